@@ -2,14 +2,16 @@
 import collections
 import concurrent.futures
 import fnmatch
-import itertools
 import os
+import threading
 import time
 
 import structlog
 
 from code_coverage_bot import taskcluster
+from code_coverage_bot.utils import DOWNLOAD_WORKERS
 from code_coverage_bot.utils import ThreadPoolExecutorResult
+from code_coverage_bot.utils import session_stats
 
 logger = structlog.get_logger(__name__)
 
@@ -24,54 +26,90 @@ SUITES_TO_IGNORE = [
 STATUS_VALUE = {"exception": 1, "failed": 2, "completed": 3}
 
 
+# Artifact fields used to index artifacts, for fast lookups
+INDEXES = [
+    ("platform",),
+    ("suite",),
+    ("chunk",),
+    ("platform", "suite"),
+    ("platform", "chunk"),
+]
+
+
 class ArtifactsHandler(object):
-    def __init__(self, test_tasks, parent_dir="ccov-artifacts", task_name_filter="*"):
+    def __init__(
+        self,
+        test_tasks,
+        parent_dir="ccov-artifacts",
+        task_name_filter="*",
+        cache=None,
+    ):
         self.test_tasks = test_tasks
         self.parent_dir = parent_dir
         self.task_name_filter = task_name_filter
+        self.cache = cache
+        self.lock = threading.Lock()
         self.artifacts = []
 
+    @property
+    def artifacts(self):
+        return self._artifacts
+
+    @artifacts.setter
+    def artifacts(self, artifacts):
+        with self.lock:
+            self._rebuild(artifacts)
+
+    def _rebuild(self, artifacts):
+        self._artifacts = []
+        self._indexes = {fields: collections.defaultdict(list) for fields in INDEXES}
+        self._chunks = collections.defaultdict(set)
+        for artifact in artifacts:
+            self._add(artifact)
+
+    def _add(self, artifact):
+        self._artifacts.append(artifact)
+        for fields, index in self._indexes.items():
+            index[tuple(getattr(artifact, field) for field in fields)].append(artifact)
+        self._chunks[artifact.platform].add(artifact.chunk)
+
+    def add_artifact(self, artifact):
+        with self.lock:
+            self._add(artifact)
+
     def generate_path(self, platform, chunk, artifact):
         file_name = "%s_%s_%s" % (platform, chunk, os.path.basename(artifact["name"]))
         return os.path.join(self.parent_dir, file_name)
 
     def get_chunks(self, platform):
-        return set(
-            artifact.chunk
-            for artifact in self.artifacts
-            if artifact.platform == platform
-        )
+        return set(self._chunks.get(platform, ()))
 
     def get_combinations(self):
         # Add the full report
         out = collections.defaultdict(list)
-        out[("all", "all")] = [artifact.path for artifact in self.artifacts]
+        out[("all", "all")] = [artifact.path for artifact in self._artifacts]
 
-        # Group by suite first
-        suites = itertools.groupby(
-            sorted(self.artifacts, key=lambda a: a.suite), lambda a: a.suite
-        )
-        for suite, artifacts in suites:
-            artifacts = list(artifacts)
+        # List all available platforms for each suite
+        suites_platforms = collections.defaultdict(list)
+        for platform, suite in self._indexes[("platform", "suite")]:
+            suites_platforms[suite].append(platform)
 
-            # List all available platforms
-            platforms = {a.platform for a in artifacts}
-            platforms.add("all")
+        # Group by suite first
+        for suite in sorted(suites_platforms):
+            out[("all", suite)] = [
+                artifact.path for artifact in self._indexes[("suite",)][(suite,)]
+            ]
 
             # And list all possible permutations with suite + platform
-            out[("all", suite)] += [artifact.path for artifact in artifacts]
-            for platform in platforms:
-                if platform != "all":
-                    out[(platform, "all")] += [
-                        artifact.path
-                        for artifact in artifacts
-                        if artifact.platform == platform
-                    ]
-                out[(platform, suite)] = [
+            for platform in suites_platforms[suite]:
+                paths = [
                     artifact.path
-                    for artifact in artifacts
-                    if platform == "all" or artifact.platform == platform
+                    for artifact in self._indexes[("platform", "suite")][
+                        (platform, suite)
+                    ]
                 ]
+                out[(platform, "all")] += paths
+                out[(platform, suite)] = paths
 
         return out
 
@@ -80,20 +118,23 @@ class ArtifactsHandler(object):
             raise Exception("suite and chunk can't both have a value")
 
         # Filter artifacts according to platform, suite and chunk.
-        filtered_files = []
-        for artifact in self.artifacts:
-            if platform is not None and artifact.platform != platform:
-                continue
-
-            if suite is not None and artifact.suite != suite:
-                continue
-
-            if chunk is not None and artifact.chunk != chunk:
-                continue
-
-            filtered_files.append(artifact.path)
+        filters = [
+            (field, value)
+            for field, value in (
+                ("platform", platform),
+                ("suite", suite),
+                ("chunk", chunk),
+            )
+            if value is not None
+        ]
+        if not filters:
+            return [artifact.path for artifact in self._artifacts]
 
-        return filtered_files
+        fields, values = zip(*filters)
+        index = self._indexes[fields]
+        if values not in index:
+            return []
+        return [artifact.path for artifact in index[values]]
 
     def download(self, test_task):
         suite = taskcluster.get_suite(test_task["task"])
@@ -109,10 +150,19 @@ class ArtifactsHandler(object):
                 continue
 
             artifact_path = self.generate_path(platform_name, chunk_name, artifact)
-            taskcluster.download_artifact(artifact_path, test_task_id, artifact["name"])
-            logger.info("%s artifact downloaded" % artifact_path)
-
-            self.artifacts.append(
+            if self.cache is not None and self.cache.fetch(
+                test_task_id, artifact["name"], artifact_path
+            ):
+                logger.info("%s artifact restored from cache" % artifact_path)
+            else:
+                taskcluster.download_artifact(
+                    artifact_path, test_task_id, artifact["name"]
+                )
+                logger.info("%s artifact downloaded" % artifact_path)
+                if self.cache is not None:
+                    self.cache.store(test_task_id, artifact["name"], artifact_path)
+
+            self.add_artifact(
                 Artifact(artifact_path, test_task_id, platform_name, suite, chunk_name)
             )
 
@@ -129,65 +179,137 @@ class ArtifactsHandler(object):
 
         return False
 
-    def download_all(self) -> None:
-        os.makedirs(self.parent_dir, exist_ok=True)
-
-        logger.info("Downloading artifacts from {} tasks".format(len(self.test_tasks)))
-
-        for test_task in self.test_tasks:
-            status = test_task["status"]["state"]
-            task_id = test_task["status"]["taskId"]
-            if status in taskcluster.FINISHED_STATUSES:
-                continue
-            while True:
-                # refresh the status information
-                task_status = taskcluster.get_task_status(task_id)
-                status = task_status["status"]["state"]
-                assert (
-                    status in taskcluster.ALL_STATUSES
-                ), "State '{}' not recognized".format(status)
-                if status in taskcluster.FINISHED_STATUSES:
-                    # Update the task status, as we will use it to compare statuses later.
-                    test_task["status"]["state"] = status
-                    break
-                logger.info(f"Waiting for task {task_id} to finish...")
-                time.sleep(60)
-
-        # Choose best tasks to download (e.g. 'completed' is better than 'failed')
-        download_tasks = {}
+    def iter_finished_tasks(self, poll_interval=60):
+        """
+        Yield batches of test tasks as soon as they reach a finished state.
+        The statuses of all pending tasks are refreshed at once by listing their
+        task groups, instead of polling every task one after the other.
+        """
+        pending = {}
+        finished = []
         for test_task in self.test_tasks:
             status = test_task["status"]["state"]
             assert (
-                status in taskcluster.FINISHED_STATUSES
+                status in taskcluster.ALL_STATUSES
             ), "State '{}' not recognized".format(status)
+            if status in taskcluster.FINISHED_STATUSES:
+                finished.append(test_task)
+            else:
+                pending[test_task["status"]["taskId"]] = test_task
+
+        if finished:
+            yield finished
+
+        while pending:
+            logger.info(f"Waiting for {len(pending)} tasks to finish...")
+            time.sleep(poll_interval)
+
+            finished = []
+            group_ids = {
+                test_task["status"]["taskGroupId"] for test_task in pending.values()
+            }
+            for group_id in group_ids:
+                for task in taskcluster.get_tasks_in_group(group_id):
+                    task_id = task["status"]["taskId"]
+                    if task_id not in pending:
+                        continue
+
+                    # refresh the status information
+                    status = task["status"]["state"]
+                    assert (
+                        status in taskcluster.ALL_STATUSES
+                    ), "State '{}' not recognized".format(status)
+                    if status in taskcluster.FINISHED_STATUSES:
+                        # Update the task status, as we will use it to compare statuses later.
+                        test_task = pending.pop(task_id)
+                        test_task["status"]["state"] = status
+                        finished.append(test_task)
+
+            if finished:
+                yield finished
+
+    def discard(self, task_id):
+        """
+        Remove the artifacts downloaded from a task, e.g. when a better task
+        for the same chunk finished later on
+        """
+        with self.lock:
+            discarded = [a for a in self._artifacts if a.task_id == task_id]
+            self._rebuild([a for a in self._artifacts if a.task_id != task_id])
 
-            chunk_name = taskcluster.get_chunk(test_task["task"])
-            platform_name = taskcluster.get_platform(test_task["task"])
+        for artifact in discarded:
+            if os.path.exists(artifact.path):
+                os.unlink(artifact.path)
 
-            if any(to_ignore in chunk_name for to_ignore in SUITES_TO_IGNORE):
-                continue
+    def replace(self, previous, test_task):
+        """
+        Download the artifacts of a task replacing worse tasks for the same chunk,
+        given as a list of (task, future) picked earlier
+        """
+        # Wait for the previous downloads to be over (or cancelled), as all tasks
+        # share the same artifact paths.
+        concurrent.futures.wait([future for _, future in previous])
 
-            if (chunk_name, platform_name) not in download_tasks:
-                # If the chunk hasn't been downloaded before, this is obviously the best task
-                # to download it from.
-                download_tasks[(chunk_name, platform_name)] = test_task
-            else:
-                # Otherwise, compare the status of this task with the previously selected task.
-                prev_task = download_tasks[(chunk_name, platform_name)]
+        # Discard all of them, as a cancelled replacement may have left the
+        # artifacts of any earlier task behind.
+        for previous_task, _ in previous:
+            self.discard(previous_task["status"]["taskId"])
+        self.download(test_task)
 
-                if STATUS_VALUE[status] > STATUS_VALUE[prev_task["status"]["state"]]:
-                    download_tasks[(chunk_name, platform_name)] = test_task
+    def download_all(self, poll_interval=60) -> None:
+        os.makedirs(self.parent_dir, exist_ok=True)
 
-        with ThreadPoolExecutorResult() as executor:
-            futures = [
-                executor.submit(self.download, test_task)
-                for test_task in download_tasks.values()
-            ]
+        logger.info("Downloading artifacts from {} tasks".format(len(self.test_tasks)))
+
+        # Tasks selected for each (chunk, platform) with their download futures,
+        # the last one being the best
+        download_tasks = collections.defaultdict(list)
+
+        with ThreadPoolExecutorResult(max_workers=DOWNLOAD_WORKERS) as executor:
+            for finished_tasks in self.iter_finished_tasks(poll_interval):
+                # Choose best tasks to download (e.g. 'completed' is better than 'failed')
+                # among the tasks that just finished and the ones already picked.
+                updated = {}
+                for test_task in finished_tasks:
+                    status = test_task["status"]["state"]
+                    chunk_name = taskcluster.get_chunk(test_task["task"])
+                    platform_name = taskcluster.get_platform(test_task["task"])
+
+                    if any(to_ignore in chunk_name for to_ignore in SUITES_TO_IGNORE):
+                        continue
+
+                    key = (chunk_name, platform_name)
+                    best = updated.get(key)
+                    if best is None and key in download_tasks:
+                        best = download_tasks[key][-1][0]
+
+                    # If the chunk hasn't been downloaded before, this is obviously the best task
+                    # to download it from. Otherwise, compare the status of this task with the
+                    # previously selected task.
+                    if (
+                        best is None
+                        or STATUS_VALUE[status] > STATUS_VALUE[best["status"]["state"]]
+                    ):
+                        updated[key] = test_task
+
+                # Start downloading right away, replacing worse tasks picked earlier.
+                for key, test_task in updated.items():
+                    previous = list(download_tasks[key])
+                    if previous:
+                        previous[-1][1].cancel()
+                        future = executor.submit(self.replace, previous, test_task)
+                    else:
+                        future = executor.submit(self.download, test_task)
+                    download_tasks[key].append((test_task, future))
+
+            futures = [picked[-1][1] for picked in download_tasks.values()]
             for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
                 exc = future.exception()
                 if exc is not None:
                     logger.error("Exception while downloading artifacts", exception=exc)
                     for f in futures:
                         f.cancel()
 
-        logger.info("Code coverage artifacts downloaded")
+        logger.info("Code coverage artifacts downloaded", **session_stats())
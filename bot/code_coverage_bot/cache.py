@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from array import array
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+# Default disk budget of the artifacts cache, in bytes
+ARTIFACTS_CACHE_SIZE = 32 * 1024**3
+
+# Delay after which the unused keys of the artifacts cache are removed, in seconds
+ARTIFACTS_KEY_MAX_AGE = 30 * 24 * 3600
+
+# Default size budget of the annotate cache, in bytes of annotations
+ANNOTATE_CACHE_SIZE = 4 * 1024**3
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    Hardlink a file, falling back to a copy when the destination
+    is on another filesystem
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1048576)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def evict_lru(directory: str, max_size: int) -> int:
+    """
+    Remove the least recently used files from a directory tree,
+    until its total size fits in the budget.
+    Returns the number of removed files.
+    """
+    entries = []
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        total -= size
+        removed += 1
+
+    return removed
+
+
+class ArtifactsCache(object):
+    """
+    Persistent cache of Taskcluster artifacts, shared by all the hooks
+    using the same cache root.
+    Artifacts are stored once per content hash, and looked up by task & artifact name.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_size: int = ARTIFACTS_CACHE_SIZE,
+        max_age: int = ARTIFACTS_KEY_MAX_AGE,
+    ) -> None:
+        self.objects_dir = os.path.join(root, "objects")
+        self.keys_dir = os.path.join(root, "keys")
+        self.max_size = max_size
+        self.max_age = max_age
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.keys_dir, exist_ok=True)
+        logger.info("Artifacts cache initialized", root=root, max_size=max_size)
+
+    def _key_path(self, task_id: str, artifact_name: str) -> str:
+        key = hashlib.sha256(f"{task_id}/{artifact_name}".encode("utf-8"))
+        return os.path.join(self.keys_dir, key.hexdigest())
+
+    def _object_path(self, content_hash: str) -> str:
+        return os.path.join(self.objects_dir, content_hash[:2], content_hash)
+
+    def fetch(self, task_id: str, artifact_name: str, path: str) -> bool:
+        """
+        Link a cached artifact at the given path, if available
+        """
+        key_path = self._key_path(task_id, artifact_name)
+        try:
+            with open(key_path, "r") as f:
+                content_hash = f.read().strip()
+        except FileNotFoundError:
+            return False
+
+        object_path = self._object_path(content_hash)
+        try:
+            # Mark the key & object as recently used.
+            os.utime(key_path)
+            os.utime(object_path)
+            if not os.path.exists(path):
+                link_or_copy(object_path, path)
+        except FileNotFoundError:
+            # The object has been evicted, forget about it.
+            os.unlink(key_path)
+            return False
+
+        logger.debug("Artifact found in cache", task_id=task_id, name=artifact_name)
+        return True
+
+    def store(self, task_id: str, artifact_name: str, path: str) -> None:
+        """
+        Add a downloaded artifact to the cache
+        """
+        content_hash = hash_file(path)
+        object_path = self._object_path(content_hash)
+
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.{uuid.uuid4().hex}.tmp"
+            link_or_copy(path, tmp_path)
+            os.replace(tmp_path, object_path)
+
+        key_path = self._key_path(task_id, artifact_name)
+        tmp_path = f"{key_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content_hash)
+        os.replace(tmp_path, key_path)
+
+    def _is_expired_key(self, path: str, expiry: float) -> bool:
+        if os.stat(path).st_mtime < expiry:
+            return True
+
+        # Keys being written by another process are not complete yet
+        if path.endswith(".tmp"):
+            return False
+
+        with open(path, "r") as f:
+            content_hash = f.read().strip()
+        return not os.path.exists(self._object_path(content_hash))
+
+    def evict(self) -> None:
+        """
+        Evict least recently used artifacts once the disk budget is exceeded,
+        then the keys of the evicted artifacts and the ones unused for too long.
+        Artifacts are hardlinked in the working directories, so this is only
+        useful once they have all been used.
+        """
+        removed = evict_lru(self.objects_dir, self.max_size)
+        if removed:
+            logger.info("Evicted artifacts from cache", nb=removed)
+
+        expiry = time.time() - self.max_age
+        removed = 0
+        for name in os.listdir(self.keys_dir):
+            path = os.path.join(self.keys_dir, name)
+            try:
+                if not self._is_expired_key(path, expiry):
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+        if removed:
+            logger.info("Evicted artifact keys from cache", nb=removed)
+
+
+def _chunks(items: list, size: int = 500) -> Iterator[list]:
+    # Bounded number of variables in each sqlite query
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+# Granularity of the last access times of the annotations, in seconds
+ANNOTATE_ACCESS_GRANULARITY = 3600
+
+# Delay between two writes of the access times & stats of a cache, in seconds
+ANNOTATE_FLUSH_INTERVAL = 60
+
+
+class AnnotateCache(object):
+    """
+    Persistent cache of annotate results, immutable for a given (revision, path).
+    Annotations are stored in sqlite as arrays of (changeset id, line) integers,
+    so it can be shared by threads and processes.
+    Lookups are read-only: the access times & stats are kept in memory,
+    and written in a single transaction from time to time (see flush).
+    """
+
+    def __init__(self, path: str, max_size: int = ANNOTATE_CACHE_SIZE) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.nodes: Dict[int, str] = {}
+        self.ids: Dict[str, int] = {}
+
+        # Access times & stats not written to the database yet
+        self.accessed: Set[Tuple[str, str]] = set()
+        self.hits = 0
+        self.misses = 0
+        self.flushed_at = time.monotonic()
+
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS changesets "
+                "(id INTEGER PRIMARY KEY, node TEXT UNIQUE NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS annotations "
+                "(rev TEXT NOT NULL, path TEXT NOT NULL, data BLOB, "
+                "last_access INTEGER NOT NULL, PRIMARY KEY (rev, path))"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS annotations_last_access "
+                "ON annotations (last_access)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS stats "
+                "(id INTEGER PRIMARY KEY CHECK (id = 0), hits INTEGER, misses INTEGER)"
+            )
+            db.execute("INSERT OR IGNORE INTO stats VALUES (0, 0, 0)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=60)
+        return db
+
+    def _load_nodes(self, db: sqlite3.Connection, ids: Set[int]) -> None:
+        with self.lock:
+            ids = ids - self.nodes.keys()
+        rows = []
+        for chunk in _chunks(list(ids)):
+            rows += db.execute(
+                "SELECT id, node FROM changesets WHERE id IN ({})".format(
+                    ",".join("?" * len(chunk))
+                ),
+                chunk,
+            ).fetchall()
+        with self.lock:
+            for id, node in rows:
+                self.nodes[id] = node
+                self.ids[node] = id
+
+    def _get_ids(self, db: sqlite3.Connection, nodes: Set[str]) -> Dict[str, int]:
+        with self.lock:
+            missing = nodes - self.ids.keys()
+        if missing:
+            db.executemany(
+                "INSERT OR IGNORE INTO changesets (node) VALUES (?)",
+                [(node,) for node in missing],
+            )
+            rows = []
+            for chunk in _chunks(list(missing)):
+                rows += db.execute(
+                    "SELECT id, node FROM changesets WHERE node IN ({})".format(
+                        ",".join("?" * len(chunk))
+                    ),
+                    chunk,
+                ).fetchall()
+            with self.lock:
+                for id, node in rows:
+                    self.nodes[id] = node
+                    self.ids[node] = id
+        with self.lock:
+            return {node: self.ids[node] for node in nodes}
+
+    def get_many(
+        self, rev: str, paths: List[str]
+    ) -> Dict[str, Optional[Tuple[Tuple[str, int], ...]]]:
+        """
+        Cached annotations of files at a revision, only for the cached files.
+        Files missing at that revision are cached as None.
+        """
+        if not paths:
+            return {}
+        db = self._connect()
+        with db:
+            rows = []
+            for chunk in _chunks(list(set(paths))):
+                rows += db.execute(
+                    "SELECT path, data, last_access FROM annotations "
+                    "WHERE rev = ? AND path IN ({})".format(",".join("?" * len(chunk))),
+                    [rev] + chunk,
+                ).fetchall()
+
+            arrays = {}
+            for path, data, _ in rows:
+                if data is None:
+                    arrays[path] = None
+                    continue
+                values = array("q")
+                values.frombytes(data)
+                arrays[path] = values
+            self._load_nodes(
+                db,
+                set(
+                    id
+                    for values in arrays.values()
+                    if values is not None
+                    for id in values[0::2]
+                ),
+            )
+
+        # Access times are only refreshed once they are older than the granularity
+        stale = int(time.time()) - ANNOTATE_ACCESS_GRANULARITY
+        with self.lock:
+            self.accessed.update(
+                (rev, path) for path, _, last_access in rows if last_access < stale
+            )
+            self.hits += len(arrays)
+            self.misses += len(set(paths)) - len(arrays)
+            flush = time.monotonic() - self.flushed_at >= ANNOTATE_FLUSH_INTERVAL
+        if flush:
+            self.flush()
+
+        with self.lock:
+            return {
+                path: None
+                if values is None
+                else tuple(
+                    (self.nodes[id], line)
+                    for id, line in zip(values[0::2], values[1::2])
+                )
+                for path, values in arrays.items()
+            }
+
+    def put_many(
+        self, rev: str, annotations: Dict[str, Optional[Tuple[Tuple[str, int], ...]]]
+    ) -> None:
+        if not annotations:
+            return
+        db = self._connect()
+        with db:
+            ids = self._get_ids(
+                db,
+                set(
+                    node
+                    for annotate in annotations.values()
+                    if annotate is not None
+                    for node, _ in annotate
+                ),
+            )
+
+            def _pack(annotate):
+                if annotate is None:
+                    return None
+                values = array("q")
+                for node, line in annotate:
+                    values.append(ids[node])
+                    values.append(line)
+                return values.tobytes()
+
+            now = int(time.time())
+            db.executemany(
+                "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)",
+                [
+                    (rev, path, _pack(annotate), now)
+                    for path, annotate in annotations.items()
+                ],
+            )
+
+    def flush(self) -> None:
+        """
+        Write the access times & stats of the lookups, in a single transaction
+        """
+        with self.lock:
+            accessed, self.accessed = self.accessed, set()
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+            self.flushed_at = time.monotonic()
+        if not accessed and not hits and not misses:
+            return
+
+        db = self._connect()
+        with db:
+            now = int(time.time())
+            db.executemany(
+                "UPDATE annotations SET last_access = ? WHERE rev = ? AND path = ?",
+                [(now, rev, path) for rev, path in accessed],
+            )
+            db.execute(
+                "UPDATE stats SET hits = hits + ?, misses = misses + ?", (hits, misses)
+            )
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Hits & misses of all the caches sharing the database, and of this one
+        """
+        hits, misses = (
+            self._connect().execute("SELECT hits, misses FROM stats").fetchone()
+        )
+        with self.lock:
+            return {"hits": hits + self.hits, "misses": misses + self.misses}
+
+    def evict(self) -> None:
+        """
+        Evict least recently used annotations once the size budget is exceeded
+        """
+        self.flush()
+        db = self._connect()
+        with db:
+            (total,) = db.execute(
+                "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM annotations"
+            ).fetchone()
+            removed = 0
+            if total > self.max_size:
+                rows = db.execute(
+                    "SELECT rev, path, COALESCE(LENGTH(data), 0) FROM annotations "
+                    "ORDER BY last_access"
+                )
+                evicted = []
+                for rev, path, size in rows:
+                    if total <= self.max_size:
+                        break
+                    evicted.append((rev, path))
+                    total -= size
+                db.executemany(
+                    "DELETE FROM annotations WHERE rev = ? AND path = ?", evicted
+                )
+                removed = len(evicted)
+
+        logger.info("Annotate cache stats", evicted=removed, **self.stats())
@@ -8,6 +8,7 @@ import os
 
 import yaml
 
+from code_coverage_bot.phabricator import MAPPING_ENGINES
 from code_coverage_bot.secrets import secrets
 from code_coverage_bot.taskcluster import taskcluster_config
 from code_coverage_bot.libmozdata import setup as setup_libmozdata
@@ -28,6 +29,13 @@ def setup_cli(parameters=True):
 
         parser.add_argument("--revision", default=os.environ.get("REVISION"))
 
+        parser.add_argument(
+            "--mapping-engine",
+            choices=MAPPING_ENGINES,
+            help="Engine mapping the coverage lines on the Phabricator revisions, "
+            "falls back on the MAPPING_ENGINE secret",
+        )
+
     parser.add_argument(
         "--cache-root", required=True, help="Cache root, used to pull changesets"
     )
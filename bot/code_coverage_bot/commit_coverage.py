@@ -4,42 +4,159 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import concurrent.futures
-import io
 import json
+import multiprocessing
+import multiprocessing.util
 import os
 import threading
 import time
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 import hglib
 import structlog
 import zstandard
+from google.cloud.storage.bucket import Bucket
 from tqdm import tqdm
 
+from code_coverage_bot import covdir
+from code_coverage_bot.cache import AnnotateCache
 from code_coverage_bot import hgmo
+from code_coverage_bot.commit_store import CommitCoverageStore
 from code_coverage_bot.phabricator import PhabricatorUploader
 from code_coverage_bot.secrets import secrets
+from code_coverage_bot.utils import ProcessPoolExecutorResult
 from code_coverage_bot.utils import ThreadPoolExecutorResult
+from code_coverage_bot.utils import available_memory
 from code_coverage_bot.gcp import DEFAULT_FILTER
-from code_coverage_bot.gcp import download_report
 from code_coverage_bot.gcp import get_bucket
 from code_coverage_bot.gcp import get_name
 from code_coverage_bot.gcp import list_reports
+from code_coverage_bot.gcp import ReportsCache
 
 logger = structlog.get_logger(__name__)
 
+# Memory budget of an analysis worker
+WORKER_MEMORY = 2 * 1024**3
+
+# Coverage of a changeset, as (node, (added, covered, unknown)), or (node, None)
+# when no coverage was found
+ChangesetResult = Tuple[str, Optional[Tuple[int, int, int]]]
+
 hg_servers = list()
 hg_servers_lock = threading.Lock()
 thread_local = threading.local()
 
 
-def _init_thread(repo_dir: str) -> None:
+def _init_thread(
+    repo_dir: str,
+    bucket: Bucket,
+    reports_cache: ReportsCache,
+    annotate_cache: AnnotateCache,
+) -> None:
     hg_server = hglib.open(repo_dir)
     thread_local.hg = hg_server
+    thread_local.bucket = bucket
+    thread_local.reports_cache = reports_cache
+    thread_local.annotate_cache = annotate_cache
     with hg_servers_lock:
         hg_servers.append(hg_server)
 
 
-def generate(server_address: str, repo_dir: str, out_dir: str = ".") -> None:
+def _init_process(
+    repo_dir: str, service_account: dict, reports_dir: str, annotate_cache_path: str
+) -> None:
+    """
+    Each worker process has its own hglib command server, bucket & caches,
+    the annotate cache database being shared by all of them
+    """
+    annotate_cache = AnnotateCache(annotate_cache_path)
+    # Write the last access times & stats of the worker when it exits
+    multiprocessing.util.Finalize(annotate_cache, annotate_cache.flush, exitpriority=10)
+    _init_thread(
+        repo_dir,
+        get_bucket(service_account),
+        ReportsCache(reports_dir),
+        annotate_cache,
+    )
+
+
+def plan_workers(cpus: int, memory: int, memory_per_worker: int = WORKER_MEMORY) -> int:
+    """
+    Number of analysis workers fitting in the available memory
+    """
+    return max(1, min(cpus, memory // memory_per_worker))
+
+
+def analyze_changeset(
+    server_address: str, repo_dir: str, changeset_to_analyze: str
+) -> List[ChangesetResult]:
+    """
+    Compute the coverage of the changesets pushed along with a changeset,
+    using the worker's hglib command server, bucket & reports cache
+    """
+    report_name = get_name(
+        "mozilla-central", changeset_to_analyze, DEFAULT_FILTER, DEFAULT_FILTER
+    )
+
+    phabricatorUploader = PhabricatorUploader(
+        repo_dir,
+        changeset_to_analyze,
+        warnings_enabled=False,
+        annotate_cache=thread_local.annotate_cache,
+    )
+
+    # Use the hg.mozilla.org server to get the automation relevant changesets, since
+    # this information is broken in our local repo (which mozilla-unified).
+    with hgmo.HGMO(server_address=server_address) as hgmo_remote_server:
+        changesets = hgmo_remote_server.get_automation_relevance_changesets(
+            changeset_to_analyze
+        )
+
+    # Only parse the files touched by the changesets
+    with thread_local.reports_cache.extract(
+        thread_local.bucket, report_name
+    ) as report_path:
+        assert report_path is not None, f"Missing report {report_name}"
+        with covdir.StreamingReport(report_path) as report:
+            results = phabricatorUploader.generate(thread_local.hg, report, changesets)
+
+    out: List[ChangesetResult] = []
+    for changeset in changesets:
+        # Lookup changeset coverage from phabricator uploader
+        coverage = results.get(changeset["node"])
+        if coverage is None:
+            logger.info("No coverage found", changeset=changeset)
+            out.append((changeset["node"], None))
+            continue
+
+        paths = coverage["paths"].values()
+        out.append(
+            (
+                changeset["node"],
+                (
+                    sum(c["lines_added"] for c in paths),
+                    sum(c["lines_covered"] for c in paths),
+                    sum(c["lines_unknown"] for c in paths),
+                ),
+            )
+        )
+    return out
+
+
+def generate(
+    server_address: str,
+    repo_dir: str,
+    out_dir: str = ".",
+    cache_dir: Optional[str] = None,
+    processes: bool = False,
+) -> None:
+    """
+    Compute the coverage of the changesets with a report on the bucket.
+    The analysis is GIL bound, so it can run in worker processes instead of threads.
+    """
     start_time = time.monotonic()
 
     commit_coverage_path = os.path.join(out_dir, "commit_coverage.json.zst")
@@ -49,30 +166,43 @@ def generate(server_address: str, repo_dir: str, out_dir: str = ".") -> None:
     ), "Missing GOOGLE_CLOUD_STORAGE secret"
     bucket = get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
 
-    blob = bucket.blob("commit_coverage.json.zst")
-    if blob.exists():
-        dctx = zstandard.ZstdDecompressor()
-        commit_coverage = json.loads(
-            dctx.decompress(blob.download_as_bytes(raw_download=True))
-        )
-    else:
-        commit_coverage = {}
+    store = CommitCoverageStore(bucket)
+    commit_coverage = store.load()
+
+    # Results not stored on the bucket yet
+    new_results: Dict[str, Optional[dict]] = {}
 
     cctx = zstandard.ZstdCompressor(threads=-1)
 
+    def _set_result(changeset: str, counts: Optional[Tuple[int, int, int]]) -> None:
+        result = None
+        if counts is not None:
+            added, covered, unknown = counts
+            result = {"added": added, "covered": covered, "unknown": unknown}
+        commit_coverage[changeset] = result
+        new_results[changeset] = result
+
     def _upload():
-        blob = bucket.blob("commit_coverage.json.zst")
-        blob.upload_from_string(
-            cctx.compress(json.dumps(commit_coverage).encode("ascii"))
-        )
-        blob.content_type = "application/json"
-        blob.content_encoding = "zstd"
-        blob.patch()
+        # Only the new results are uploaded, in their own segment
+        nonlocal new_results
+        results, new_results = new_results, {}
+        store.append(results)
 
     # We are only interested in "overall" coverage, not platform or suite specific.
+    reports = list_reports(
+        bucket,
+        "mozilla-central",
+        platform=DEFAULT_FILTER,
+        suite=DEFAULT_FILTER,
+        cache_path=(
+            os.path.join(cache_dir, "ccov-reports-listing.json")
+            if cache_dir is not None
+            else None
+        ),
+    )
     changesets_to_analyze = [
         changeset
-        for changeset, platform, suite in list_reports(bucket, "mozilla-central")
+        for changeset, platform, suite in reports
         if platform == DEFAULT_FILTER and suite == DEFAULT_FILTER
     ]
 
@@ -83,77 +213,93 @@ def generate(server_address: str, repo_dir: str, out_dir: str = ".") -> None:
         if changeset not in commit_coverage
     ]
 
+    # Reports are kept compressed, in the persistent cache when available
+    reports_dir = os.path.join(
+        cache_dir if cache_dir is not None else out_dir, "ccov-reports"
+    )
+    reports_cache = ReportsCache(reports_dir)
+
+    # Annotations of the same changesets are shared between reports and runs
+    annotate_cache_path = os.path.join(
+        cache_dir if cache_dir is not None else out_dir, "annotate.sqlite"
+    )
+    annotate_cache = AnnotateCache(annotate_cache_path)
+
     # Use the local server to generate the coverage mapping, as it is faster and
     # correct.
-    def analyze_changeset(changeset_to_analyze: str) -> None:
-        report_name = get_name(
-            "mozilla-central", changeset_to_analyze, DEFAULT_FILTER, DEFAULT_FILTER
+    if processes:
+        max_workers = plan_workers(os.cpu_count() or 1, available_memory())
+        # Spawned, so the workers do not inherit the bucket client & hglib servers
+        executor = ProcessPoolExecutorResult(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process,
+            initargs=(
+                repo_dir,
+                secrets[secrets.GOOGLE_CLOUD_STORAGE],
+                reports_dir,
+                annotate_cache_path,
+            ),
         )
-        assert download_report(
-            os.path.join(out_dir, "ccov-reports"), bucket, report_name
+    else:
+        max_workers = min(
+            32,
+            (os.cpu_count() or 1) + 4,
+            plan_workers(32, available_memory()),
+        )
+        executor = ThreadPoolExecutorResult(
+            max_workers=max_workers,
+            initializer=_init_thread,
+            initargs=(repo_dir, bucket, reports_cache, annotate_cache),
         )
+    logger.info(
+        f"Analyzing {len(changesets_to_analyze)} with {max_workers} workers",
+        processes=processes,
+    )
 
-        with open(
-            os.path.join(out_dir, "ccov-reports", f"{report_name}.json"), "r"
-        ) as f:
-            report = json.load(f)
+    # Segments are compacted in the background, once there are too many
+    with ThreadPoolExecutorResult(max_workers=1) as compactor:
+        compaction = None
+        with executor:
+            futures = {
+                executor.submit(
+                    analyze_changeset, server_address, repo_dir, changeset
+                ): changeset
+                for changeset in changesets_to_analyze
+            }
+            for future in tqdm(
+                concurrent.futures.as_completed(futures), total=len(futures)
+            ):
+                exc = future.exception()
+                if exc is not None:
+                    logger.error(f"Exception {exc} while analyzing {futures[future]}")
+                else:
+                    for changeset, counts in future.result():
+                        _set_result(changeset, counts)
 
-        phabricatorUploader = PhabricatorUploader(
-            repo_dir, changeset_to_analyze, warnings_enabled=False
-        )
+                if time.monotonic() - start_time >= 600:
+                    _upload()
+                    start_time = time.monotonic()
 
-        # Use the hg.mozilla.org server to get the automation relevant changesets, since
-        # this information is broken in our local repo (which mozilla-unified).
-        with hgmo.HGMO(server_address=server_address) as hgmo_remote_server:
-            changesets = hgmo_remote_server.get_automation_relevance_changesets(
-                changeset_to_analyze
-            )
+                    if store.needs_compaction() and (
+                        compaction is None or compaction.done()
+                    ):
+                        compaction = compactor.submit(store.compact)
 
-        results = phabricatorUploader.generate(thread_local.hg, report, changesets)
+        while len(hg_servers) > 0:
+            hg_server = hg_servers.pop()
+            hg_server.close()
 
-        for changeset in changesets:
-            # Lookup changeset coverage from phabricator uploader
-            coverage = results.get(changeset["node"])
-            if coverage is None:
-                logger.info("No coverage found", changeset=changeset)
-                commit_coverage[changeset["node"]] = None
-                continue
+        reports_cache.evict()
+        annotate_cache.evict()
 
-            commit_coverage[changeset["node"]] = {
-                "added": sum(c["lines_added"] for c in coverage["paths"].values()),
-                "covered": sum(c["lines_covered"] for c in coverage["paths"].values()),
-                "unknown": sum(c["lines_unknown"] for c in coverage["paths"].values()),
-            }
+        _upload()
+
+    if store.needs_compaction():
+        store.compact()
 
-    max_workers = min(32, (os.cpu_count() or 1) + 4)
-    logger.info(f"Analyzing {len(changesets_to_analyze)} with {max_workers} workers")
-
-    with ThreadPoolExecutorResult(
-        initializer=_init_thread, initargs=(repo_dir,)
-    ) as executor:
-        futures = [
-            executor.submit(analyze_changeset, changeset)
-            for changeset in changesets_to_analyze
-        ]
-        for changeset, future in tqdm(
-            zip(changesets_to_analyze, concurrent.futures.as_completed(futures)),
-            total=len(futures),
-        ):
-            exc = future.exception()
-            if exc is not None:
-                logger.error(f"Exception {exc} while analyzing {changeset}")
-
-            if time.monotonic() - start_time >= 600:
-                _upload()
-                start_time = time.monotonic()
-
-    while len(hg_servers) > 0:
-        hg_server = hg_servers.pop()
-        hg_server.close()
-
-    _upload()
-
-    with open(commit_coverage_path, "wb") as zf:
-        with cctx.stream_writer(zf) as compressor:
-            with io.TextIOWrapper(compressor, encoding="ascii") as f:
-                json.dump(commit_coverage, f)
+    # A single frame, storing its content size for the readers of the legacy blob
+    data = cctx.compress(json.dumps(commit_coverage).encode("ascii"))
+    with open(commit_coverage_path, "wb") as f:
+        f.write(data)
+    store.write_legacy(data)
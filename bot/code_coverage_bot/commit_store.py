@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Segmented store of the commit coverage results on the bucket.
+
+* segments: immutable zstd JSON blobs, each holding the results of a checkpoint
+* index: small JSON blob listing the segments, from the oldest to the newest,
+  and the segments replaced by a compaction, waiting to be deleted
+
+A checkpoint only uploads the new results and the index, and compaction merges
+the segments in the background. Newer segments override older ones.
+
+The legacy commit_coverage.json.zst blob is still written with all the results
+at the end of each run, until all its readers switch to read().
+"""
+
+import json
+import threading
+import time
+import uuid
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import structlog
+import zstandard
+from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud.storage.bucket import Bucket
+
+logger = structlog.get_logger(__name__)
+
+LEGACY_PATH = "commit_coverage.json.zst"
+INDEX_PATH = "commit_coverage/index.json"
+SEGMENT_PATH = "commit_coverage/segments/{}.json.zst"
+
+# Number of segments above which they are compacted
+COMPACTION_THRESHOLD = 16
+
+# Delay before deleting the segments replaced by a compaction, in seconds,
+# so readers of the previous index can still load them
+RETIRED_GRACE_PERIOD = 3600
+
+# Attempts to load all the segments of an index, when they are deleted meanwhile
+LOAD_ATTEMPTS = 3
+
+# Segments & retired (segment, timestamp) pairs of the index
+Segments = List[str]
+Retired = List[Tuple[str, float]]
+
+
+class CommitCoverageStore(object):
+    def __init__(self, bucket: Bucket) -> None:
+        self.bucket = bucket
+        self.segments: Segments = []
+        self.retired: Retired = []
+        self.generation: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def _read_segment(self, path: str) -> dict:
+        data = self.bucket.blob(path).download_as_bytes(raw_download=True)
+        return json.loads(zstandard.ZstdDecompressor().decompress(data))
+
+    def _read_segments(self, segments: Segments) -> Dict[str, Optional[dict]]:
+        results: Dict[str, Optional[dict]] = {}
+        for path in segments:
+            results.update(self._read_segment(path))
+        return results
+
+    def _write_segment(self, results: dict) -> str:
+        path = SEGMENT_PATH.format(uuid.uuid4().hex)
+        blob = self.bucket.blob(path)
+        blob.content_encoding = "zstd"
+        blob.upload_from_string(
+            zstandard.ZstdCompressor(threads=-1).compress(
+                json.dumps(results).encode("ascii")
+            ),
+            content_type="application/json",
+        )
+        return path
+
+    def _delete_segments(self, segments: Segments) -> None:
+        for path in segments:
+            try:
+                self.bucket.blob(path).delete()
+            except NotFound:
+                pass
+
+    def _load_index(self) -> bool:
+        """
+        Load the index, returning False when there is none
+        """
+        blob = self.bucket.get_blob(INDEX_PATH)
+        if blob is None:
+            self.segments, self.retired, self.generation = [], [], None
+            return False
+
+        try:
+            data = json.loads(
+                blob.download_as_bytes(if_generation_match=blob.generation)
+            )
+        except (NotFound, PreconditionFailed):
+            # Replaced in the meantime, load the new version
+            return self._load_index()
+
+        self.segments = data["segments"]
+        self.retired = [(path, retired) for path, retired in data.get("retired", [])]
+        self.generation = blob.generation
+        return True
+
+    def _update_index(
+        self, update: Callable[[Segments, Retired], Tuple[Segments, Retired]]
+    ) -> None:
+        """
+        Replace the index with update(segments, retired). When another process
+        updated it meanwhile, the update is applied again on the new version.
+        """
+        while True:
+            segments, retired = update(list(self.segments), list(self.retired))
+            blob = self.bucket.blob(INDEX_PATH)
+            try:
+                blob.upload_from_string(
+                    json.dumps({"segments": segments, "retired": retired}),
+                    content_type="application/json",
+                    if_generation_match=self.generation or 0,
+                )
+            except PreconditionFailed:
+                logger.info("Commit coverage index changed, updating it again")
+                self._load_index()
+                continue
+
+            self.segments, self.retired = segments, retired
+            self.generation = blob.generation
+            return
+
+    def _migrate(self) -> None:
+        """
+        Store the results of the single legacy blob as the first segment
+        """
+        try:
+            results = self._read_segment(LEGACY_PATH)
+        except NotFound:
+            path = None
+        else:
+            path = self._write_segment(results)
+
+        def update(segments, retired):
+            # Another process may have migrated the legacy blob meanwhile
+            if self.generation is not None:
+                return segments, retired
+            return [path] if path is not None else [], retired
+
+        self._update_index(update)
+        if path is not None and path not in self.segments:
+            self._delete_segments([path])
+        elif path is not None:
+            logger.info("Migrated legacy commit coverage", nb=len(results))
+
+    def load(self, migrate: bool = True) -> Dict[str, Optional[dict]]:
+        """
+        Load the index, and merge all the segments.
+        Without an index, the legacy blob is migrated, or only read.
+        """
+        for attempt in range(LOAD_ATTEMPTS):
+            with self.lock:
+                if not self._load_index():
+                    if not migrate:
+                        try:
+                            return self._read_segment(LEGACY_PATH)
+                        except NotFound:
+                            return {}
+                    self._migrate()
+                segments = list(self.segments)
+
+            try:
+                results = self._read_segments(segments)
+            except NotFound:
+                # Compacted and deleted meanwhile, use the new index
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+                logger.info("Commit coverage segment deleted, reloading the index")
+                continue
+
+            logger.info(
+                "Loaded commit coverage", segments=len(segments), nb=len(results)
+            )
+            return results
+
+    def append(self, results: Dict[str, Optional[dict]]) -> None:
+        """
+        Store new results in their own segment
+        """
+        if not results:
+            return
+        path = self._write_segment(results)
+        with self.lock:
+            self._update_index(lambda segments, retired: (segments + [path], retired))
+        logger.info("Stored commit coverage segment", path=path, nb=len(results))
+
+    def needs_compaction(self) -> bool:
+        return len(self.segments) > COMPACTION_THRESHOLD
+
+    def compact(self) -> None:
+        """
+        Merge the current segments in a single one.
+        Segments appended in the meantime are kept after it, and the merged
+        ones are deleted after a grace period.
+        """
+        with self.lock:
+            segments = list(self.segments)
+        if len(segments) <= 1:
+            return
+
+        try:
+            results = self._read_segments(segments)
+        except NotFound:
+            # Compacted & deleted by another process meanwhile
+            logger.info("Commit coverage compacted by another process")
+            with self.lock:
+                self._load_index()
+            return
+        path = self._write_segment(results)
+
+        def update(current, retired):
+            # Another process may have compacted the same segments meanwhile
+            if current[: len(segments)] != segments:
+                return current, retired
+            now = time.time()
+            return (
+                [path] + current[len(segments) :],
+                retired + [(old_path, now) for old_path in segments],
+            )
+
+        with self.lock:
+            self._update_index(update)
+        if path not in self.segments:
+            self._delete_segments([path])
+            logger.info("Commit coverage compacted by another process")
+            return
+        logger.info(
+            "Compacted commit coverage", segments=len(segments), nb=len(results)
+        )
+
+        self.delete_retired()
+
+    def delete_retired(self) -> None:
+        """
+        Delete the segments replaced by compactions more than a grace period ago
+        """
+        limit = time.time() - RETIRED_GRACE_PERIOD
+        with self.lock:
+            expired = [path for path, retired in self.retired if retired < limit]
+        if not expired:
+            return
+
+        self._delete_segments(expired)
+        with self.lock:
+            self._update_index(
+                lambda segments, retired: (
+                    segments,
+                    [(path, at) for path, at in retired if path not in expired],
+                )
+            )
+        logger.info("Deleted retired commit coverage segments", nb=len(expired))
+
+    def write_legacy(self, data: bytes) -> None:
+        """
+        Replace the legacy blob with all the results, compressed in a zstd frame
+        with its content size, for the readers that do not use read() yet
+        """
+        blob = self.bucket.blob(LEGACY_PATH)
+        blob.content_encoding = "zstd"
+        blob.upload_from_string(data, content_type="application/json")
+
+
+def read(bucket: Bucket) -> Dict[str, Optional[dict]]:
+    """
+    All the commit coverage results, merged as a single dict
+    """
+    return CommitCoverageStore(bucket).load(migrate=False)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Binary covdir format, giving random access to the coverage of a single file.
+
+Layout (little endian):
+* header: magic, number of files, offset and size of the top table
+* records: the line coverage of each file, as runs of (length, hits + 1) varints
+* blocks: sorted path table, split in blocks of BLOCK_SIZE entries
+  (path length, path, record offset, record size)
+* top table: offset, size and first path of each block
+
+A reader fetches the header and the top table once, then a single block
+and a single record for each file.
+"""
+
+import bisect
+import io
+import struct
+
+from code_coverage_bot.covdir import coverage_array
+
+MAGIC = b"COVBIN\x00\x01"
+HEADER = struct.Struct("<8sIIQQ")
+TOP_ENTRY = struct.Struct("<QIH")
+BLOCK_ENTRY = struct.Struct("<QI")
+PATH_SIZE = struct.Struct("<H")
+BLOCK_SIZE = 256
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_coverage(coverage):
+    """
+    Run-length encode the hits of a file, where -1 marks a line without code
+    """
+    out = bytearray()
+    i = 0
+    while i < len(coverage):
+        value = coverage[i]
+        length = 1
+        while i + length < len(coverage) and coverage[i + length] == value:
+            length += 1
+        _write_varint(out, length)
+        _write_varint(out, value + 1)
+        i += length
+    return bytes(out)
+
+
+def decode_coverage(data):
+    out = []
+    pos = 0
+    while pos < len(data):
+        length, pos = _read_varint(data, pos)
+        value, pos = _read_varint(data, pos)
+        out.extend([value - 1] * length)
+    return coverage_array(out)
+
+
+class Writer(object):
+    """
+    Incremental writer of the binary format to a seekable file object:
+    each record is written as its file is added, the path tables on finish
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.start = f.tell()
+        self.size = HEADER.size
+        self.entries = []
+        f.write(bytes(HEADER.size))
+
+    def add(self, path, coverage):
+        record = encode_coverage(coverage)
+        self.entries.append((path.encode("utf-8"), self.size, len(record)))
+        self.f.write(record)
+        self.size += len(record)
+
+    def finish(self):
+        self.entries.sort()
+
+        top = bytearray()
+        for i in range(0, len(self.entries), BLOCK_SIZE):
+            block = bytearray()
+            for path, offset, size in self.entries[i : i + BLOCK_SIZE]:
+                block += (
+                    PATH_SIZE.pack(len(path)) + path + BLOCK_ENTRY.pack(offset, size)
+                )
+
+            first_path = self.entries[i][0]
+            top += TOP_ENTRY.pack(self.size, len(block), len(first_path))
+            top += first_path
+            self.f.write(block)
+            self.size += len(block)
+
+        self.f.write(top)
+        end = self.f.tell()
+        self.f.seek(self.start)
+        self.f.write(HEADER.pack(MAGIC, len(self.entries), 0, self.size, len(top)))
+        self.f.seek(end)
+        self.size += len(top)
+
+
+def dumps(index):
+    """
+    Serialize the files of a covdir.PathIndex in the binary format
+    """
+    out = io.BytesIO()
+    writer = Writer(out)
+    for path, coverage in sorted(index.coverages.items()):
+        writer.add(path, coverage)
+    writer.finish()
+    return out.getvalue()
+
+
+class Reader(object):
+    """
+    Random access to a binary covdir report, through a read(offset, size) function
+    (e.g. ranged reads on a remote blob)
+    """
+
+    def __init__(self, read):
+        self.read = read
+        self.top = None
+        self.blocks = {}
+
+    def _load_top(self):
+        magic, self.nb_files, _, top_offset, top_size = HEADER.unpack(
+            self.read(0, HEADER.size)
+        )
+        assert magic == MAGIC, "Not a binary covdir report"
+
+        data = self.read(top_offset, top_size) if top_size else b""
+        self.top = []
+        pos = 0
+        while pos < len(data):
+            offset, size, path_size = TOP_ENTRY.unpack_from(data, pos)
+            pos += TOP_ENTRY.size
+            self.top.append((data[pos : pos + path_size], offset, size))
+            pos += path_size
+        self.first_paths = [first for first, _, _ in self.top]
+
+    def _load_block(self, i):
+        if i not in self.blocks:
+            _, offset, size = self.top[i]
+            data = self.read(offset, size)
+            block = {}
+            pos = 0
+            while pos < len(data):
+                (path_size,) = PATH_SIZE.unpack_from(data, pos)
+                pos += PATH_SIZE.size
+                path = data[pos : pos + path_size]
+                pos += path_size
+                block[path] = BLOCK_ENTRY.unpack_from(data, pos)
+                pos += BLOCK_ENTRY.size
+            self.blocks[i] = block
+        return self.blocks[i]
+
+    def get(self, path):
+        """
+        Coverage of a file, None if it is not in the report
+        """
+        if self.top is None:
+            self._load_top()
+
+        key = "/".join(filter(None, path.split("/"))).encode("utf-8")
+        i = bisect.bisect_right(self.first_paths, key) - 1
+        if i < 0:
+            return None
+
+        entry = self._load_block(i).get(key)
+        if entry is None:
+            return None
+        offset, size = entry
+        if size == 0:
+            return coverage_array([])
+        return decode_coverage(self.read(offset, size))
+
+    def get_coverages(self, paths):
+        """
+        Coverage of the given files, for the ones in the report
+        """
+        out = {}
+        for path in paths:
+            coverage = self.get(path)
+            if coverage is not None:
+                out[path] = coverage
+        return out
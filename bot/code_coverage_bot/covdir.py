@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import math
+import mmap
+import re
+import sys
+from array import array
+from collections.abc import Mapping
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+STATS = ("coveragePercent", "linesCovered", "linesMissed", "linesTotal")
+
+
+def is_file(node):
+    return "coverage" in node
+
+
+def coverage_array(values):
+    """
+    Compact line coverage, widened only when a hits count overflows 32 bits
+    """
+    try:
+        return array("i", values)
+    except OverflowError:
+        return array("q", values)
+
+
+class Node(Mapping):
+    """
+    Compact covdir node, read-only and usable as the dict it was loaded from
+    """
+
+    __slots__ = ("name",) + STATS
+    KEYS = ("name",) + STATS
+
+    def __init__(self, data):
+        self.name = sys.intern(data["name"])
+        self.coveragePercent = data["coveragePercent"]
+        self.linesCovered = data["linesCovered"]
+        self.linesMissed = data["linesMissed"]
+        self.linesTotal = data["linesTotal"]
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+class Directory(Node):
+    __slots__ = ("children",)
+    KEYS = Node.KEYS + ("children",)
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.children = data["children"]
+
+
+class File(Node):
+    __slots__ = ("coverage",)
+    KEYS = Node.KEYS + ("coverage",)
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.coverage = coverage_array(data["coverage"])
+
+
+def _build_node(data):
+    if not isinstance(data.get("name"), str):
+        # A map of children, indexed by their interned names
+        return {child.name: child for child in data.values()}
+    if "coverage" in data and not data.get("children"):
+        return File(data)
+    return Directory(data)
+
+
+def load(f):
+    """
+    Load a covdir report from a file object, as a compact tree
+    """
+    return json.load(f, object_hook=_build_node)
+
+
+def loads(data):
+    """
+    Load a covdir report from a string, as a compact tree
+    """
+    return json.loads(data, object_hook=_build_node)
+
+
+class PathIndex(object):
+    """
+    Flat index of the files in a covdir report, mapping their paths to their coverage
+    """
+
+    def __init__(self, coverages, root=""):
+        self.coverages = coverages
+        self.root = root
+
+    @staticmethod
+    def from_report(report):
+        """
+        Flatten a covdir report, walking it only once
+        """
+        coverages = {}
+        stack = [("", report)]
+        while stack:
+            base_path, node = stack.pop()
+            children = node.get("children")
+            if children:
+                # Reversed, to list the paths in the report order
+                for name, child in reversed(children.items()):
+                    stack.append((f"{base_path}{name}/", child))
+            elif "coverage" in node:
+                coverages[base_path[:-1]] = node["coverage"]
+
+        return PathIndex(coverages, report["name"])
+
+    @staticmethod
+    def from_file(report_path):
+        """
+        Build the index of a covdir report file
+        """
+        with open(report_path, "rb") as f:
+            return PathIndex.from_report(load(f))
+
+    def get(self, path):
+        """
+        Coverage of a file, None if it is not in the report
+        """
+        coverage = self.coverages.get(path)
+        if coverage is None and ("//" in path or path[:1] == "/" or path[-1:] == "/"):
+            coverage = self.coverages.get("/".join(filter(None, path.split("/"))))
+        return coverage
+
+    def get_coverages(self, paths):
+        """
+        Coverage of the given files, for the ones in the report
+        """
+        out = {}
+        for path in paths:
+            coverage = self.get(path)
+            if coverage is not None:
+                out[path] = coverage
+        return out
+
+    def paths(self):
+        """
+        List all the paths in the report, including its root directory name
+        """
+        if not self.root:
+            return list(self.coverages)
+        return [f"{self.root}/{path}" for path in self.coverages]
+
+    def __len__(self):
+        return len(self.coverages)
+
+
+class StreamingReport(object):
+    """
+    covdir report reader, only parsing the files it is asked for:
+    the other subtrees are skipped without building any object.
+    """
+
+    STRING = re.compile(rb'"((?:[^"\\]|\\.)*)"', re.DOTALL)
+    TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]', re.DOTALL)
+    SCALAR = re.compile(rb"[^,}\]\s]*")
+    SPACES = re.compile(rb"[ \t\n\r]*")
+
+    def __init__(self, source):
+        """
+        Read a report from a file path (memory mapped) or from bytes
+        """
+        self.file = None
+        if isinstance(source, str):
+            self.file = open(source, "rb")
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = source
+
+    def close(self):
+        if self.file is not None:
+            self.data.close()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_coverages(self, paths):
+        """
+        Coverage of the given files, for the ones in the report
+        """
+        wanted = {}
+        tree = {}
+        for path in paths:
+            parts = list(filter(None, path.split("/")))
+            wanted.setdefault("/".join(parts), []).append(path)
+            subtree = tree
+            for part in parts:
+                subtree = subtree.setdefault(part, {})
+
+        out = {}
+        self._parse_node(self._spaces(0), "", tree, wanted, out)
+        return out
+
+    def _spaces(self, pos):
+        return self.SPACES.match(self.data, pos).end()
+
+    def _string(self, pos):
+        match = self.STRING.match(self.data, pos)
+        assert match is not None, f"Expected a string at {pos}"
+        raw = match.group(1)
+        if b"\\" in raw:
+            return json.loads(match.group(0)), match.end()
+        return raw.decode("utf-8"), match.end()
+
+    def _skip(self, pos):
+        """
+        Skip a JSON value, returning its end position
+        """
+        first = self.data[pos : pos + 1]
+        if first == b'"':
+            return self.STRING.match(self.data, pos).end()
+        if first not in (b"{", b"["):
+            return self.SCALAR.match(self.data, pos).end()
+
+        depth = 0
+        for match in self.TOKEN.finditer(self.data, pos):
+            token = self.data[match.start()]
+            if token == 0x22:  # A string, possibly containing brackets
+                continue
+            if token in (0x7B, 0x5B):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+        raise ValueError("Truncated covdir report")
+
+    def _parse_object(self, pos, on_item):
+        """
+        Walk the items of a JSON object, on_item parses or skips each value
+        """
+        assert self.data[pos] == 0x7B, f"Expected an object at {pos}"
+        pos = self._spaces(pos + 1)
+        if self.data[pos] == 0x7D:
+            return pos + 1
+        while True:
+            key, pos = self._string(pos)
+            pos = self._spaces(pos)
+            assert self.data[pos] == 0x3A, f"Expected ':' at {pos}"
+            pos = on_item(key, self._spaces(pos + 1))
+            pos = self._spaces(pos)
+            if self.data[pos] == 0x7D:
+                return pos + 1
+            assert self.data[pos] == 0x2C, f"Expected ',' at {pos}"
+            pos = self._spaces(pos + 1)
+
+    def _parse_node(self, pos, path, tree, wanted, out):
+        def on_child(name, pos):
+            if name not in tree:
+                return self._skip(pos)
+            child_path = f"{path}/{name}" if path else name
+            return self._parse_node(pos, child_path, tree[name], wanted, out)
+
+        def on_item(key, pos):
+            if key == "children" and tree:
+                return self._parse_object(pos, on_child)
+            if key == "coverage" and path in wanted:
+                end = self.data.find(b"]", pos)
+                assert end != -1, "Truncated covdir report"
+                values = self.data[pos + 1 : end].split(b",")
+                coverage = coverage_array(
+                    [int(value) for value in values if value.strip()]
+                )
+                for original_path in wanted[path]:
+                    out[original_path] = coverage
+                return end + 1
+            return self._skip(pos)
+
+        return self._parse_object(pos, on_item)
+
+
+class ReportParser(object):
+    """
+    Incremental covdir report parser, fed with the successive chunks of a report.
+    The coverage of each file is passed to on_file(path, coverage) as soon as it
+    is read, so only a chunk and a file are kept in memory.
+    """
+
+    TOKEN = re.compile(
+        rb'[ \t\n\r]*(?:"((?:[^"\\]|\\.)*)"|([{}\[\]:,])|([^ \t\n\r{}\[\]:,"]+))',
+        re.DOTALL,
+    )
+
+    def __init__(self, on_file):
+        self.on_file = on_file
+        self.data = b""
+        self.pos = 0
+        # Open containers, as [key, expecting a key, children map] for objects
+        # and None for arrays
+        self.stack = []
+
+    def feed(self, chunk):
+        self.data = self.data[self.pos :] + chunk
+        self.pos = 0
+        self._parse(final=False)
+
+    def close(self):
+        self._parse(final=True)
+        assert not self.stack, "Truncated covdir report"
+        assert not self.data[self.pos :].strip(), "Trailing data in covdir report"
+
+    def _path(self):
+        # Files are named by the keys of the children maps, below the root
+        return "/".join(
+            frame[0] for frame in self.stack if frame is not None and frame[2]
+        )
+
+    def _parse(self, final):
+        data = self.data
+        while True:
+            match = self.TOKEN.match(data, self.pos)
+            if match is None or (match.end() == len(data) and not final):
+                # Wait for the rest of a token split between chunks
+                assert (
+                    not final or not data[self.pos :].strip()
+                ), f"Invalid covdir report at {self.pos}"
+                return
+
+            string, punctuation, _ = match.groups()
+            top = self.stack[-1] if self.stack else None
+            in_node = top is not None and not top[2]
+            if string is not None:
+                if top is not None and top[1]:
+                    top[0] = (
+                        json.loads(match.group(0).strip())
+                        if b"\\" in string
+                        else string.decode("utf-8")
+                    )
+                    top[1] = False
+            elif punctuation == b"{":
+                self.stack.append([None, True, in_node and top[0] == "children"])
+            elif punctuation == b"[" and in_node and top[0] == "coverage":
+                end = data.find(b"]", match.end())
+                if end == -1:
+                    if final:
+                        raise ValueError("Truncated covdir report")
+                    return
+                values = data[match.end() : end].split(b",")
+                self.on_file(
+                    self._path(),
+                    coverage_array([int(value) for value in values if value.strip()]),
+                )
+                self.pos = end + 1
+                continue
+            elif punctuation == b"[":
+                self.stack.append(None)
+            elif punctuation in (b"}", b"]"):
+                self.stack.pop()
+            elif punctuation == b"," and top is not None:
+                top[1] = True
+            self.pos = match.end()
+
+
+def merge_coverage(a, b):
+    """
+    Sum the hits of two line coverage arrays, where -1 marks a line without code.
+    The shorter array is padded with -1.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    out = list(a)
+    for i, hits in enumerate(b):
+        if hits < 0:
+            continue
+        out[i] = hits if out[i] < 0 else out[i] + hits
+    return out
+
+
+def merge_into(target, source):
+    """
+    Merge a covdir node in another one, in place.
+    Nodes from the source are reused, so it must not be used afterwards.
+    The stats are not updated, see update_stats.
+    """
+    if is_file(source):
+        assert is_file(target), f"{source['name']} is both a file and a directory"
+        target["coverage"] = merge_coverage(target["coverage"], source["coverage"])
+        return
+
+    assert not is_file(target), f"{source['name']} is both a file and a directory"
+    children = target.setdefault("children", {})
+    for name, child in source["children"].items():
+        if name in children:
+            merge_into(children[name], child)
+        else:
+            children[name] = child
+
+
+def percent(covered, total):
+    """
+    Coverage percentage rounded at 2 digits, with the same float expression as
+    grcov: (covered / total * 10000.0).round() / 100.0, Rust rounding half away
+    from zero (unlike Python's round, rounding half to even)
+    """
+    if total == 0:
+        return 0.0
+    value = covered / total * 10000.0
+    rounded = math.floor(value)
+    if value - rounded >= 0.5:
+        rounded += 1
+    return rounded / 100.0
+
+
+def update_stats(node):
+    """
+    Recompute the lines stats of a covdir node, from its files' coverage
+    """
+    if is_file(node):
+        total = sum(1 for hits in node["coverage"] if hits >= 0)
+        covered = sum(1 for hits in node["coverage"] if hits > 0)
+    else:
+        total = covered = 0
+        for child in node["children"].values():
+            child_covered, child_total = update_stats(child)
+            covered += child_covered
+            total += child_total
+
+    node["coveragePercent"] = percent(covered, total)
+    node["linesCovered"] = covered
+    node["linesMissed"] = total - covered
+    node["linesTotal"] = total
+    return covered, total
+
+
+def merge(reports):
+    """
+    Merge covdir reports, summing the hits of each line
+    """
+    out = {"children": {}, "name": ""}
+    for report in reports:
+        merge_into(out, report)
+    update_stats(out)
+    return out
+
+
+def _serialize(obj):
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, array):
+        return obj.tolist()
+    raise TypeError(f"Unsupported type {type(obj)}")
+
+
+def dumps(report):
+    """
+    Serialize a covdir report as grcov does
+    """
+    return json.dumps(
+        report,
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=_serialize,
+    ).encode("utf-8")
+
+
+def merge_files(paths, output_path):
+    """
+    Merge covdir report files, loading them one at a time
+    """
+
+    def _load():
+        for path in paths:
+            with open(path, "rb") as f:
+                yield json.load(f)
+
+    report = merge(_load())
+    with open(output_path, "wb") as f:
+        f.write(dumps(report))
+
+    logger.info("Merged covdir reports", nb=len(paths), output=output_path)
+    return output_path
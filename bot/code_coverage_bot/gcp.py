@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
+import io
+import json
 import os
 import re
+import shutil
+import threading
+import time
+import uuid
+from array import array
+from contextlib import contextmanager
 from datetime import datetime
 from datetime import timedelta
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
 from typing import Iterator
 from typing import Optional
 from typing import Tuple
@@ -10,91 +21,523 @@ from typing import Tuple
 import pytz
 import structlog
 import zstandard
+from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import PreconditionFailed
 from google.cloud import storage as gcp_storage
 from google.oauth2.service_account import Credentials
 
+from code_coverage_bot import covbin
+from code_coverage_bot.cache import evict_lru
+
 logger = structlog.get_logger(__name__)
 
 DEFAULT_FILTER = "all"
 
+# Size of the reads & writes when downloading a report
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Default disk budget of the reports cache, in bytes
+REPORTS_CACHE_SIZE = 16 * 1024**3
+
+
+def glob_to_regex(glob: str) -> str:
+    """
+    Convert a Cloud Storage glob: * and ? do not match /, ** matches anything
+    """
+    out = ""
+    i = 0
+    while i < len(glob):
+        if glob.startswith("**", i):
+            out += ".*"
+            i += 2
+        elif glob[i] == "*":
+            out += "[^/]*"
+            i += 1
+        elif glob[i] == "?":
+            out += "[^/]"
+            i += 1
+        else:
+            out += re.escape(glob[i])
+            i += 1
+    return out + "$"
+
+
+class LocalBlob(object):
+    """
+    Blob stored on the local filesystem, supporting the subset of the
+    Google Cloud Storage API used by the bot
+    """
+
+    def __init__(self, bucket: "LocalBucket", name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, name)
+        self.metadata_path = os.path.join(bucket.root, ".metadata", f"{name}.json")
+        self.content_type = None
+        self.content_encoding = None
+        self.generation = None
+        self.reload()
+
+    def reload(self) -> None:
+        try:
+            with open(self.metadata_path) as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return
+        self.content_type = metadata["content_type"]
+        self.content_encoding = metadata["content_encoding"]
+        self.generation = metadata.get("generation")
+
+    def patch(self) -> None:
+        os.makedirs(os.path.dirname(self.metadata_path), exist_ok=True)
+        with open(self.metadata_path, "w") as f:
+            json.dump(
+                {
+                    "content_type": self.content_type,
+                    "content_encoding": self.content_encoding,
+                    "generation": self.generation,
+                },
+                f,
+            )
+
+    def _check_generation(self, if_generation_match: Optional[int]) -> None:
+        if if_generation_match is None:
+            return
+        current = LocalBlob(self.bucket, self.name)
+        generation = current.generation if current.exists() else 0
+        if generation != if_generation_match:
+            raise PreconditionFailed(f"Generation mismatch on {self.name}")
+
+    @property
+    def size(self) -> Optional[int]:
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return None
+
+    @property
+    def time_created(self) -> Optional[datetime]:
+        try:
+            return datetime.fromtimestamp(os.path.getmtime(self.path), pytz.UTC)
+        except FileNotFoundError:
+            return None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def upload_from_file(
+        self, f, content_type=None, if_generation_match=None, **kwargs
+    ) -> None:
+        if content_type is not None:
+            self.content_type = content_type
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as output:
+            shutil.copyfileobj(f, output)
+
+        with self.bucket.lock:
+            self._check_generation(if_generation_match)
+            os.replace(tmp_path, self.path)
+            self.generation = time.time_ns()
+            self.patch()
+
+    def upload_from_string(self, data, content_type=None, **kwargs) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.upload_from_file(io.BytesIO(data), content_type=content_type, **kwargs)
+
+    def download_as_bytes(
+        self,
+        start=None,
+        end=None,
+        raw_download=False,
+        if_generation_match=None,
+        **kwargs,
+    ):
+        self._check_generation(if_generation_match)
+        try:
+            with open(self.path, "rb") as f:
+                if start is None:
+                    return f.read()
+                f.seek(start)
+                return f.read(None if end is None else end - start + 1)
+        except FileNotFoundError:
+            raise NotFound(f"No such blob {self.name}")
+
+    def open(self, mode: str = "rb", **kwargs) -> BinaryIO:
+        assert mode == "rb", "Only binary reads are supported"
+        try:
+            return open(self.path, "rb")
+        except FileNotFoundError:
+            raise NotFound(f"No such blob {self.name}")
+
+    def download_to_filename(self, filename, raw_download=False, **kwargs) -> None:
+        if not self.exists():
+            raise NotFound(f"No such blob {self.name}")
+        shutil.copyfile(self.path, filename)
+
+    def delete(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            raise NotFound(f"No such blob {self.name}")
+
+
+class LocalBucket(object):
+    """
+    Bucket stored in a local directory, to run the bot offline (e.g. in tests
+    and benchmarks)
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.name = os.path.basename(root)
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def blob(self, name: str) -> LocalBlob:
+        return LocalBlob(self, name)
+
+    def get_blob(self, name: str) -> Optional[LocalBlob]:
+        blob = self.blob(name)
+        return blob if blob.exists() else None
+
+    def list_blobs(
+        self, prefix: str = "", match_glob: Optional[str] = None, **kwargs
+    ) -> Iterator[LocalBlob]:
+        glob = re.compile(glob_to_regex(match_glob)) if match_glob else None
+        for root, dirs, files in os.walk(self.root):
+            if root == self.root and ".metadata" in dirs:
+                dirs.remove(".metadata")
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.relpath(os.path.join(root, name), self.root)
+                path = path.replace(os.sep, "/")
+                if path.startswith(prefix) and (glob is None or glob.match(path)):
+                    yield LocalBlob(self, path)
+
+    def __repr__(self) -> str:
+        return f"<LocalBucket {self.root}>"
+
+
+_buckets: Dict[Tuple[Optional[str], ...], Any] = {}
+_buckets_lock = threading.Lock()
+
 
 def get_bucket(service_account: dict) -> gcp_storage.bucket.Bucket:
     """
     Build a Google Cloud Storage client & bucket
-    from Taskcluster secret
+    from Taskcluster secret.
+    The bucket is built once per process, and shared by all threads.
+    A local directory can be used instead, through the local_dir key.
     """
-    # Load credentials from Taskcluster secret
-    if "bucket" not in service_account:
-        raise KeyError("Missing bucket in GOOGLE_CLOUD_STORAGE")
-    bucket = service_account["bucket"]
+    if "local_dir" in service_account:
+        key = ("local", service_account["local_dir"])
+    else:
+        # Load credentials from Taskcluster secret
+        if "bucket" not in service_account:
+            raise KeyError("Missing bucket in GOOGLE_CLOUD_STORAGE")
+        key = (
+            service_account["bucket"],
+            service_account.get("client_email"),
+            service_account.get("private_key_id"),
+        )
 
-    # Use those credentials to create a Storage client
-    # The project is needed to avoid checking env variables and crashing
-    creds = Credentials.from_service_account_info(service_account)
-    client = gcp_storage.Client(project=creds.project_id, credentials=creds)
+    with _buckets_lock:
+        if key not in _buckets:
+            if "local_dir" in service_account:
+                _buckets[key] = LocalBucket(service_account["local_dir"])
+            else:
+                # Use those credentials to create a Storage client
+                # The project is needed to avoid checking env variables and crashing
+                creds = Credentials.from_service_account_info(service_account)
+                client = gcp_storage.Client(project=creds.project_id, credentials=creds)
+                _buckets[key] = client.get_bucket(service_account["bucket"])
 
-    return client.get_bucket(bucket)
+        return _buckets[key]
 
 
 def get_name(repository: str, changeset: str, platform: str, suite: str) -> str:
     return f"{repository}/{changeset}/{platform}:{suite}"
 
 
+def _download_report(
+    bucket: gcp_storage.bucket.Bucket, name: str, output: BinaryIO
+) -> None:
+    """
+    Decompress a report archive while streaming it from the bucket.
+    Raises NotFound when the report does not exist.
+    """
+    blob = bucket.blob(f"{name}.json.zstd")
+    with blob.open("rb", raw_download=True, chunk_size=DOWNLOAD_CHUNK_SIZE) as archive:
+        dctx = zstandard.ZstdDecompressor()
+        dctx.copy_stream(
+            archive,
+            output,
+            read_size=DOWNLOAD_CHUNK_SIZE,
+            write_size=DOWNLOAD_CHUNK_SIZE,
+        )
+
+
 def download_report(
     base_dir: str, bucket: gcp_storage.bucket.Bucket, name: str
 ) -> bool:
-    path = f"{name}.json"
-    archive_path = f"{name}.json.zstd"
-    full_archive_path = os.path.join(base_dir, archive_path)
-    full_path = os.path.join(base_dir, path)
-
-    blob = bucket.blob(archive_path)
-    if not blob.exists():
-        logger.debug("No report found on GCP", path=archive_path)
-        return False
-
+    full_path = os.path.join(base_dir, f"{name}.json")
     if os.path.exists(full_path):
         logger.info("Report already available", path=full_path)
         return True
 
-    os.makedirs(os.path.dirname(full_archive_path), exist_ok=True)
-    blob.download_to_filename(full_archive_path, raw_download=True)
-    logger.info("Downloaded report archive", path=full_archive_path)
-
-    with open(full_path, "wb") as output:
-        with open(full_archive_path, "rb") as archive:
-            dctx = zstandard.ZstdDecompressor()
-            reader = dctx.stream_reader(archive)
-            while True:
-                chunk = reader.read(16384)
-                if not chunk:
-                    break
-                output.write(chunk)
-
-    os.unlink(full_archive_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    tmp_path = f"{full_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as output:
+            _download_report(bucket, name, output)
+        os.replace(tmp_path, full_path)
+    except NotFound:
+        logger.debug("No report found on GCP", path=f"{name}.json.zstd")
+        return False
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    logger.info("Downloaded report", path=full_path)
     return True
 
 
+def download_report_data(
+    bucket: gcp_storage.bucket.Bucket, name: str
+) -> Optional[bytes]:
+    """
+    Download a report in memory, None when it does not exist
+    """
+    output = io.BytesIO()
+    try:
+        _download_report(bucket, name, output)
+    except NotFound:
+        logger.debug("No report found on GCP", path=f"{name}.json.zstd")
+        return None
+    return output.getvalue()
+
+
+class ReportsCache(object):
+    """
+    Local cache of reports, kept compressed as they are stored on the bucket.
+    Its root can live on a persistent volume, to be reused by the next runs.
+    """
+
+    def __init__(self, root: str, max_size: int = REPORTS_CACHE_SIZE) -> None:
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, f"{name}.json.zstd")
+
+    def fetch(self, bucket: gcp_storage.bucket.Bucket, name: str) -> Optional[str]:
+        """
+        Path of a report archive, downloaded when it is not cached yet.
+        None when the report does not exist.
+        """
+        path = self._path(name)
+        try:
+            # Mark the report as recently used.
+            os.utime(path)
+            with self.lock:
+                self.hits += 1
+            return path
+        except FileNotFoundError:
+            pass
+
+        with self.lock:
+            self.misses += 1
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as output:
+                blob = bucket.blob(f"{name}.json.zstd")
+                with blob.open(
+                    "rb", raw_download=True, chunk_size=DOWNLOAD_CHUNK_SIZE
+                ) as archive:
+                    shutil.copyfileobj(archive, output, DOWNLOAD_CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        except NotFound:
+            logger.debug("No report found on GCP", path=f"{name}.json.zstd")
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        return path
+
+    @contextmanager
+    def extract(
+        self, bucket: gcp_storage.bucket.Bucket, name: str
+    ) -> Iterator[Optional[str]]:
+        """
+        Decompress a report in a temporary file, removed once done with it
+        """
+        archive_path = self.fetch(bucket, name)
+        if archive_path is None:
+            yield None
+            return
+
+        path = f"{archive_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(archive_path, "rb") as archive, open(path, "wb") as output:
+                zstandard.ZstdDecompressor().copy_stream(
+                    archive,
+                    output,
+                    read_size=DOWNLOAD_CHUNK_SIZE,
+                    write_size=DOWNLOAD_CHUNK_SIZE,
+                )
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def evict(self) -> None:
+        """
+        Evict least recently used reports once the disk budget is exceeded
+        """
+        removed = evict_lru(self.root, self.max_size)
+        logger.info(
+            "Reports cache stats",
+            hits=self.hits,
+            misses=self.misses,
+            evicted=removed,
+        )
+
+
+def get_binary_report(bucket: gcp_storage.bucket.Bucket, name: str) -> covbin.Reader:
+    """
+    Random access to the coverage of a report's files, through ranged reads
+    on its binary version
+    """
+    blob = bucket.blob(f"{name}.covbin")
+
+    def read(offset: int, size: int) -> bytes:
+        return blob.download_as_bytes(
+            start=offset, end=offset + size - 1, raw_download=True
+        )
+
+    return covbin.Reader(read)
+
+
+def download_file_coverage(
+    bucket: gcp_storage.bucket.Bucket, name: str, path: str
+) -> Optional[array]:
+    """
+    Download the coverage of a single file from a report
+    """
+    try:
+        return get_binary_report(bucket, name).get(path)
+    except NotFound:
+        logger.debug("No binary report found on GCP", name=name)
+        return None
+
+
+def _load_listing(path: str) -> Dict[str, list]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_listing(path: str, listing: Dict[str, list]) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(listing, f)
+    os.replace(tmp_path, path)
+
+
 def list_reports(
-    bucket: gcp_storage.bucket.Bucket, repository: str, until: Optional[datetime] = None
+    bucket: gcp_storage.bucket.Bucket,
+    repository: str,
+    until: Optional[timedelta] = None,
+    platform: Optional[str] = None,
+    suite: Optional[str] = None,
+    cache_path: Optional[str] = None,
 ) -> Iterator[Tuple[str, str, str]]:
+    """
+    List the (changeset, platform, suite) reports of a repository.
+    Only the needed fields are listed, and the platform & suite filters are
+    applied by the server.
+    When a cache path is given, the parsed listing of all the reports is kept
+    there, so only the blobs created or replaced since the last run need to be
+    parsed again. The filters are then applied on the listed entries.
+    """
     REGEX_BLOB = re.compile(
         r"^{}/(\w+)/([\w\-]+):([\w\-]+).json.zstd$".format(repository)
     )
+    REGEX_BINARY_BLOB = re.compile(
+        r"^{}/\w+/[\w\-]+:[\w\-]+.covbin$".format(repository)
+    )
+    cached = _load_listing(cache_path) if cache_path is not None else {}
+    listing = {}
+    complete = False
+
+    if cache_path is None:
+        match_glob = "{}/*/{}:{}.json.zstd".format(
+            repository, platform or "*", suite or "*"
+        )
+    else:
+        # The cached listing holds all the reports, whatever the filters
+        match_glob = f"{repository}/*/*:*.json.zstd"
+    blobs = bucket.list_blobs(
+        prefix=f"{repository}/",
+        match_glob=match_glob,
+        fields="items(name,generation,timeCreated),nextPageToken",
+    )
     now = datetime.utcnow().replace(tzinfo=pytz.UTC)
-    for blob in bucket.list_blobs(prefix=repository):
-        if isinstance(until, timedelta) and (now - blob.time_created) >= until:
-            logger.debug(f"Skipping old blob {blob}")
-            continue
-
-        # Get changeset from blob name
-        match = REGEX_BLOB.match(blob.name)
-        if match is None:
-            logger.warn("Invalid blob found {}".format(blob.name))
-            continue
-        changeset = match.group(1)
-        platform = match.group(2)
-        suite = match.group(3)
-
-        # Build report instance and ingest it
-        yield changeset, platform, suite
+    try:
+        for blob in blobs:
+            entry = cached.get(blob.name)
+            if entry is None or entry[0] != blob.generation:
+                # Binary reports are only a companion of the JSON ones
+                if REGEX_BINARY_BLOB.match(blob.name):
+                    continue
+
+                # Get changeset from blob name
+                match = REGEX_BLOB.match(blob.name)
+                if match is None:
+                    logger.warn("Invalid blob found {}".format(blob.name))
+                    continue
+                entry = [blob.generation, blob.time_created.timestamp()] + list(
+                    match.groups()
+                )
+            listing[blob.name] = entry
+
+            if platform is not None and entry[3] != platform:
+                continue
+            if suite is not None and entry[4] != suite:
+                continue
+
+            created = datetime.fromtimestamp(entry[1], pytz.UTC)
+            if isinstance(until, timedelta) and (now - created) >= until:
+                logger.debug(f"Skipping old blob {blob.name}")
+                continue
+
+            # Build report instance and ingest it
+            yield tuple(entry[2:])
+
+        complete = True
+    finally:
+        # Keep the entries parsed so far when the listing was interrupted, the
+        # removed reports are only dropped from a complete listing.
+        if cache_path is not None:
+            if not complete:
+                listing = {**cached, **listing}
+            _save_listing(cache_path, listing)
+            logger.info(
+                "Listed reports",
+                repository=repository,
+                nb=len(listing),
+                new=len(listing.keys() - cached.keys()),
+            )
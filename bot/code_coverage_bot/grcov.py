@@ -1,12 +1,30 @@
 # -*- coding: utf-8 -*-
+import os
+
 import structlog
 
 from code_coverage_bot.utils import run_check
+from code_coverage_bot.utils import run_to_file
 
 logger = structlog.get_logger(__name__)
 
+# Peak memory used by a grcov process building a covdir report, in bytes
+GRCOV_MEMORY = 4 * 1024**3
+
+
+def plan_parallelism(nb_reports, cpus, memory, memory_per_report=GRCOV_MEMORY):
+    """
+    Split the available CPUs between concurrent grcov processes,
+    running no more of them than the memory budget allows.
+    Returns the number of concurrent processes and the threads for each of them.
+    """
+    assert nb_reports > 0, "No reports to build"
+    workers = min(nb_reports, cpus, memory // memory_per_report)
+    workers = max(1, workers)
+    return workers, max(1, cpus // workers)
+
 
-def report(artifacts, source_dir=None, out_format="covdir", options=[]):
+def build_command(artifacts, source_dir=None, out_format="covdir", options=None):
     assert out_format in (
         "covdir",
         "files",
@@ -24,7 +42,14 @@ def report(artifacts, source_dir=None, out_format="covdir", options=[]):
         cmd.append("--ignore-not-existing")
 
     cmd.extend(artifacts)
-    cmd.extend(options)
+    if options is not None:
+        cmd.extend(options)
+
+    return cmd
+
+
+def report(artifacts, source_dir=None, out_format="covdir", options=None):
+    cmd = build_command(artifacts, source_dir, out_format, options)
 
     try:
         return run_check(cmd)
@@ -33,6 +58,29 @@ def report(artifacts, source_dir=None, out_format="covdir", options=[]):
         raise
 
 
+def report_to_file(
+    artifacts, output_path, source_dir=None, out_format="covdir", options=None
+):
+    """
+    Run grcov, writing the report straight to a file instead of keeping it in memory
+    """
+    cmd = build_command(artifacts, source_dir, out_format, options)
+
+    try:
+        peak_rss = run_to_file(cmd, output_path)
+    except Exception:
+        logger.error("Error while running grcov")
+        raise
+
+    logger.info(
+        "Built grcov report",
+        path=output_path,
+        size=os.path.getsize(output_path),
+        peak_rss=peak_rss,
+    )
+    return output_path
+
+
 def files_list(artifacts, source_dir=None):
     options = ["--filter", "covered", "--threads", "2"]
     files = report(
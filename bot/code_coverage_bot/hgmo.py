@@ -3,11 +3,12 @@ import os
 import signal
 import subprocess
 
-import requests
 import structlog
 
 from typing import Iterable
 
+from code_coverage_bot.utils import get_session
+
 
 logger = structlog.get_logger(__name__)
 
@@ -87,7 +88,7 @@ class HGMO(object):
         if changeset is not None:
             params["changeset"] = changeset
 
-        r = requests.get(
+        r = get_session().get(
             "{}/json-pushes".format(self.server_address),
             params=params,
             headers={"User-Agent": "code-coverage-bot"},
@@ -97,7 +98,7 @@ class HGMO(object):
         return r.json()
 
     def get_automation_relevance_changesets(self, changeset):
-        r = requests.get(
+        r = get_session().get(
             "{}/json-automationrelevance/{}".format(
                 self.server_address,
                 changeset,
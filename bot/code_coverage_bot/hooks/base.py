@@ -12,11 +12,13 @@ import hglib
 import structlog
 
 from code_coverage_bot import config
+from code_coverage_bot import covdir
 from code_coverage_bot import grcov
 from code_coverage_bot import taskcluster
 from code_coverage_bot.artifacts import ArtifactsHandler
-from code_coverage_bot.taskcluster import taskcluster_config
+from code_coverage_bot.cache import ArtifactsCache
 from code_coverage_bot.utils import ThreadPoolExecutorResult
+from code_coverage_bot.utils import available_memory
 
 logger = structlog.get_logger(__name__)
 
@@ -49,10 +51,15 @@ class Hook(object):
             "Mercurial setup", repository=self.repository, revision=self.revision
         )
 
+        self.cache_root = cache_root
+        artifacts_cache = None
         if cache_root is not None:
             assert os.path.isdir(cache_root), f"Cache root {cache_root} is not a dir."
             self.repo_dir = os.path.join(cache_root, self.branch)
 
+            # Keep artifacts between runs on the same revision
+            artifacts_cache = ArtifactsCache(os.path.join(cache_root, "ccov-artifacts"))
+
         # Load coverage tasks for all platforms
         decision_task_id = taskcluster.get_decision_task(self.branch, self.revision)
 
@@ -74,7 +81,7 @@ class Hook(object):
             assert platform in platforms, f"{platform} missing in the task group."
 
         self.artifactsHandler = ArtifactsHandler(
-            test_tasks, self.artifacts_dir, task_name_filter
+            test_tasks, self.artifacts_dir, task_name_filter, cache=artifacts_cache
         )
 
     @property
@@ -124,20 +131,87 @@ class Hook(object):
                     logger.error(format_exception(exc, exc, exc.__traceback__))
                     os._exit(1)
 
-    def build_reports(self, only=None):
+    def build_reports(self, only=None, merge=False):
         """
-        Build all the possible covdir reports using current artifacts
+        Build all the possible covdir reports using current artifacts.
+        In merge mode, grcov only builds the (platform, suite) reports, and the
+        aggregated ones are merged from them.
         """
+        try:
+            return self._build_reports(only, merge)
+        finally:
+            # The artifacts used by the reports are linked in the working directory,
+            # so the cache can be trimmed now
+            if self.artifactsHandler.cache is not None:
+                self.artifactsHandler.cache.evict()
+
+    def _build_reports(self, only, merge):
         os.makedirs(self.reports_dir, exist_ok=True)
 
-        reports = {}
-        for (
-            (platform, suite),
-            artifacts,
-        ) in self.artifactsHandler.get_combinations().items():
-            if only is not None and (platform, suite) not in only:
-                continue
+        all_combinations = self.artifactsHandler.get_combinations()
+        combinations = {
+            key: artifacts
+            for key, artifacts in all_combinations.items()
+            if only is None or key in only
+        }
+        if not merge:
+            return self._run_grcov(combinations)
+
+        def is_leaf(key):
+            return "all" not in key
+
+        # List the leaf reports needed to build each aggregated report
+        aggregates = {
+            (platform, suite): [
+                leaf
+                for leaf in all_combinations
+                if is_leaf(leaf)
+                and platform in ("all", leaf[0])
+                and suite in ("all", leaf[1])
+            ]
+            for platform, suite in combinations
+            if not is_leaf((platform, suite))
+        }
+        leaves = set(key for key in combinations if is_leaf(key))
+        for aggregate_leaves in aggregates.values():
+            leaves.update(aggregate_leaves)
+
+        reports = self._run_grcov(
+            {key: all_combinations[key] for key in all_combinations if key in leaves}
+        )
+
+        for (platform, suite), aggregate_leaves in aggregates.items():
+            logger.info(
+                "Merging covdir suite report",
+                suite=suite,
+                platform=platform,
+                reports=len(aggregate_leaves),
+            )
+            reports[(platform, suite)] = covdir.merge_files(
+                [reports[leaf] for leaf in aggregate_leaves],
+                os.path.join(self.reports_dir, f"{platform}.{suite}.json"),
+            )
+
+        return {key: reports[key] for key in combinations}
 
+    def _run_grcov(self, combinations):
+        """
+        Build covdir reports for the given combinations with grcov, in parallel
+        """
+        if not combinations:
+            return {}
+
+        workers, threads = grcov.plan_parallelism(
+            len(combinations), os.cpu_count() or 1, available_memory()
+        )
+        logger.info(
+            "Building covdir reports",
+            nb=len(combinations),
+            workers=workers,
+            threads=threads,
+        )
+
+        def build(platform, suite, artifacts):
             # Generate covdir report for that suite & platform
             logger.info(
                 "Building covdir suite report",
@@ -145,18 +219,23 @@ class Hook(object):
                 platform=platform,
                 artifacts=len(artifacts),
             )
-            output = grcov.report(
-                artifacts, source_dir=self.repo_dir, out_format="covdir"
+            return grcov.report_to_file(
+                artifacts,
+                os.path.join(self.reports_dir, f"{platform}.{suite}.json"),
+                source_dir=self.repo_dir,
+                out_format="covdir",
+                options=["--threads", str(threads)],
             )
 
-            # Write output on FS
-            path = os.path.join(self.reports_dir, f"{platform}.{suite}.json")
-            with open(path, "wb") as f:
-                f.write(output)
-
-            reports[(platform, suite)] = path
+        # The full report is the first in the combinations, and the longest to build:
+        # it starts first and stays first in the output.
+        with ThreadPoolExecutorResult(max_workers=workers) as executor:
+            futures = {
+                key: executor.submit(build, key[0], key[1], artifacts)
+                for key, artifacts in combinations.items()
+            }
 
-        return reports
+        return {key: future.result() for key, future in futures.items()}
 
     def index_task(self, namespaces, ttl=180):
         """
@@ -169,7 +248,7 @@ class Hook(object):
             logger.warning("Skipping Taskcluster indexation, no task id found.")
             return
 
-        index_service = taskcluster_config.get_service("index")
+        index_service = taskcluster.get_service("index")
 
         for namespace in namespaces:
             index_service.insertTask(
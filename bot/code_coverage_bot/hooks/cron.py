@@ -34,7 +34,9 @@ class CronHook(Hook):
     def run(self) -> None:
         self.retrieve_source_and_artifacts()
 
-        commit_coverage.generate(self.repository, self.repo_dir)
+        commit_coverage.generate(
+            self.repository, self.repo_dir, cache_dir=self.cache_root, processes=True
+        )
 
         logger.info("Generating zero coverage reports")
         zc = ZeroCov(self.repo_dir)
@@ -3,14 +3,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import json
+import concurrent.futures
 import os
+import time
 import zipfile
 from datetime import timedelta
 
 import structlog
 
 from code_coverage_bot import config
+from code_coverage_bot.cache import AnnotateCache
+from code_coverage_bot import covdir
 from code_coverage_bot import taskcluster
 from code_coverage_bot import hgmo
 from code_coverage_bot import uploader
@@ -21,25 +24,70 @@ from code_coverage_bot.phabricator import PhabricatorUploader
 from code_coverage_bot.phabricator import parse_revision_id
 from code_coverage_bot.secrets import secrets
 from code_coverage_bot.taskcluster import taskcluster_config
+from code_coverage_bot.utils import ThreadPoolExecutorResult
+from code_coverage_bot.utils import available_memory
 from code_coverage_bot import gcp
 
 logger = structlog.get_logger(__name__)
 
+# Maximum number of covdir reports uploaded concurrently
+UPLOAD_WORKERS = 8
+
 
 class RepositoryHook(Hook):
     """
     Base class to support specific workflows per repository
     """
 
+    def __init__(self, *args, mapping_engine=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mapping_engine = mapping_engine
+
     def upload_reports(self, reports):
         """
         Upload all provided covdir reports on GCP
         """
-        for (platform, suite), path in reports.items():
-            report = open(path, "rb").read()
-            uploader.gcp(
-                self.branch, self.revision, report, suite=suite, platform=platform
-            )
+        start = time.monotonic()
+        bucket = gcp.get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+        manifest = uploader.get_manifest(bucket, self.branch)
+
+        def upload(platform, suite, path):
+            with open(path, "rb") as f:
+                uploader.gcp(
+                    self.branch,
+                    self.revision,
+                    f,
+                    suite=suite,
+                    platform=platform,
+                    manifest=manifest,
+                )
+            return os.path.getsize(path)
+
+        # Run no more uploads than the memory budget allows
+        workers = max(
+            1, min(UPLOAD_WORKERS, available_memory() // uploader.UPLOAD_MEMORY)
+        )
+        futures = []
+        try:
+            with ThreadPoolExecutorResult(max_workers=workers) as executor:
+                for (platform, suite), path in reports.items():
+                    futures.append(executor.submit(upload, platform, suite, path))
+        finally:
+            # Register the uploaded reports even when another upload failed,
+            # along with the ones of a previous run that were not registered
+            concurrent.futures.wait(futures)
+            manifest.reconcile([self.revision])
+            manifest.save()
+
+        size = sum(future.result() for future in futures)
+        duration = time.monotonic() - start
+        logger.info(
+            "Uploaded covdir reports",
+            nb=len(reports),
+            size=size,
+            duration=round(duration, 3),
+            throughput_mbps=round(size / 1024**2 / max(duration, 1e-6), 2),
+        )
 
     def check_javascript_files(self):
         """
@@ -79,9 +127,25 @@ class RepositoryHook(Hook):
         """
         Helper to upload coverage report on Phabricator
         """
-        phabricatorUploader = PhabricatorUploader(self.repo_dir, self.revision)
-        logger.info("Upload changeset coverage data to Phabricator")
-        return phabricatorUploader.upload(report, changesets)
+        annotate_cache = None
+        if self.cache_root is not None:
+            annotate_cache = AnnotateCache(
+                os.path.join(self.cache_root, "annotate.sqlite")
+            )
+        # The engine given on the CLI wins over the secret
+        mapping = self.mapping_engine or secrets.get(secrets.MAPPING_ENGINE, "annotate")
+        phabricatorUploader = PhabricatorUploader(
+            self.repo_dir,
+            self.revision,
+            annotate_cache=annotate_cache,
+            mapping=mapping,
+        )
+        logger.info("Upload changeset coverage data to Phabricator", mapping=mapping)
+        try:
+            return phabricatorUploader.upload(report, changesets)
+        finally:
+            if annotate_cache is not None:
+                annotate_cache.evict()
 
 
 class MozillaCentralHook(RepositoryHook):
@@ -119,16 +183,17 @@ class MozillaCentralHook(RepositoryHook):
 
         full_path = reports.get(("all", "all"))
         assert full_path is not None, "Missing full report (all:all)"
-        with open(full_path, "r") as f:
-            report_text = f.read()
+        with open(full_path, "rb") as f:
+            report_data = f.read()
 
         # Upload report as an artifact.
         taskcluster_config.upload_artifact(
             "public/code-coverage-report.json",
-            report_text,
+            report_data,
             "application/json",
             timedelta(days=14),
         )
+        del report_data
 
         # Index on Taskcluster
         self.index_task(
@@ -142,7 +207,8 @@ class MozillaCentralHook(RepositoryHook):
             ]
         )
 
-        report = json.loads(report_text)
+        # Index the report files by path, for the checks and the Phabricator upload
+        report = covdir.PathIndex.from_file(full_path)
 
         # Check extensions
         paths = uploader.covdir_paths(report)
@@ -163,9 +229,11 @@ class MozillaCentralHook(RepositoryHook):
             self.check_javascript_files()
 
         # Generate all reports except the full one which we generated earlier.
+        # grcov only parses the artifacts once per platform & suite, the other
+        # reports are merged from these.
         all_report_combinations = self.artifactsHandler.get_combinations()
         del all_report_combinations[("all", "all")]
-        reports.update(self.build_reports())
+        reports.update(self.build_reports(only=all_report_combinations, merge=True))
         logger.info("Built all covdir reports", nb=len(reports))
 
         # Upload reports on GCP
@@ -208,10 +276,10 @@ class TryHook(RepositoryHook):
         # Retrieve the full report
         full_path = reports.get(("all", "all"))
         assert full_path is not None, "Missing full report (all:all)"
-        report = json.load(open(full_path))
-
-        # Upload coverage on phabricator
-        self.upload_phabricator(report, changesets)
+        # Only parse the files touched by the changesets
+        with covdir.StreamingReport(full_path) as report:
+            # Upload coverage on phabricator
+            self.upload_phabricator(report, changesets)
 
         # Index on Taskcluster
         self.index_task(
@@ -246,6 +314,10 @@ def main():
     assert hook_class is not None, f"Unsupported repository {repository}"
 
     hook = hook_class(
-        revision, args.task_name_filter, args.cache_root, args.working_dir
+        revision,
+        args.task_name_filter,
+        args.cache_root,
+        args.working_dir,
+        mapping_engine=args.mapping_engine,
     )
     hook.run()
@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 import structlog
 
+from code_coverage_bot import taskcluster
 from code_coverage_bot.phabricator import parse_revision_id
 from code_coverage_bot.phabricator import parse_revision_url
 from code_coverage_bot.secrets import secrets
-from code_coverage_bot.taskcluster import taskcluster_config
 
 logger = structlog.get_logger(__name__)
 
@@ -13,7 +13,7 @@ def notify_email(revision, changesets, changesets_coverage):
     """
     Send an email to admins when low coverage for new commits is detected
     """
-    notify_service = taskcluster_config.get_service("notify")
+    notify_service = taskcluster.get_service("notify")
 
     content = ""
     for changeset in changesets:
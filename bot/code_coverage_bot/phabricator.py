@@ -2,12 +2,19 @@
 
 import os
 import re
+import threading
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from itertools import repeat
 from typing import Any
 from typing import Dict
+from typing import Iterable
 from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
+from typing import Union
 
 import hglib
 import structlog
@@ -15,11 +22,33 @@ from libmozdata.phabricator import BuildState
 from libmozdata.phabricator import PhabricatorAPI
 from libmozdata.phabricator import PhabricatorRevisionNotFoundException
 
+from code_coverage_bot.cache import AnnotateCache
+from code_coverage_bot.covdir import PathIndex
+from code_coverage_bot.covdir import StreamingReport
 from code_coverage_bot.secrets import secrets
 from code_coverage_bot import COVERAGE_EXTENSIONS
 
 logger = structlog.get_logger(__name__)
 
+# Annotations of multiple files, as "path\0changeset:line\n...\0"
+ANNOTATE_TEMPLATE = "{path}\\0{lines % '{node|short}:{lineno}\\n'}\\0"
+
+# Headers of the files & hunks of a diff without context
+DIFF_HEADER_REGEX = re.compile(rb"^diff(?: -r \w+)+ (.*)$")
+HUNK_REGEX = re.compile(rb"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+# Phabricator coverage characters of the lines
+LINE_COVERED = ord("C")
+LINE_NOT_COVERED = ord("U")
+LINE_NOT_COVERABLE = ord("N")
+LINE_UNKNOWN = ord("X")
+
+# Third party exclusion list, in a repository
+THIRD_PARTY_PATHS = "tools/rewriting/ThirdPartyPaths.txt"
+
+# Line mapping engines: with the annotate data of both changesets, or with their diff
+MAPPING_ENGINES = ("annotate", "diff")
+
 PHABRICATOR_REVISION_REGEX = re.compile(
     "Differential Revision: (https://phabricator.services.mozilla.com/D([0-9]+))"
 )
@@ -39,73 +68,235 @@ def parse_revision_url(desc):
     return match.group(1)
 
 
+def map_lines(
+    hunks: List[Tuple[int, int, int, int]], nb_lines: int
+) -> List[Optional[int]]:
+    """
+    Map each line of the old version of a file to its index in the new one,
+    from the hunks of their diff. Changed & removed lines are None.
+    """
+    out: List[Optional[int]] = []
+    offset = 0
+    for old_start, old_len, new_start, new_len in hunks:
+        # Lines before the hunk, a pure insertion being after old_start
+        end = old_start - 1 if old_len > 0 else old_start
+        out += [line + offset for line in range(len(out), end)]
+        out += [None] * old_len
+        offset += new_len - old_len
+    out += [line + offset for line in range(len(out), nb_lines)]
+    return out
+
+
+def coverage_bytes(coverage_record: List[int], length: int) -> bytes:
+    """
+    States of the lines of a coverage record, as Phabricator coverage characters.
+    Lines outside the record are assumed uncoverable (that happens for the last few
+    lines of a file, they are not considered by instrumentation).
+    """
+    out = bytearray(
+        LINE_NOT_COVERABLE
+        if count == -1
+        else LINE_COVERED
+        if count > 0
+        else LINE_NOT_COVERED
+        for count in coverage_record[:length]
+    )
+    out += bytes([LINE_NOT_COVERABLE]) * (length - len(out))
+    return bytes(out)
+
+
+class PrefixMatcher(object):
+    """
+    Match paths against a list of prefixes, with a set lookup for each distinct
+    prefix length instead of a startswith for each prefix
+    """
+
+    def __init__(self, prefixes: List[str]) -> None:
+        self.prefixes = prefixes
+        self.prefixes_set = frozenset(prefixes)
+        self.lengths = sorted(set(len(prefix) for prefix in prefixes))
+
+    def match(self, path: str) -> bool:
+        for length in self.lengths:
+            if length > len(path):
+                break
+            if path[:length] in self.prefixes_set:
+                return True
+        return False
+
+    def filter(self, paths: Iterable[str]) -> Iterator[str]:
+        """
+        Only keep the paths matching a prefix
+        """
+        return filter(self.match, paths)
+
+
+# Matchers of the third party exclusion lists, by path, with the list mtime
+_third_parties_cache: Dict[str, Tuple[float, PrefixMatcher]] = {}
+_third_parties_lock = threading.Lock()
+
+
+def load_third_parties(path: str) -> Optional[PrefixMatcher]:
+    """
+    Matcher of a third party exclusion list, built once and kept until the list
+    changes on disk. None when the list is missing.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+    with _third_parties_lock:
+        cached = _third_parties_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    with open(path) as f:
+        matcher = PrefixMatcher([line.rstrip() for line in f])
+    with _third_parties_lock:
+        _third_parties_cache[path] = (mtime, matcher)
+    return matcher
+
+
 class PhabricatorUploader(object):
     def __init__(
-        self, repo_dir: str, revision: str, warnings_enabled: Optional[bool] = True
+        self,
+        repo_dir: str,
+        revision: str,
+        warnings_enabled: Optional[bool] = True,
+        annotate_cache: Optional[AnnotateCache] = None,
+        mapping: str = "annotate",
     ) -> None:
         self.repo_dir = repo_dir
         self.revision = revision
         self.warnings_enabled = warnings_enabled
+        self.annotate_cache = annotate_cache
+
+        # Engine lining up the lines of the build changeset with the changesets ones
+        assert mapping in MAPPING_ENGINES, f"Unsupported mapping engine {mapping}"
+        self.mapping = mapping
+
+        # Integer ids of the changesets found in annotate data, to key their lines
+        self.changeset_ids: Dict[str, int] = {}
 
         # Read third party exclusion lists from repo
-        third_parties = os.path.join(
-            self.repo_dir, "tools/rewriting/ThirdPartyPaths.txt"
-        )
-        if os.path.exists(third_parties):
-            self.third_parties = [line.rstrip() for line in open(third_parties)]
-        else:
-            self.third_parties = []
+        third_parties = os.path.join(self.repo_dir, THIRD_PARTY_PATHS)
+        self.third_parties_matcher = load_third_parties(third_parties)
+        if self.third_parties_matcher is None:
+            self.third_parties_matcher = PrefixMatcher([])
             logger.warn("Missing third party exclusion list", path=third_parties)
+        self.third_parties = self.third_parties_matcher.prefixes
 
     def run_annotate(
         self, hg: hglib.client, rev: str, path: str
     ) -> Optional[Tuple[Tuple[str, int], ...]]:
-        args = hglib.util.cmdbuilder(
-            b"annotate",
-            os.path.join(self.repo_dir, path).encode("ascii"),
-            r=rev,
-            line_number=True,
-            changeset=True,
-        )
-        try:
-            out = hg.rawcommand(args)
-        except hglib.error.CommandError as e:
-            if b"no such file in rev" not in e.err:
-                raise
+        return self.run_annotate_batch(hg, rev, [path])[path]
 
-            # The file was removed.
-            return None
+    def run_annotate_batch(
+        self, hg: hglib.client, rev: str, paths: List[str]
+    ) -> Dict[str, Optional[Tuple[Tuple[str, int], ...]]]:
+        """
+        Annotate files at a revision with a single annotate command,
+        as (changeset, line) tuples. Files missing at that revision are None.
+        Results are looked up in the annotate cache first, when there is one.
+        """
+        if self.annotate_cache is None:
+            return self._run_annotate_batch(hg, rev, paths)
+
+        cached = self.annotate_cache.get_many(rev, paths)
+        missing = [path for path in paths if path not in cached]
+        annotations = self._run_annotate_batch(hg, rev, missing)
+        self.annotate_cache.put_many(rev, annotations)
+        return {path: cached.get(path, annotations.get(path)) for path in paths}
+
+    def _run_annotate_batch(
+        self, hg: hglib.client, rev: str, paths: List[str]
+    ) -> Dict[str, Optional[Tuple[Tuple[str, int], ...]]]:
+        out: Dict[str, Optional[Tuple[Tuple[str, int], ...]]] = {
+            path: None for path in paths
+        }
+        if not paths:
+            return out
 
-        def _collect() -> Iterator[Tuple[str, int]]:
-            for line in out.splitlines():
-                orig_changeset, orig_line, _ = line.split(b":", 2)
-                yield orig_changeset.decode("ascii"), int(orig_line)
+        # annotate aborts on missing files, so the removed ones are skipped first
+        def _missing_files(ret, out, err):
+            if ret != 1:
+                raise hglib.error.CommandError(args, ret, out, err)
+            return out
 
-        return tuple(_collect())
+        args = hglib.util.cmdbuilder(
+            b"files",
+            *[os.path.join(self.repo_dir, path).encode("utf-8") for path in paths],
+            r=rev,
+            T="{path}\\0",
+        )
+        existing = [
+            path
+            for path in hg.rawcommand(args, eh=_missing_files)
+            .decode("utf-8")
+            .split("\0")
+            if path in out
+        ]
+        if not existing:
+            return out
 
-    def _find_coverage(self, report: dict, path: str) -> Optional[List[int]]:
+        args = hglib.util.cmdbuilder(
+            b"annotate",
+            *[os.path.join(self.repo_dir, path).encode("utf-8") for path in existing],
+            r=rev,
+            T=ANNOTATE_TEMPLATE,
+        )
+        data = hg.rawcommand(args)
+
+        # Files are separated by NUL bytes, alternating paths and annotations
+        parts = data.split(b"\0")
+        for path, lines in zip(parts[0::2], parts[1::2]):
+            annotate = []
+            for line in lines.splitlines():
+                orig_changeset, orig_line = line.split(b":", 1)
+                annotate.append((orig_changeset.decode("ascii"), int(orig_line)))
+            out[path.decode("utf-8")] = tuple(annotate)
+
+        return out
+
+    def _find_coverage(
+        self, index: PathIndex, path: str, third_party: Optional[bool] = None
+    ) -> Optional[List[int]]:
         """
-        Find coverage value in a covdir report
+        Find coverage value in a covdir report index
         """
-        parts = path.split("/")
-        for part in filter(None, parts):
-            if part not in report["children"]:
-                # Only send warning for non 3rd party + supported extensions
-                if self.is_third_party(path):
-                    logger.info("Path not found in report for third party", path=path)
-                elif not self.is_supported_extension(path):
-                    logger.info(
-                        "Path not found in report for unsupported extension", path=path
-                    )
+        coverage = index.get(path)
+        if coverage is None:
+            if third_party is None:
+                third_party = self.is_third_party(path)
+
+            # Only send warning for non 3rd party + supported extensions
+            if third_party:
+                logger.info("Path not found in report for third party", path=path)
+            elif not self.is_supported_extension(path):
+                logger.info(
+                    "Path not found in report for unsupported extension", path=path
+                )
+            else:
+                if self.warnings_enabled:
+                    logger.warn("Path not found in report", path=path)
                 else:
-                    if self.warnings_enabled:
-                        logger.warn("Path not found in report", path=path)
-                    else:
-                        logger.info("Path not found in report", path=path)
-                return None
-            report = report["children"][part]
+                    logger.info("Path not found in report", path=path)
 
-        return report["coverage"]
+        return coverage
+
+    def _annotate_keys(self, annotate: Tuple[Tuple[str, int], ...]) -> array:
+        """
+        Integer keys of the lines of an annotate, from their original changeset & line
+        """
+        ids = self.changeset_ids
+        return array(
+            "q",
+            [
+                (ids.setdefault(orig_changeset, len(ids)) << 32) | orig_line
+                for orig_changeset, orig_line in annotate
+            ],
+        )
 
     def _build_coverage_map(self, annotate, coverage_record):
         # We can't use plain line numbers to map coverage data from the build changeset to the
@@ -115,47 +306,188 @@ class PhabricatorUploader(object):
         # data. The line number and changeset where a line was introduced are unique, so whenever
         # they match in the annotate data of the two changesets, we can be sure that it is the
         # same line.
-        coverage_map = {}
-
-        for lineno, (orig_changeset, orig_line) in enumerate(annotate):
-            key = (orig_changeset, orig_line)
-            # Assume lines outside the coverage record are uncoverable (that happens for the
-            # last few lines of a file, they are not considered by instrumentation).
-            coverage_map[key] = (
-                coverage_record[lineno] if lineno < len(coverage_record) else -1
+        return dict(
+            zip(
+                self._annotate_keys(annotate),
+                coverage_bytes(coverage_record, len(annotate)),
             )
-
-        return coverage_map
+        )
 
     def _apply_coverage_map(self, annotate, coverage_map):
-        phab_coverage_data = ""
-
-        for orig_changeset, orig_line in annotate:
-            key = (orig_changeset, orig_line)
-            if key in coverage_map:
-                count = coverage_map[key]
-                if count == -1:
-                    # A non-executable line.
-                    phab_coverage_data += "N"
-                elif count > 0:
-                    phab_coverage_data += "C"
-                else:
-                    phab_coverage_data += "U"
-            else:
-                # We couldn't find the original changeset-original line in the annotate data for the build changeset,
-                # this means that this line has been overwritten by another changeset.
-                phab_coverage_data += "X"
+        # Lines missing from the annotate data for the build changeset have been overwritten
+        # by another changeset.
+        return bytes(
+            map(coverage_map.get, self._annotate_keys(annotate), repeat(LINE_UNKNOWN))
+        )
 
-        return phab_coverage_data
+    def _map_changeset_annotate(
+        self,
+        hg: hglib.client,
+        changeset: dict,
+        coverage_records: Dict[str, List[int]],
+        build_annotate_by_path: Dict[str, Optional[Tuple[Tuple[str, int], ...]]],
+    ) -> Dict[str, Tuple[bytes, List[int]]]:
+        """
+        Coverage string & added lines of the files of a changeset, lining up lines
+        with the annotate data of the build changeset and of the changeset
+        """
+        annotate_by_path = self.run_annotate_batch(
+            hg, changeset["node"], list(coverage_records)
+        )
+
+        out = {}
+        for path, coverage_record in coverage_records.items():
+            # Retrieve the annotate data for the build changeset.
+            build_annotate = build_annotate_by_path.get(path)
+            if build_annotate is None:
+                # This means the file has been removed by another changeset, but if this is the
+                # case, then we shouldn't have a coverage record and so we should have *continue*d
+                # earlier.
+                assert (
+                    False
+                ), "Failure to retrieve annotate data for the build changeset"
+
+            # Build the coverage map from the annotate data and the coverage data of the build changeset.
+            coverage_map = self._build_coverage_map(build_annotate, coverage_record)
+
+            # Retrieve the annotate data for the changeset of interest.
+            annotate = annotate_by_path[path]
+            if annotate is None:
+                # This means the file has been removed by this changeset, and maybe was brought back by a following changeset.
+                continue
+
+            # List lines added by this patch
+            lines_added = [
+                lineno
+                for lineno, (annotate_changeset, _) in enumerate(annotate)
+                if annotate_changeset == changeset["node"][:12]
+            ]
+
+            # Apply the coverage map on the annotate data of the changeset of interest.
+            out[path] = (self._apply_coverage_map(annotate, coverage_map), lines_added)
+
+        return out
+
+    def _map_changeset_diff(
+        self,
+        hg: hglib.client,
+        changeset: dict,
+        coverage_records: Dict[str, List[int]],
+    ) -> Dict[str, Tuple[bytes, List[int]]]:
+        """
+        Coverage string & added lines of the files of a changeset, lining up lines
+        with the diff between the changeset and the build changeset
+        """
+        paths = list(coverage_records)
+        nb_lines_by_path = self.count_lines_batch(hg, changeset["node"], paths)
+        to_build_hunks = self.run_diff_batch(
+            hg, paths, rev=[changeset["node"], self.revision]
+        )
+        changeset_hunks = self.run_diff_batch(hg, paths, change=changeset["node"])
+
+        out = {}
+        for path, coverage_record in coverage_records.items():
+            nb_lines = nb_lines_by_path[path]
+            if nb_lines is None:
+                # This means the file has been removed by this changeset, and maybe was brought back by a following changeset.
+                continue
+
+            lines_added = [
+                lineno
+                for _, _, new_start, new_len in changeset_hunks.get(path, [])
+                for lineno in range(new_start - 1, new_start - 1 + new_len)
+            ]
+
+            # Lines changed by another changeset are unknown.
+            build_lines = map_lines(to_build_hunks.get(path, []), nb_lines)
+            build_coverage = coverage_bytes(
+                coverage_record,
+                max((line for line in build_lines if line is not None), default=-1) + 1,
+            )
+            coverage = bytes(
+                LINE_UNKNOWN if line is None else build_coverage[line]
+                for line in build_lines
+            )
+
+            out[path] = (coverage, lines_added)
+
+        return out
+
+    def run_diff_batch(
+        self, hg: hglib.client, paths: List[str], **kwargs
+    ) -> Dict[str, List[Tuple[int, int, int, int]]]:
+        """
+        Hunks of the diff of files without context, as
+        (old start, old length, new start, new length) tuples
+        """
+        out: Dict[str, List[Tuple[int, int, int, int]]] = {}
+        if not paths:
+            return out
+
+        args = hglib.util.cmdbuilder(
+            b"diff",
+            *[os.path.join(self.repo_dir, path).encode("utf-8") for path in paths],
+            unified=0,
+            **kwargs,
+        )
+        hunks = None
+        for line in hg.rawcommand(args).splitlines():
+            if line.startswith(b"diff "):
+                match = DIFF_HEADER_REGEX.match(line)
+                assert match is not None, f"Invalid diff header {line!r}"
+                hunks = out.setdefault(match.group(1).decode("utf-8"), [])
+                continue
+
+            match = HUNK_REGEX.match(line)
+            if match is None:
+                continue
+            assert hunks is not None, "Hunk outside of a file diff"
+            old_start, old_len, new_start, new_len = match.groups()
+            hunks.append(
+                (
+                    int(old_start),
+                    1 if old_len is None else int(old_len),
+                    int(new_start),
+                    1 if new_len is None else int(new_len),
+                )
+            )
+
+        return out
+
+    def count_lines_batch(
+        self, hg: hglib.client, rev: str, paths: List[str]
+    ) -> Dict[str, Optional[int]]:
+        """
+        Number of lines of files at a revision, None for the missing ones
+        """
+        out: Dict[str, Optional[int]] = {path: None for path in paths}
+        if not paths:
+            return out
+
+        def _missing_files(ret, out, err):
+            if ret != 1:
+                raise hglib.error.CommandError(args, ret, out, err)
+            return out
+
+        args = hglib.util.cmdbuilder(
+            b"cat",
+            *[os.path.join(self.repo_dir, path).encode("utf-8") for path in paths],
+            r=rev,
+            T="{path}\\0{data|splitlines|count}\\0",
+        )
+        parts = hg.rawcommand(args, eh=_missing_files).split(b"\0")
+        for path, nb_lines in zip(parts[0::2], parts[1::2]):
+            path = path.decode("utf-8")
+            if path in out:
+                out[path] = int(nb_lines)
+
+        return out
 
     def is_third_party(self, path):
         """
         Check a file against known list of third party paths
         """
-        for third_party in self.third_parties:
-            if path.startswith(third_party):
-                return True
-        return False
+        return self.third_parties_matcher.match(path)
 
     def is_supported_extension(self, path):
         """
@@ -167,7 +499,10 @@ class PhabricatorUploader(object):
         return ext[1:] in COVERAGE_EXTENSIONS
 
     def generate(
-        self, hg: hglib.client, report: dict, changesets: List[dict]
+        self,
+        hg: hglib.client,
+        report: Union[dict, PathIndex, StreamingReport],
+        changesets: List[dict],
     ) -> Dict[str, Dict[str, Any]]:
         results = {}
 
@@ -186,17 +521,35 @@ class PhabricatorUploader(object):
             set(sum((changeset["files"] for changeset in changesets), []))
         )
 
+        # Reports can be any provider of coverage by path (e.g. a PathIndex or a
+        # StreamingReport), only the touched files are retrieved from them.
+        if isinstance(report, Mapping):
+            report = PathIndex.from_report(report)
+        index = PathIndex(report.get_coverages(all_paths))
+
+        # Third party files are still mapped when the report has their coverage,
+        # the missing ones are only told apart to silence their warnings.
+        third_party_paths = set(
+            self.third_parties_matcher.filter(
+                path for path in all_paths if index.get(path) is None
+            )
+        )
         coverage_records_by_path = {
-            path: self._find_coverage(report, path) for path in all_paths
+            path: self._find_coverage(index, path, path in third_party_paths)
+            for path in all_paths
         }
 
         # Retrieve the annotate data for the build changeset.
-
-        build_annotate_by_path = {
-            path: self.run_annotate(hg, self.revision, path)
-            for path in all_paths
-            if coverage_records_by_path.get(path) is not None
-        }
+        if self.mapping == "annotate":
+            build_annotate_by_path = self.run_annotate_batch(
+                hg,
+                self.revision,
+                [
+                    path
+                    for path in all_paths
+                    if coverage_records_by_path.get(path) is not None
+                ],
+            )
 
         for changeset in changesets:
             # Retrieve the revision ID for this changeset.
@@ -207,64 +560,37 @@ class PhabricatorUploader(object):
                 "paths": {},
             }
 
-            # For each file...
-            for path in changeset["files"]:
-                # Retrieve the coverage data.
-                coverage_record = coverage_records_by_path.get(path)
-                if coverage_record is None:
-                    continue
-
-                # Retrieve the annotate data for the build changeset.
-                build_annotate = build_annotate_by_path.get(path)
-                if build_annotate is None:
-                    # This means the file has been removed by another changeset, but if this is the
-                    # case, then we shouldn't have a coverage record and so we should have *continue*d
-                    # earlier.
-                    assert (
-                        False
-                    ), "Failure to retrieve annotate data for the build changeset"
-
-                # Build the coverage map from the annotate data and the coverage data of the build changeset.
-                coverage_map = self._build_coverage_map(build_annotate, coverage_record)
-
-                # Retrieve the annotate data for the changeset of interest.
-                annotate = self.run_annotate(hg, changeset["node"], path)
-                if annotate is None:
-                    # This means the file has been removed by this changeset, and maybe was brought back by a following changeset.
-                    continue
-
-                # List lines added by this patch
-                lines_added = [
-                    lineno
-                    for lineno, (annotate_changeset, _) in enumerate(annotate)
-                    if annotate_changeset == changeset["node"][:12]
-                ]
-
-                # Apply the coverage map on the annotate data of the changeset of interest.
-                coverage = self._apply_coverage_map(annotate, coverage_map)
+            # Map the coverage of the build changeset on the changeset of interest,
+            # for all the files with coverage at once.
+            coverage_records = {
+                path: coverage_records_by_path[path]
+                for path in changeset["files"]
+                if coverage_records_by_path.get(path) is not None
+            }
+            if self.mapping == "annotate":
+                mapped = self._map_changeset_annotate(
+                    hg, changeset, coverage_records, build_annotate_by_path
+                )
+            else:
+                mapped = self._map_changeset_diff(hg, changeset, coverage_records)
 
+            for path, (coverage, lines_added) in mapped.items():
+                # Count the states of the added lines in a single pass
+                counts = Counter(
+                    coverage[line] for line in lines_added if line < len(coverage)
+                )
                 results[changeset["node"]]["paths"][path] = {
-                    "lines_added": sum(
-                        coverage[line] != "N"
-                        for line in lines_added
-                        if line < len(coverage)
-                    ),
-                    "lines_unknown": sum(
-                        coverage[line] == "X"
-                        for line in lines_added
-                        if line < len(coverage)
-                    ),
-                    "lines_covered": sum(
-                        coverage[line] == "C"
-                        for line in lines_added
-                        if line < len(coverage)
-                    ),
-                    "coverage": coverage,
+                    "lines_added": sum(counts.values()) - counts[LINE_NOT_COVERABLE],
+                    "lines_unknown": counts[LINE_UNKNOWN],
+                    "lines_covered": counts[LINE_COVERED],
+                    "coverage": coverage.decode("ascii"),
                 }
 
         return results
 
-    def upload(self, report: dict, changesets: List[dict]) -> Dict[str, Dict[str, Any]]:
+    def upload(
+        self, report: Union[dict, PathIndex, StreamingReport], changesets: List[dict]
+    ) -> Dict[str, Dict[str, Any]]:
         with hglib.open(self.repo_dir) as hg:
             results = self.generate(hg, report, changesets)
 
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import functools
 import os
 
 import structlog
@@ -6,6 +7,7 @@ import taskcluster
 from taskcluster.helper import TaskclusterConfig
 
 from code_coverage_bot.utils import download_file
+from code_coverage_bot.utils import get_session
 
 logger = structlog.getLogger(__name__)
 taskcluster_config = TaskclusterConfig("https://firefox-ci-tc.services.mozilla.com")
@@ -15,9 +17,30 @@ ALL_STATUSES = FINISHED_STATUSES + ["unscheduled", "pending", "running"]
 NAME_PARTS_TO_SKIP = ("opt", "debug", "e10s", "1proc")
 
 
+def get_service(service_name):
+    """
+    Build a Taskcluster service client using the shared HTTP session
+    """
+    if taskcluster_config.options is None:
+        taskcluster_config.auth()
+
+    service = getattr(taskcluster, service_name.capitalize())
+    return service(taskcluster_config.options, session=get_session())
+
+
+@functools.lru_cache(maxsize=None)
+def get_public_queue():
+    # Use un-authenticated Taskcluster client to avoid taskcluster-proxy rewrite issue
+    # https://github.com/taskcluster/taskcluster-proxy/issues/44
+    return taskcluster.Queue(
+        {"rootUrl": "https://firefox-ci-tc.services.mozilla.com"},
+        session=get_session(),
+    )
+
+
 def get_decision_task(branch, revision):
     route = f"gecko.v2.{branch}.revision.{revision}.taskgraph.decision"
-    index = taskcluster_config.get_service("index")
+    index = get_service("index")
     try:
         return index.findTask(route)["taskId"]
     except taskcluster.exceptions.TaskclusterRestFailure as e:
@@ -27,22 +50,22 @@ def get_decision_task(branch, revision):
 
 
 def get_task_details(task_id):
-    queue = taskcluster_config.get_service("queue")
+    queue = get_service("queue")
     return queue.task(task_id)
 
 
 def get_task_status(task_id):
-    queue = taskcluster_config.get_service("queue")
+    queue = get_service("queue")
     return queue.status(task_id)
 
 
 def get_task_artifacts(task_id):
-    queue = taskcluster_config.get_service("queue")
+    queue = get_service("queue")
     return queue.listLatestArtifacts(task_id)["artifacts"]
 
 
 def get_tasks_in_group(group_id):
-    queue = taskcluster_config.get_service("queue")
+    queue = get_service("queue")
 
     token = None
     while True:
@@ -64,10 +87,7 @@ def download_artifact(artifact_path: str, task_id: str, artifact_name: str) -> N
         return
 
     # Build artifact public url
-    # Use un-authenticated Taskcluster client to avoid taskcluster-proxy rewrite issue
-    # https://github.com/taskcluster/taskcluster-proxy/issues/44
-    queue = taskcluster.Queue({"rootUrl": "https://firefox-ci-tc.services.mozilla.com"})
-    url = queue.buildUrl("getLatestArtifact", task_id, artifact_name)
+    url = get_public_queue().buildUrl("getLatestArtifact", task_id, artifact_name)
     logger.debug("Downloading artifact", url=url)
 
     download_file(url, artifact_path)
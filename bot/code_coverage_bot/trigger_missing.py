@@ -8,7 +8,6 @@ import os
 from datetime import datetime
 from datetime import timedelta
 
-import requests
 import structlog
 import zstandard
 from taskcluster.utils import slugId
@@ -19,7 +18,6 @@ from code_coverage_bot import taskcluster
 from code_coverage_bot import uploader
 from code_coverage_bot import utils
 from code_coverage_bot.secrets import secrets
-from code_coverage_bot.taskcluster import taskcluster_config
 from code_coverage_bot.gcp import get_bucket
 
 logger = structlog.get_logger(__name__)
@@ -32,7 +30,7 @@ def trigger_task(task_group_id: str, revision: str) -> None:
     """
     Trigger a code coverage task to build covdir at a specified revision
     """
-    hooks = taskcluster_config.get_service("hooks")
+    hooks = taskcluster.get_service("hooks")
     hooks.triggerHook(
         "project-relman",
         f"code-coverage-repo-{secrets[secrets.APP_CHANNEL]}",
@@ -49,7 +47,7 @@ def trigger_missing(server_address: str, out_dir: str = ".") -> None:
     triggered_revisions_path = os.path.join(out_dir, "triggered_revisions.zst")
 
     url = f"https://firefox-ci-tc.services.mozilla.com/api/index/v1/task/project.relman.code-coverage.{secrets[secrets.APP_CHANNEL]}.crontrigger.latest/artifacts/public/triggered_revisions.zst"
-    r = requests.head(url, allow_redirects=True)
+    r = utils.get_session().head(url, allow_redirects=True)
     if r.status_code != 404:
         utils.download_file(url, triggered_revisions_path)
 
@@ -81,6 +79,7 @@ def trigger_missing(server_address: str, out_dir: str = ".") -> None:
         secrets[secrets.GOOGLE_CLOUD_STORAGE] is not None
     ), "Missing GOOGLE_CLOUD_STORAGE secret"
     bucket = get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+    manifest = uploader.get_manifest(bucket, "mozilla-central")
 
     missing_revisions = []
     for revision, timestamp in revisions:
@@ -90,9 +89,7 @@ def trigger_missing(server_address: str, out_dir: str = ".") -> None:
             continue
 
         # If the revision was already ingested, we don't need to trigger ingestion for it again.
-        if uploader.gcp_covdir_exists(
-            bucket, "mozilla-central", revision, "all", "all"
-        ):
+        if manifest.exists(revision, "all", "all"):
             triggered_revisions.add(revision)
             continue
 
@@ -105,7 +102,15 @@ def trigger_missing(server_address: str, out_dir: str = ".") -> None:
     task_group_id = slugId()
     logger.info(f"Triggering tasks in the {task_group_id} group")
     triggered = 0
+    reconciled = False
     for revision, timestamp in reversed(missing_revisions):
+        # The report may have been uploaded without being registered
+        if manifest.reconcile([revision]):
+            reconciled = True
+            if manifest.exists(revision, "all", "all"):
+                triggered_revisions.add(revision)
+                continue
+
         # If it's older than yesterday, we assume the group finished.
         # If it is newer than yesterday, we load the group and check if all tasks in it finished.
         if timestamp > yesterday:
@@ -129,6 +134,9 @@ def trigger_missing(server_address: str, out_dir: str = ".") -> None:
         if triggered == MAXIMUM_TRIGGERS:
             break
 
+    if reconciled:
+        manifest.save()
+
     cctx = zstandard.ZstdCompressor(threads=-1)
     with open(triggered_revisions_path, "wb") as zf:
         with cctx.stream_writer(zf) as compressor:
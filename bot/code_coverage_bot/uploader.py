@@ -1,48 +1,306 @@
 # -*- coding: utf-8 -*-
-import itertools
-import os.path
+import io
+import json
+import os
+import re
+import tempfile
+import time
+from collections.abc import Mapping
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
 
 import structlog
 import zstandard as zstd
+from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import PreconditionFailed
 from google.cloud.storage.bucket import Bucket
 
+from code_coverage_bot import covbin
+from code_coverage_bot import covdir
 from code_coverage_bot.secrets import secrets
 from code_coverage_bot.gcp import get_bucket
 from code_coverage_bot import hgmo
 
 logger = structlog.get_logger(__name__)
 GCP_COVDIR_PATH = "{repository}/{revision}/{platform}:{suite}.json.zstd"
+GCP_COVBIN_PATH = "{repository}/{revision}/{platform}:{suite}.covbin"
+GCP_MANIFEST_PATH = "manifests/{repository}.json.zstd"
 
+# Size of the chunks of resumable uploads, must be a multiple of 256KiB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
 
-def gcp(repository, revision, report, platform, suite):
+# Peak memory used by a report upload, in bytes: the chunks in flight, the zstd
+# buffers and the binary version path table
+UPLOAD_MEMORY = 256 * 1024 * 1024
+
+
+def _log_upload(blob, size, start):
+    duration = time.monotonic() - start
+    logger.info(
+        "Uploaded {}".format(blob.name),
+        size=size,
+        duration=round(duration, 3),
+        throughput_mbps=round(size / 1024**2 / max(duration, 1e-6), 2),
+    )
+
+
+def _upload_file(blob, f, content_type):
+    """
+    Upload a file object in chunks, through a resumable upload
+    """
+    start = time.monotonic()
+    blob.chunk_size = UPLOAD_CHUNK_SIZE
+    blob.upload_from_file(f, content_type=content_type)
+    _log_upload(blob, f.tell(), start)
+
+
+class _TeeReader(object):
+    """
+    File object reader, passing the chunks it reads to a callback
+    """
+
+    def __init__(self, f, on_chunk):
+        self.f = f
+        self.on_chunk = on_chunk
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if data:
+            self.on_chunk(data)
+        return data
+
+
+def _upload_compressed(blob, f, content_type, on_chunk=None):
+    """
+    Compress a file object with zstandard while uploading it in chunks,
+    through a resumable upload. The chunks read from the file are also
+    passed to on_chunk, when given.
+    """
+    start = time.monotonic()
+    blob.chunk_size = UPLOAD_CHUNK_SIZE
+    blob.content_encoding = "zstd"
+    # Store the report size in the zstd frame, when it is known
+    try:
+        size = os.fstat(f.fileno()).st_size - f.tell()
+    except (OSError, io.UnsupportedOperation):
+        size = f.getbuffer().nbytes - f.tell() if hasattr(f, "getbuffer") else -1
+    if on_chunk is not None:
+        f = _TeeReader(f, on_chunk)
+
+    compressor = zstd.ZstdCompressor(threads=-1)
+    with compressor.stream_reader(
+        f, size=size, read_size=UPLOAD_CHUNK_SIZE, closefd=False
+    ) as reader:
+        blob.upload_from_file(reader, content_type=content_type)
+        size = reader.tell()
+    _log_upload(blob, size, start)
+
+
+class ReportsManifest(object):
+    """
+    Set of the (revision, platform, suite) reports uploaded for a repository,
+    stored as a single blob on the bucket, so existence checks do not need
+    a request per report.
+    """
+
+    def __init__(self, bucket: Bucket, repository: str) -> None:
+        self.bucket = bucket
+        self.repository = repository
+        self.path = GCP_MANIFEST_PATH.format(repository=repository)
+        self.reports: Dict[str, Set[Tuple[str, str]]] = {}
+        self.generation: Optional[int] = None
+        self.pending: Set[Tuple[str, str, str]] = set()
+
+    def exists(self, revision: str, platform: str = "all", suite: str = "all") -> bool:
+        return (platform, suite) in self.reports.get(revision, ())
+
+    def add(self, revision: str, platform: str, suite: str) -> None:
+        """
+        Register an uploaded report, stored on the next save
+        """
+        self.reports.setdefault(revision, set()).add((platform, suite))
+        self.pending.add((revision, platform, suite))
+
+    def _merge(self, entries) -> None:
+        for revision, platform, suite in entries:
+            self.reports.setdefault(revision, set()).add((platform, suite))
+
+    def load(self) -> bool:
+        """
+        Download the manifest, only when it changed since the last load.
+        Returns False when there is no manifest on the bucket.
+        """
+        blob = self.bucket.get_blob(self.path)
+        if blob is None:
+            return False
+        if blob.generation is not None and blob.generation == self.generation:
+            return True
+
+        try:
+            data = blob.download_as_bytes(
+                raw_download=True, if_generation_match=blob.generation
+            )
+        except (NotFound, PreconditionFailed):
+            # Replaced in the meantime, load the new version
+            return self.load()
+
+        self.reports = {
+            revision: set(tuple(report.split(":", 1)) for report in reports)
+            for revision, reports in json.loads(
+                zstd.ZstdDecompressor().decompress(data)
+            ).items()
+        }
+        self._merge(self.pending)
+        self.generation = blob.generation
+        logger.info("Loaded reports manifest", path=self.path, nb=len(self.reports))
+        return True
+
+    def _list(self, revision: Optional[str] = None) -> Iterator[Tuple[str, str, str]]:
+        """
+        List the (revision, platform, suite) reports of a revision on the bucket,
+        or of all the revisions
+        """
+        prefix = f"{self.repository}/{revision}/" if revision else f"{self.repository}/"
+        regex = re.compile(
+            r"^{}/(\w+)/([\w\-]+):([\w\-]+).json.zstd$".format(
+                re.escape(self.repository)
+            )
+        )
+        blobs = self.bucket.list_blobs(
+            prefix=prefix,
+            match_glob=f"{self.repository}/{revision or '*'}/*.json.zstd",
+            fields="items(name),nextPageToken",
+        )
+        for blob in blobs:
+            match = regex.match(blob.name)
+            if match is not None:
+                yield match.groups()
+
+    def rebuild(self) -> None:
+        """
+        Build the manifest from a single listing of the repository reports
+        """
+        self.reports = {}
+        self._merge(self._list())
+        self._merge(self.pending)
+        logger.info("Rebuilt reports manifest", path=self.path, nb=len(self.reports))
+
+    def reconcile(self, revisions: List[str]) -> bool:
+        """
+        Register the reports of some revisions found on the bucket, with a listing
+        for each of them, e.g. after uploads that failed before being registered.
+        Returns whether reports were missing, they are stored on the next save.
+        """
+        missing = [
+            report
+            for revision in revisions
+            for report in self._list(revision)
+            if not self.exists(*report)
+        ]
+        for report in missing:
+            self.add(*report)
+        if missing:
+            logger.info("Reconciled reports manifest", path=self.path, nb=len(missing))
+        return len(missing) > 0
+
+    def refresh(self) -> None:
+        """
+        Update the manifest from the bucket, building it when it is missing
+        """
+        if not self.load():
+            self.rebuild()
+            self.pending = set(
+                (revision, platform, suite)
+                for revision, reports in self.reports.items()
+                for platform, suite in reports
+            )
+            self.save()
+
+    def save(self) -> None:
+        """
+        Store the manifest, merging the pending reports in the latest version
+        on the bucket when another upload replaced it
+        """
+        while True:
+            data = json.dumps(
+                {
+                    revision: sorted(
+                        f"{platform}:{suite}" for platform, suite in reports
+                    )
+                    for revision, reports in self.reports.items()
+                },
+                sort_keys=True,
+            ).encode("utf-8")
+            blob = self.bucket.blob(self.path)
+            blob.content_encoding = "zstd"
+            try:
+                blob.upload_from_string(
+                    zstd.ZstdCompressor().compress(data),
+                    content_type="application/json",
+                    if_generation_match=self.generation or 0,
+                )
+            except PreconditionFailed:
+                logger.info("Reports manifest changed, merging", path=self.path)
+                if not self.load():
+                    self.generation = None
+                continue
+
+            self.generation = blob.generation
+            self.pending = set()
+            return
+
+
+def get_manifest(bucket: Bucket, repository: str) -> ReportsManifest:
+    """
+    Load the up to date manifest of a repository's reports
+    """
+    manifest = ReportsManifest(bucket, repository)
+    manifest.refresh()
+    return manifest
+
+
+def gcp(repository, revision, report, platform, suite, manifest=None):
     """
     Upload a grcov raw report on Google Cloud Storage
-    * Compress with zstandard
-    * Upload on bucket using revision in name
+    * Compress with zstandard, while streaming the report
+    * Build its binary version from the same chunks, in a temporary file
+    * Upload on bucket using revision in name, along with its binary version
     * Trigger ingestion on channel's backend
+    The report is either bytes or a binary file object.
+    It is registered in the manifest when given, which must be saved afterwards.
     """
-    assert isinstance(report, bytes)
+    if isinstance(report, bytes):
+        report = io.BytesIO(report)
+    assert report.tell() == 0, "The report must be read from its start"
     assert isinstance(platform, str)
     assert isinstance(suite, str)
     bucket = get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
 
-    # Compress report
-    compressor = zstd.ZstdCompressor(threads=-1)
-    archive = compressor.compress(report)
-
-    # Upload archive
+    # Upload archive, with its headers set in the same request
     path = GCP_COVDIR_PATH.format(
         repository=repository, revision=revision, platform=platform, suite=suite
     )
     blob = bucket.blob(path)
-    blob.upload_from_string(archive)
+    with tempfile.TemporaryFile() as binary:
+        writer = covbin.Writer(binary)
+        parser = covdir.ReportParser(writer.add)
+        _upload_compressed(blob, report, "application/json", on_chunk=parser.feed)
+        parser.close()
+        writer.finish()
 
-    # Update headers
-    blob.content_type = "application/json"
-    blob.content_encoding = "zstd"
-    blob.patch()
+        # Upload the binary version, giving random access to each file's coverage
+        binary_path = GCP_COVBIN_PATH.format(
+            repository=repository, revision=revision, platform=platform, suite=suite
+        )
+        binary.seek(0)
+        _upload_file(bucket.blob(binary_path), binary, "application/octet-stream")
 
-    logger.info("Uploaded {} on {}".format(path, bucket))
+    if manifest is not None:
+        manifest.add(revision, platform, suite)
 
     return blob
 
@@ -51,7 +309,8 @@ def gcp_covdir_exists(
     bucket: Bucket, repository: str, revision: str, platform: str, suite: str
 ) -> bool:
     """
-    Check if a covdir report exists on the Google Cloud Storage bucket
+    Check if a covdir report exists on the Google Cloud Storage bucket.
+    Use a ReportsManifest to check many reports.
     """
     path = GCP_COVDIR_PATH.format(
         repository=repository, revision=revision, platform=platform, suite=suite
@@ -68,13 +327,14 @@ def gcp_latest(repo_url):
         secrets[secrets.GOOGLE_CLOUD_STORAGE] is not None
     ), "Missing GOOGLE_CLOUD_STORAGE secret"
     bucket = get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+    manifest = get_manifest(bucket, "mozilla-central")
 
     for push_id, push_data in hgmo.iter_pushes(server_address=repo_url):
         changesets: list[str] = push_data.get("changesets", [])
         if not changesets:
             continue
 
-        if gcp_covdir_exists(bucket, "mozilla-central", changesets[-1], "all", "all"):
+        if manifest.exists(changesets[-1], "all", "all"):
             return changesets[-1]
 
     return None
@@ -84,24 +344,8 @@ def covdir_paths(report):
     """
     Load a covdir report and recursively list all the paths
     """
-    assert isinstance(report, dict)
-
-    def _extract(obj, base_path=""):
-        out = []
-        children = obj.get("children", {})
-        if children:
-            # Recursive on folder files
-            out += itertools.chain(
-                *[
-                    _extract(child, os.path.join(base_path, obj["name"]))
-                    for child in children.values()
-                ]
-            )
-
-        else:
-            # Add full filename
-            out.append(os.path.join(base_path, obj["name"]))
-
-        return out
+    if isinstance(report, covdir.PathIndex):
+        return report.paths()
 
-    return _extract(report)
+    assert isinstance(report, Mapping)
+    return covdir.PathIndex.from_report(report).paths()
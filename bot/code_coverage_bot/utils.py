@@ -2,10 +2,15 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import collections
 import concurrent.futures
+import os
+import struct
 import subprocess
+import threading
+import zipfile
+import zlib
 from zipfile import BadZipFile
-from zipfile import is_zipfile
 
 import requests
 import structlog
@@ -13,6 +18,12 @@ import tenacity
 
 log = structlog.get_logger(__name__)
 
+# Number of parallel downloads, also used to size the HTTP connection pool
+DOWNLOAD_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+_session = None
+_session_lock = threading.Lock()
+
 
 def hide_secrets(text, secrets):
     if type(text) is bytes:
@@ -29,6 +40,21 @@ def hide_secrets(text, secrets):
     return text
 
 
+def available_memory():
+    """
+    Memory available for new processes, in bytes
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
 def run_check(command, **kwargs):
     """
     Run a command through subprocess and check for output
@@ -70,42 +96,451 @@ def run_check(command, **kwargs):
     return output
 
 
-class ThreadPoolExecutorResult(concurrent.futures.ThreadPoolExecutor):
+def run_to_file(command, output_path, error_lines=50, **kwargs):
+    """
+    Run a command through subprocess, writing its output straight to a file.
+    Only the last lines of its error output are kept, for error reporting.
+    Returns the peak memory usage (RSS) of the command, in bytes.
+    """
+    assert isinstance(command, list)
+
+    if len(command) == 0:
+        raise Exception("Can't run an empty command.")
+
+    log.info("Running command", command=" ".join(command), output=output_path)
+
+    error = collections.deque(maxlen=error_lines)
+    with open(output_path, "wb") as output:
+        proc = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,  # no interactions
+            stdout=output,
+            stderr=subprocess.PIPE,
+            **kwargs,
+        )
+        with proc.stderr:
+            for line in proc.stderr:
+                error.append(line)
+
+        # Wait on the process ourselves to retrieve its resources usage
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+    if proc.returncode != 0:
+        error = b"".join(error).decode("utf-8", errors="replace")
+
+        # Use error to send log to sentry
+        log.error(
+            f"Command failed with code: {proc.returncode}",
+            exit=proc.returncode,
+            command=" ".join(command),
+            error=error.rstrip("\n").split("\n")[-1],
+        )
+        print(f"Error:\n{error}")
+
+        raise Exception(f"`{command[0]}` failed with code: {proc.returncode}.")
+
+    # ru_maxrss is expressed in kilobytes on Linux
+    return rusage.ru_maxrss * 1024
+
+
+class ExecutorResult(object):
+    """
+    Executor mixin, raising the first exception of its tasks when exiting
+    """
+
     def __init__(self, *args, **kwargs):
         self.futures = []
-        super(ThreadPoolExecutorResult, self).__init__(*args, **kwargs)
+        super().__init__(*args, **kwargs)
 
     def submit(self, *args, **kwargs):
-        future = super(ThreadPoolExecutorResult, self).submit(*args, **kwargs)
+        future = super().submit(*args, **kwargs)
         self.futures.append(future)
         return future
 
     def __exit__(self, *args):
         try:
             for future in concurrent.futures.as_completed(self.futures):
+                if future.cancelled():
+                    continue
                 future.result()
         except Exception as e:
             for future in self.futures:
                 future.cancel()
             raise e
-        return super(ThreadPoolExecutorResult, self).__exit__(*args)
+        return super().__exit__(*args)
+
+
+class ThreadPoolExecutorResult(ExecutorResult, concurrent.futures.ThreadPoolExecutor):
+    pass
+
+
+class ProcessPoolExecutorResult(ExecutorResult, concurrent.futures.ProcessPoolExecutor):
+    pass
+
+
+class TruncatedDownload(Exception):
+    """
+    The download stopped before the end of the file, it can be resumed
+    """
+
+
+class ZipStreamValidator(object):
+    """
+    Validate a zip archive incrementally, while it is being downloaded:
+    the CRC of each entry is checked as its data comes in, and the central
+    directory must list as many entries as the archive contains.
+    """
+
+    LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+    CENTRAL_HEADER = struct.Struct("<4s6H3I5H2I")
+    END_RECORD = struct.Struct("<4s4H2IH")
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.state = self._read_signature
+        self.entries = 0
+        self.central_entries = 0
+        self.done = False
+
+        # Set when the archive can't be checked incrementally (e.g. unsupported
+        # compression method), the whole file must then be checked at the end.
+        self.unverified = False
+
+        # Current entry
+        self.name = None
+        self.remaining = None
+        self.crc = 0
+        self.expected_crc = None
+        self.decompressor = None
+
+    def feed(self, data):
+        if self.done or self.unverified:
+            return
+
+        self.buffer += data
+        while self.state():
+            if self.done or self.unverified:
+                self.buffer.clear()
+                break
+
+    def finish(self):
+        if not self.done and not self.unverified:
+            raise TruncatedDownload("Truncated zip file")
+
+    def _consume(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def _read_signature(self):
+        if len(self.buffer) < 4:
+            return False
+
+        signature = bytes(self.buffer[:4])
+        if signature == b"PK\x03\x04" and self.central_entries == 0:
+            self.state = self._read_local_header
+        elif signature == b"PK\x01\x02":
+            self.state = self._read_central_header
+        elif signature == b"PK\x05\x06":
+            self.state = self._read_end_record
+        elif signature in (b"PK\x06\x06", b"PK\x06\x07"):
+            # Zip64 records, let the zipfile module check those at the end.
+            self.unverified = True
+        else:
+            raise BadZipFile("File is not a zip file")
+        return True
+
+    def _read_local_header(self):
+        if len(self.buffer) < self.LOCAL_HEADER.size:
+            return False
+        (
+            _,
+            _,
+            flags,
+            method,
+            _,
+            _,
+            crc,
+            compressed_size,
+            _,
+            name_length,
+            extra_length,
+        ) = self.LOCAL_HEADER.unpack_from(self.buffer)
+        header_size = self.LOCAL_HEADER.size + name_length + extra_length
+        if len(self.buffer) < header_size:
+            return False
+
+        header = self._consume(header_size)
+        self.name = header[self.LOCAL_HEADER.size :][:name_length].decode(
+            "utf-8", "replace"
+        )
+        self.entries += 1
+        self.crc = 0
+
+        if flags & 0x08:
+            # Sizes and CRC are stored after the data, only deflated data
+            # can be delimited without them.
+            self.remaining = None
+            self.expected_crc = None
+            if method != zipfile.ZIP_DEFLATED:
+                self.unverified = True
+        else:
+            self.remaining = compressed_size
+            self.expected_crc = crc
+
+        if method == zipfile.ZIP_DEFLATED:
+            self.decompressor = zlib.decompressobj(-15)
+        elif method == zipfile.ZIP_STORED:
+            self.decompressor = None
+        else:
+            self.unverified = True
+
+        self.state = self._read_data
+        return True
+
+    def _read_data(self):
+        if self.remaining is not None:
+            data = self._consume(self.remaining)
+            self.remaining -= len(data)
+            self._update_crc(data)
+            if self.remaining > 0:
+                return False
+            if self.decompressor is not None:
+                self.crc = zlib.crc32(self.decompressor.flush(), self.crc)
+            self._check_crc()
+            self.state = self._read_signature
+            return True
+
+        data = self._consume(len(self.buffer))
+        self._update_crc(data)
+        if not self.decompressor.eof:
+            return False
+
+        # The deflate stream ended, the rest belongs to the data descriptor.
+        self.buffer[:0] = self.decompressor.unused_data
+        self.state = self._read_data_descriptor
+        return True
+
+    def _read_data_descriptor(self):
+        size = 16 if self.buffer[:4] == b"PK\x07\x08" else 12
+        if len(self.buffer) < size:
+            return False
+        descriptor = self._consume(size)
+        (self.expected_crc,) = struct.unpack_from("<I", descriptor, size - 12)
+        self._check_crc()
+        self.state = self._read_signature
+        return True
+
+    def _update_crc(self, data):
+        if self.decompressor is not None:
+            try:
+                data = self.decompressor.decompress(data)
+            except zlib.error as e:
+                raise BadZipFile(f"Bad compressed data for file {self.name}: {e}")
+        self.crc = zlib.crc32(data, self.crc)
+
+    def _check_crc(self):
+        if self.crc != self.expected_crc:
+            raise BadZipFile(f"Bad CRC-32 for file {self.name}")
+
+    def _read_central_header(self):
+        if len(self.buffer) < self.CENTRAL_HEADER.size:
+            return False
+        fields = self.CENTRAL_HEADER.unpack_from(self.buffer)
+        name_length, extra_length, comment_length = fields[10:13]
+        header_size = (
+            self.CENTRAL_HEADER.size + name_length + extra_length + comment_length
+        )
+        if len(self.buffer) < header_size:
+            return False
+        self._consume(header_size)
+        self.central_entries += 1
+        self.state = self._read_signature
+        return True
+
+    def _read_end_record(self):
+        if len(self.buffer) < self.END_RECORD.size:
+            return False
+        fields = self.END_RECORD.unpack_from(self.buffer)
+        total_entries = fields[4]
+        if total_entries != self.central_entries or total_entries != self.entries:
+            raise BadZipFile(
+                f"Central directory lists {total_entries} entries, {self.entries} found"
+            )
+        self.done = True
+        return False
+
+
+def download_wait(retry_state: tenacity.RetryCallState) -> float:
+    """
+    Pick a backoff delay according to the error that made the download fail
+    """
+    exc = retry_state.outcome.exception()
+    attempt = retry_state.attempt_number
+
+    if isinstance(
+        exc,
+        (
+            TruncatedDownload,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.ConnectionError,
+        ),
+    ):
+        # The download will be resumed where it stopped, no need to wait long.
+        return min(2 ** (attempt - 1), 8)
+
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        retry_after = exc.response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            return min(int(retry_after), 60)
+        if exc.response.status_code >= 500 or exc.response.status_code == 429:
+            return min(4 * 2 ** (attempt - 1), 32)
+
+    return min(2 * 2 ** (attempt - 1), 16)
+
+
+class PooledHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTP adapter counting requests and new connections,
+    to check connections are actually reused
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.counters_lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        adapter = self
+
+        def counting_pool(pool_class):
+            class CountingConnectionPool(pool_class):
+                def _new_conn(self):
+                    with adapter.counters_lock:
+                        adapter.connections += 1
+                    return super()._new_conn()
+
+            return CountingConnectionPool
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting_pool(pool_class)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def send(self, *args, **kwargs):
+        with self.counters_lock:
+            self.requests += 1
+        return super().send(*args, **kwargs)
+
+
+def get_session() -> requests.Session:
+    """
+    Shared HTTP session, with a connection pool sized for parallel downloads
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = PooledHTTPAdapter(
+                pool_connections=4, pool_maxsize=DOWNLOAD_WORKERS
+            )
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session.headers["User-Agent"] = "code-coverage-bot"
+
+    return _session
+
+
+def session_stats() -> dict:
+    """
+    Count requests made through the shared session, and how many of them
+    reused an existing connection
+    """
+    adapter = get_session().get_adapter("https://")
+    with adapter.counters_lock:
+        return {
+            "requests": adapter.requests,
+            "connections": adapter.connections,
+            "reused": adapter.requests - adapter.connections,
+        }
 
 
 def download_file(url: str, path: str) -> None:
+    """
+    Download a file, resuming from the bytes already downloaded when the
+    transfer fails midway.
+    Zip archives are validated while they are being downloaded.
+    """
+    part_path = f"{path}.part"
+    validator = None
+
+    def restart():
+        nonlocal validator
+        if os.path.exists(part_path):
+            os.unlink(part_path)
+        validator = ZipStreamValidator() if path.endswith(".zip") else None
+
+    def request(offset):
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+        return get_session().get(url, stream=True, headers=headers)
+
     @tenacity.retry(
         reraise=True,
-        wait=tenacity.wait_exponential(multiplier=1, min=16, max=64),
+        wait=download_wait,
         stop=tenacity.stop_after_attempt(5),
     )
     def perform_download() -> None:
-        r = requests.get(url, stream=True)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        r = request(offset)
+
+        if r.status_code == 416:
+            # The partial file can't be resumed, start over.
+            restart()
+            offset = 0
+            r = request(offset)
+
         r.raise_for_status()
 
-        with open(path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1048576):
+        if offset > 0 and not (
+            r.status_code == 206
+            and r.headers.get("Content-Range", "").startswith(f"bytes {offset}-")
+        ):
+            log.info("Server does not support resuming the download", url=url)
+            restart()
+            offset = 0
+
+        length = r.headers.get("Content-Length")
+        written = 0
+        with open(part_path, "ab" if offset > 0 else "wb") as f:
+            # Use small chunks, as a chunk being read is lost when the connection breaks.
+            for chunk in r.iter_content(chunk_size=65536):
                 f.write(chunk)
+                written += len(chunk)
+                if validator is not None:
+                    try:
+                        validator.feed(chunk)
+                    except BadZipFile:
+                        restart()
+                        raise
 
-        if path.endswith(".zip") and not is_zipfile(path):
-            raise BadZipFile("File is not a zip file")
+        if length is not None and written < int(length):
+            raise TruncatedDownload(f"Downloaded {written} bytes out of {length}")
+
+        if validator is not None:
+            validator.finish()
+            if validator.unverified:
+                with zipfile.ZipFile(part_path) as z:
+                    bad_file = z.testzip()
+                if bad_file is not None:
+                    restart()
+                    raise BadZipFile(f"Bad CRC-32 for file {bad_file}")
+
+        os.replace(part_path, path)
 
+    restart()
     perform_download()
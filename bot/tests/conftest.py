@@ -424,4 +424,7 @@ def mock_tenacity(monkeypatch):
     """
     Mock Tenacity wait function to avoid spening time in unit tests
     """
+    from code_coverage_bot import utils
+
     monkeypatch.setattr(tenacity, "wait_fixed", lambda x: None)
+    monkeypatch.setattr(utils, "download_wait", lambda retry_state: 0)
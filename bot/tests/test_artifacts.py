@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import hashlib
+import json
 import itertools
 import os
+import threading
 from unittest import mock
 
 import pytest
 import responses
 
+from code_coverage_bot import covdir
+from code_coverage_bot import grcov
 from code_coverage_bot.artifacts import Artifact
 from code_coverage_bot.artifacts import ArtifactsHandler
 from code_coverage_bot.hooks.base import Hook
@@ -65,6 +69,13 @@ def test_get_chunks(fake_artifacts):
         "xpcshell-7",
         "firefox-ui-functional-remote",
     }
+    assert a.get_chunks("android") == set()
+
+    # The index follows the artifacts added or discarded later on
+    a.add_artifact(Artifact("path", "task", "android", "mochitest", "mochitest-3"))
+    assert a.get_chunks("android") == {"mochitest-3"}
+    a.discard("task")
+    assert a.get_chunks("android") == set()
 
 
 def test_get_combinations(tmpdir, fake_artifacts):
@@ -174,6 +185,30 @@ def test_get_coverage_artifacts(tmpdir, fake_artifacts):
         a.get(chunk="xpcshell-7", suite="mochitest")
 
 
+def test_add_artifact(fake_artifacts):
+    a = ArtifactsHandler([])
+    b = ArtifactsHandler([])
+    b.artifacts = fake_artifacts
+    for artifact in fake_artifacts:
+        a.add_artifact(artifact)
+
+    # Artifacts added one by one are indexed like the ones set at once.
+    assert a.artifacts == fake_artifacts
+    assert dict(a.get_combinations()) == dict(b.get_combinations())
+    assert a.get_chunks("linux") == b.get_chunks("linux")
+    for platform, chunk in itertools.product(
+        ["linux", "windows", "mac"], ["xpcshell-7", "cppunit", "nope"]
+    ):
+        assert a.get(platform=platform, chunk=chunk) == b.get(
+            platform=platform, chunk=chunk
+        )
+    assert a.get(platform="mac") == []
+    assert a.get(suite="xpcshell", platform="linux") == [
+        fake_artifacts[3].path,
+        fake_artifacts[4].path,
+    ]
+
+
 @mock.patch("code_coverage_bot.taskcluster.get_task_artifacts")
 @mock.patch("code_coverage_bot.taskcluster.download_artifact")
 def test_download(
@@ -316,3 +351,192 @@ def test_download_all(
                 "test-linux64-ccov/opt-cppunit-completed",
             ]
         )
+
+
+def test_download_all_pending(monkeypatch, tmpdir):
+    def build_task(task_id, chunk, state):
+        return {
+            "status": {"taskId": task_id, "taskGroupId": "group", "state": state},
+            "task": {
+                "metadata": {"name": f"test-linux64-ccov/opt-xpcshell-{chunk}"},
+                "env": {},
+                "extra": {"suite": "xpcshell", "chunks": {"current": chunk}},
+                "tags": {"os": "linux"},
+            },
+        }
+
+    # Successive states of the task group, returned each time it is refreshed
+    group_states = [
+        {"A": "running", "B": "failed", "C": "pending"},
+        {"A": "completed", "B": "failed", "C": "completed"},
+    ]
+    test_tasks = [
+        build_task("A", 1, "running"),
+        build_task("B", 1, "failed"),
+        build_task("C", 2, "pending"),
+    ]
+
+    def get_tasks_in_group(group_id):
+        assert group_id == "group"
+        states = group_states.pop(0)
+        return [build_task(task_id, 0, state) for task_id, state in states.items()]
+
+    monkeypatch.setattr(
+        "code_coverage_bot.taskcluster.get_tasks_in_group", get_tasks_in_group
+    )
+    sleeps = []
+    monkeypatch.setattr("code_coverage_bot.artifacts.time.sleep", sleeps.append)
+
+    a = ArtifactsHandler(test_tasks, parent_dir=tmpdir.strpath)
+
+    downloaded = []
+
+    def mock_download(task):
+        task_id = task["status"]["taskId"]
+        downloaded.append(task_id)
+        a.add_artifact(Artifact(task_id, task_id, "linux", "xpcshell", task_id))
+
+    a.download = mock_download
+
+    a.download_all(poll_interval=5)
+
+    # The failed task is downloaded before the others are finished, then replaced
+    # by the completed one for the same chunk.
+    assert downloaded[0] == "B"
+    assert sorted(downloaded[1:]) == ["A", "C"]
+    assert sorted(artifact.task_id for artifact in a.artifacts) == ["A", "C"]
+    assert sleeps == [5, 5]
+    assert group_states == []
+
+
+def test_download_all_replace_chain(monkeypatch, tmpdir):
+    def build_task(task_id, state):
+        return {
+            "status": {"taskId": task_id, "taskGroupId": "group", "state": state},
+            "task": {
+                "metadata": {"name": "test-linux64-ccov/opt-xpcshell-1"},
+                "env": {},
+                "extra": {"suite": "xpcshell", "chunks": {"current": 1}},
+                "tags": {"os": "linux"},
+            },
+        }
+
+    # A single worker, busy with the first task until all of them finished, so
+    # the replacement of A by B is cancelled when C is picked.
+    monkeypatch.setattr("code_coverage_bot.artifacts.DOWNLOAD_WORKERS", 1)
+    release = threading.Event()
+
+    a = ArtifactsHandler([], parent_dir=tmpdir.strpath)
+
+    def iter_finished_tasks(poll_interval):
+        yield [build_task("A", "exception")]
+        yield [build_task("B", "failed")]
+        yield [build_task("C", "completed")]
+        release.set()
+
+    a.iter_finished_tasks = iter_finished_tasks
+
+    downloaded = []
+
+    def mock_download(task):
+        task_id = task["status"]["taskId"]
+        if task_id == "A":
+            assert release.wait(10)
+        downloaded.append(task_id)
+        a.add_artifact(Artifact(task_id, task_id, "linux", "xpcshell", "1"))
+
+    a.download = mock_download
+
+    a.download_all()
+
+    assert downloaded == ["A", "C"]
+    assert [artifact.task_id for artifact in a.artifacts] == ["C"]
+
+
+def test_build_reports(monkeypatch, tmpdir, fake_artifacts):
+    hook = Hook.__new__(Hook)
+    hook.repo_dir = "repo"
+    hook.reports_dir = tmpdir.strpath
+    hook.artifactsHandler = ArtifactsHandler([], cache=mock.Mock())
+    hook.artifactsHandler.artifacts = fake_artifacts
+
+    monkeypatch.setattr(grcov, "GRCOV_MEMORY", 1)
+
+    def report_to_file(
+        artifacts, output_path, source_dir=None, out_format="covdir", options=None
+    ):
+        assert source_dir == "repo"
+        assert options[0] == "--threads" and int(options[1]) >= 1
+        with open(output_path, "w") as f:
+            json.dump(sorted(artifacts), f)
+        return output_path
+
+    monkeypatch.setattr(grcov, "report_to_file", report_to_file)
+
+    reports = hook.build_reports()
+    combinations = hook.artifactsHandler.get_combinations()
+    assert list(reports) == list(combinations)
+    assert list(reports)[0] == ("all", "all")
+    for (platform, suite), path in reports.items():
+        assert path == tmpdir.join(f"{platform}.{suite}.json").strpath
+        with open(path) as f:
+            assert json.load(f) == sorted(combinations[(platform, suite)])
+
+    # The artifacts cache is trimmed once the reports are built
+    assert hook.artifactsHandler.cache.evict.call_count == 1
+
+    reports = hook.build_reports(only=[("linux", "all")])
+    assert list(reports) == [("linux", "all")]
+
+
+def test_build_reports_merge(monkeypatch, tmpdir, fake_artifacts):
+    hook = Hook.__new__(Hook)
+    hook.repo_dir = "repo"
+    hook.reports_dir = tmpdir.strpath
+    hook.artifactsHandler = ArtifactsHandler([])
+    hook.artifactsHandler.artifacts = fake_artifacts
+
+    def fake_report(artifacts):
+        # One file per artifact, covered on its first line
+        report = {
+            "name": "",
+            "children": {
+                os.path.basename(artifact): {
+                    "name": os.path.basename(artifact),
+                    "coverage": [1, -1, 0],
+                }
+                for artifact in artifacts
+            },
+        }
+        covdir.update_stats(report)
+        return covdir.dumps(report)
+
+    grcov_calls = []
+
+    def report_to_file(
+        artifacts, output_path, source_dir=None, out_format="covdir", options=None
+    ):
+        grcov_calls.append(sorted(artifacts))
+        with open(output_path, "wb") as f:
+            f.write(fake_report(artifacts))
+        return output_path
+
+    monkeypatch.setattr(grcov, "report_to_file", report_to_file)
+
+    combinations = hook.artifactsHandler.get_combinations()
+    reports = hook.build_reports(merge=True)
+    assert list(reports) == list(combinations)
+
+    # grcov only ran once per platform & suite
+    leaves = [key for key in combinations if "all" not in key]
+    assert len(grcov_calls) == len(leaves)
+
+    for key, path in reports.items():
+        with open(path, "rb") as f:
+            assert f.read() == fake_report(combinations[key])
+
+    # Aggregated reports only need their leaves
+    grcov_calls.clear()
+    reports = hook.build_reports(only=[("windows", "all")], merge=True)
+    assert list(reports) == [("windows", "all")]
+    assert len(grcov_calls) == len([key for key in leaves if key[0] == "windows"])
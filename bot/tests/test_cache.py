@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import threading
+import time
+
+from code_coverage_bot.cache import AnnotateCache
+from code_coverage_bot.cache import ArtifactsCache
+
+
+def write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def test_artifacts_cache(tmpdir):
+    cache = ArtifactsCache(os.path.join(tmpdir.strpath, "cache"))
+    work = os.path.join(tmpdir.strpath, "work")
+    os.makedirs(work)
+
+    path = os.path.join(work, "linux_xpcshell-1_code-coverage-grcov.zip")
+    assert not cache.fetch("taskA", "public/code-coverage-grcov.zip", path)
+    assert not os.path.exists(path)
+
+    write(path, b"artifact content")
+    cache.store("taskA", "public/code-coverage-grcov.zip", path)
+
+    # Same content from another task is only stored once.
+    other = os.path.join(work, "other.zip")
+    write(other, b"artifact content")
+    cache.store("taskB", "public/code-coverage-grcov.zip", other)
+    objects = [f for _, _, files in os.walk(cache.objects_dir) for f in files]
+    assert len(objects) == 1
+
+    # A new working directory gets a hardlink to the cached object.
+    new_work = os.path.join(tmpdir.strpath, "new_work")
+    os.makedirs(new_work)
+    new_path = os.path.join(new_work, "linux_xpcshell-1_code-coverage-grcov.zip")
+    assert cache.fetch("taskA", "public/code-coverage-grcov.zip", new_path)
+    with open(new_path, "rb") as f:
+        assert f.read() == b"artifact content"
+    assert os.stat(new_path).st_ino == os.stat(path).st_ino
+
+    assert not cache.fetch("taskA", "public/code-coverage-jsvm.zip", new_path + "2")
+
+
+def test_artifacts_cache_eviction(tmpdir):
+    cache = ArtifactsCache(os.path.join(tmpdir.strpath, "cache"), max_size=25)
+    work = tmpdir.strpath
+
+    for i, name in enumerate(["old", "unused", "new"]):
+        path = os.path.join(work, name)
+        write(path, name.encode("ascii") * 4)
+        cache.store(name, "artifact", path)
+        # Make sure the objects have distinct modification times.
+        os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+
+    # Using the oldest artifact makes it the most recently used.
+    assert cache.fetch("old", "artifact", os.path.join(work, "old_restored"))
+
+    cache.evict()
+
+    assert cache.fetch("old", "artifact", os.path.join(work, "old_restored2"))
+    assert cache.fetch("new", "artifact", os.path.join(work, "new_restored"))
+    assert not cache.fetch("unused", "artifact", os.path.join(work, "unused_restored"))
+
+
+def test_artifacts_cache_keys_eviction(tmpdir):
+    cache = ArtifactsCache(os.path.join(tmpdir.strpath, "cache"), max_age=100)
+    path = os.path.join(tmpdir.strpath, "artifact")
+    write(path, b"artifact content")
+    for task_id in ("old", "used", "new"):
+        cache.store(task_id, "artifact", path)
+    cache.store("dangling", "artifact", path)
+    write(cache._key_path("dangling", "artifact"), b"0" * 64)
+    write(os.path.join(cache.keys_dir, "writing.tmp"), b"")
+
+    # Keys unused for too long are removed, even when their object is still cached
+    old = time.time() - 200
+    for task_id in ("old", "used"):
+        os.utime(cache._key_path(task_id, "artifact"), (old, old))
+    assert cache.fetch("used", "artifact", os.path.join(tmpdir.strpath, "restored"))
+
+    cache.evict()
+
+    assert sorted(os.listdir(cache.keys_dir)) == sorted(
+        [
+            os.path.basename(cache._key_path("used", "artifact")),
+            os.path.basename(cache._key_path("new", "artifact")),
+            "writing.tmp",
+        ]
+    )
+
+
+def test_annotate_cache(tmpdir):
+    path = os.path.join(tmpdir.strpath, "annotate.sqlite")
+    cache = AnnotateCache(path, max_size=64)
+
+    annotate = (("a" * 12, 1), ("b" * 12, 1), ("a" * 12, 2))
+    assert cache.get_many("rev1", ["file", "removed"]) == {}
+    cache.put_many("rev1", {"file": annotate, "removed": None})
+    assert cache.get_many("rev1", ["file", "removed", "other"]) == {
+        "file": annotate,
+        "removed": None,
+    }
+
+    # Shared with other threads & processes through the database
+    other = AnnotateCache(path)
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(other.get_many("rev1", ["file"]))
+    )
+    thread.start()
+    thread.join()
+    assert results == [{"file": annotate}]
+
+    # Lookups do not write to the database until flushed
+    assert other.stats() == {"hits": 1, "misses": 0}
+    cache.flush()
+    assert other.stats() == {"hits": 3, "misses": 3}
+    other.flush()
+    assert AnnotateCache(path).stats() == {"hits": 3, "misses": 3}
+
+    # Access times are only refreshed when they are older than their granularity
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE annotations SET last_access = 1")
+    assert cache.get_many("rev1", ["file"]) == {"file": annotate}
+    assert cache.get_many("rev1", ["file"]) == {"file": annotate}
+    assert cache.accessed == {("rev1", "file")}
+    cache.flush()
+    with sqlite3.connect(path) as db:
+        assert db.execute(
+            "SELECT path FROM annotations WHERE last_access > 1"
+        ).fetchall() == [("file",)]
+
+    # Least recently used annotations are evicted beyond the size budget
+    cache.put_many("rev2", {"file": annotate[:2]})
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE annotations SET last_access = 0 WHERE rev = 'rev1'")
+    cache.evict()
+    assert cache.get_many("rev1", ["file"]) == {}
+    assert cache.get_many("rev2", ["file"]) == {"file": annotate[:2]}
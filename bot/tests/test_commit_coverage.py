@@ -4,18 +4,43 @@ import os
 import threading
 from contextlib import contextmanager
 
+import pytest
 import zstandard
 
 from code_coverage_bot import commit_coverage
+from code_coverage_bot import commit_store
+from code_coverage_bot import gcp
 from code_coverage_bot import hgmo
+from code_coverage_bot.secrets import secrets
 from conftest import add_file
 from conftest import commit
 from conftest import copy_pushlog_database
 from conftest import covdir_report
 
 
+def build_bucket(path, reports, commit_coverage=None):
+    bucket = gcp.LocalBucket(path)
+    cctx = zstandard.ZstdCompressor()
+    for revision, report in reports.items():
+        bucket.blob(f"mozilla-central/{revision}/all:all.json.zstd").upload_from_string(
+            cctx.compress(json.dumps(report).encode("utf-8"))
+        )
+    if commit_coverage is not None:
+        bucket.blob("commit_coverage.json.zst").upload_from_string(
+            cctx.compress(json.dumps(commit_coverage).encode("ascii"))
+        )
+    return bucket
+
+
+@pytest.mark.parametrize("processes", [False, True])
 def test_generate_from_scratch(
-    monkeypatch, tmpdir, mock_secrets, mock_taskcluster, mock_phabricator, fake_hg_repo
+    monkeypatch,
+    tmpdir,
+    mock_secrets,
+    mock_taskcluster,
+    mock_phabricator,
+    fake_hg_repo,
+    processes,
 ):
     tmp_path = tmpdir.strpath
 
@@ -39,75 +64,38 @@ def test_generate_from_scratch(
         }
     )
 
-    uploaded_data = None
-    patch_calls = 0
-
-    class Blob:
-        def exists(self):
-            return False
-
-        def upload_from_string(self, val):
-            nonlocal uploaded_data
-            uploaded_data = val
-
-        def download_as_bytes(self, raw_download=False):
-            assert False
-
-        def patch(self):
-            nonlocal patch_calls
-            assert self.content_type == "application/json"
-            assert self.content_encoding == "zstd"
-            patch_calls += 1
-
-    class Bucket:
-        def blob(self, path):
-            assert path == "commit_coverage.json.zst"
-            return Blob()
-
-    myBucket = Bucket()
+    # Worker processes build their own bucket from the secret
+    bucket_dir = os.path.join(tmp_path, "bucket")
+    build_bucket(bucket_dir, {revision2: report})
+    secrets[secrets.GOOGLE_CLOUD_STORAGE] = {"local_dir": bucket_dir}
+    myBucket = gcp.get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
 
-    def get_bucket(acc):
-        return myBucket
-
-    monkeypatch.setattr(commit_coverage, "get_bucket", get_bucket)
-
-    def list_reports(bucket, repo):
+    def list_reports(bucket, repo, platform=None, suite=None, cache_path=None):
         assert bucket == myBucket
         assert repo == "mozilla-central"
+        assert platform == "all"
+        assert suite == "all"
         yield revision2, "linux", "all"
         yield revision2, "all", "xpcshell"
         yield revision2, "all", "all"
 
     monkeypatch.setattr(commit_coverage, "list_reports", list_reports)
 
-    def download_report(report_dir, bucket, report_name):
-        os.makedirs(
-            os.path.join(tmp_path, report_dir, "mozilla-central", revision2),
-            exist_ok=True,
-        )
-        with open(
-            os.path.join(
-                tmp_path, report_dir, "mozilla-central", revision2, "all:all.json"
-            ),
-            "w",
-        ) as f:
-            json.dump(report, f)
-
-        return True
-
-    monkeypatch.setattr(commit_coverage, "download_report", download_report)
-
     with hgmo.HGMO(repo_dir=local) as hgmo_server:
-        commit_coverage.generate(hgmo_server.server_address, local, out_dir=tmp_path)
-
-    assert patch_calls == 1
+        commit_coverage.generate(
+            hgmo_server.server_address, local, out_dir=tmp_path, processes=processes
+        )
 
     dctx = zstandard.ZstdDecompressor()
     with open(os.path.join(tmp_path, "commit_coverage.json.zst"), "rb") as zf:
         with dctx.stream_reader(zf) as reader:
             result = json.load(reader)
 
-    assert result == json.loads(dctx.decompress(uploaded_data))
+    assert result == commit_store.read(myBucket)
+
+    # The legacy blob is still written for its readers
+    legacy = myBucket.blob(commit_store.LEGACY_PATH).download_as_bytes()
+    assert json.loads(dctx.decompress(legacy)) == result
     assert result == {
         revision1: {
             "added": 3,
@@ -164,41 +152,20 @@ def test_generate_two_pushes(
         }
     )
 
-    uploaded_data = None
-    patch_calls = 0
-
-    class Blob:
-        def exists(self):
-            return False
-
-        def upload_from_string(self, val):
-            nonlocal uploaded_data
-            uploaded_data = val
-
-        def download_as_bytes(self, raw_download=False):
-            assert False
-
-        def patch(self):
-            nonlocal patch_calls
-            assert self.content_type == "application/json"
-            assert self.content_encoding == "zstd"
-            patch_calls += 1
-
-    class Bucket:
-        def blob(self, path):
-            assert path == "commit_coverage.json.zst"
-            return Blob()
-
-    myBucket = Bucket()
+    myBucket = build_bucket(
+        os.path.join(tmp_path, "bucket"), {revision2: report1, revision4: report2}
+    )
 
     def get_bucket(acc):
         return myBucket
 
     monkeypatch.setattr(commit_coverage, "get_bucket", get_bucket)
 
-    def list_reports(bucket, repo):
+    def list_reports(bucket, repo, platform=None, suite=None, cache_path=None):
         assert bucket == myBucket
         assert repo == "mozilla-central"
+        assert platform == "all"
+        assert suite == "all"
         yield revision2, "linux", "all"
         yield revision2, "all", "xpcshell"
         yield revision2, "all", "all"
@@ -206,37 +173,6 @@ def test_generate_two_pushes(
 
     monkeypatch.setattr(commit_coverage, "list_reports", list_reports)
 
-    def download_report(report_dir, bucket, report_name):
-        if revision2 in report_name:
-            os.makedirs(
-                os.path.join(tmp_path, report_dir, "mozilla-central", revision2),
-                exist_ok=True,
-            )
-            with open(
-                os.path.join(
-                    tmp_path, report_dir, "mozilla-central", revision2, "all:all.json"
-                ),
-                "w",
-            ) as f:
-                json.dump(report1, f)
-
-        if revision4 in report_name:
-            os.makedirs(
-                os.path.join(tmp_path, report_dir, "mozilla-central", revision4),
-                exist_ok=True,
-            )
-            with open(
-                os.path.join(
-                    tmp_path, report_dir, "mozilla-central", revision4, "all:all.json"
-                ),
-                "w",
-            ) as f:
-                json.dump(report2, f)
-
-        return True
-
-    monkeypatch.setattr(commit_coverage, "download_report", download_report)
-
     with hgmo.HGMO(repo_dir=local) as hgmo_server:
         lock = threading.Lock()
 
@@ -254,14 +190,12 @@ def test_generate_two_pushes(
 
         commit_coverage.generate(hgmo_server.server_address, local, out_dir=tmp_path)
 
-    assert patch_calls == 1
-
     dctx = zstandard.ZstdDecompressor()
     with open(os.path.join(tmp_path, "commit_coverage.json.zst"), "rb") as zf:
         with dctx.stream_reader(zf) as reader:
             result = json.load(reader)
 
-    assert result == json.loads(dctx.decompress(uploaded_data))
+    assert result == commit_store.read(myBucket)
     assert result == {
         revision1: {
             "added": 3,
@@ -311,86 +245,44 @@ def test_generate_from_preexisting(
         }
     )
 
-    uploaded_data = None
-    patch_calls = 0
-
-    class Blob:
-        def exists(self):
-            return True
-
-        def upload_from_string(self, val):
-            nonlocal uploaded_data
-            uploaded_data = val
-
-        def download_as_bytes(self, raw_download=False):
-            return zstandard.ZstdCompressor().compress(
-                json.dumps(
-                    {
-                        "revision1": {
-                            "added": 7,
-                            "covered": 3,
-                            "unknown": 0,
-                        },
-                        "revision2": None,
-                    }
-                ).encode("ascii")
-            )
-
-        def patch(self):
-            nonlocal patch_calls
-            assert self.content_type == "application/json"
-            assert self.content_encoding == "zstd"
-            patch_calls += 1
-
-    class Bucket:
-        def blob(self, path):
-            assert path == "commit_coverage.json.zst"
-            return Blob()
-
-    myBucket = Bucket()
+    myBucket = build_bucket(
+        os.path.join(tmp_path, "bucket"),
+        {revision2: report},
+        {
+            "revision1": {
+                "added": 7,
+                "covered": 3,
+                "unknown": 0,
+            },
+            "revision2": None,
+        },
+    )
 
     def get_bucket(acc):
         return myBucket
 
     monkeypatch.setattr(commit_coverage, "get_bucket", get_bucket)
 
-    def list_reports(bucket, repo):
+    def list_reports(bucket, repo, platform=None, suite=None, cache_path=None):
         assert bucket == myBucket
         assert repo == "mozilla-central"
+        assert platform == "all"
+        assert suite == "all"
         yield revision2, "linux", "all"
         yield revision2, "all", "xpcshell"
         yield revision2, "all", "all"
 
     monkeypatch.setattr(commit_coverage, "list_reports", list_reports)
 
-    def download_report(report_dir, bucket, report_name):
-        os.makedirs(
-            os.path.join(tmp_path, report_dir, "mozilla-central", revision2),
-            exist_ok=True,
-        )
-        with open(
-            os.path.join(
-                tmp_path, report_dir, "mozilla-central", revision2, "all:all.json"
-            ),
-            "w",
-        ) as f:
-            json.dump(report, f)
-
-        return True
-
-    monkeypatch.setattr(commit_coverage, "download_report", download_report)
-
     with hgmo.HGMO(repo_dir=local) as hgmo_server:
         commit_coverage.generate(hgmo_server.server_address, local, out_dir=tmp_path)
 
-    assert patch_calls == 1
-
     dctx = zstandard.ZstdDecompressor()
     with open(os.path.join(tmp_path, "commit_coverage.json.zst"), "rb") as zf:
         with dctx.stream_reader(zf) as reader:
             result = json.load(reader)
 
-    assert result == json.loads(dctx.decompress(uploaded_data))
+    assert result == commit_store.read(myBucket)
     assert result == {
         "revision1": {"added": 7, "covered": 3, "unknown": 0},
         "revision2": None,
@@ -405,3 +297,9 @@ def test_generate_from_preexisting(
             "unknown": 0,
         },
     }
+
+
+def test_plan_workers():
+    assert commit_coverage.plan_workers(16, 64 * 1024**3) == 16
+    assert commit_coverage.plan_workers(16, 9 * 1024**3) == 4
+    assert commit_coverage.plan_workers(16, 1024**3) == 1
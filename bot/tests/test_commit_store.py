@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import json
+
+import zstandard
+
+from code_coverage_bot import commit_store
+from code_coverage_bot import gcp
+
+
+def segments(bucket):
+    return [blob.name for blob in bucket.list_blobs(prefix="commit_coverage/segments/")]
+
+
+def test_migrate(tmpdir):
+    bucket = gcp.LocalBucket(tmpdir.strpath)
+    legacy = {"rev1": {"added": 7, "covered": 3, "unknown": 0}, "rev2": None}
+    bucket.blob(commit_store.LEGACY_PATH).upload_from_string(
+        zstandard.ZstdCompressor().compress(json.dumps(legacy).encode("ascii"))
+    )
+
+    # Readers do not migrate
+    assert commit_store.read(bucket) == legacy
+    assert bucket.get_blob(commit_store.INDEX_PATH) is None
+
+    store = commit_store.CommitCoverageStore(bucket)
+    assert store.load() == legacy
+    assert len(store.segments) == 1
+    assert commit_store.read(bucket) == legacy
+
+
+def test_write_legacy(tmpdir):
+    bucket = gcp.LocalBucket(tmpdir.strpath)
+    results = {"rev1": {"added": 7, "covered": 3, "unknown": 0}}
+    store = commit_store.CommitCoverageStore(bucket)
+    store.write_legacy(
+        zstandard.ZstdCompressor().compress(json.dumps(results).encode("ascii"))
+    )
+
+    # Existing consumers decompress the blob in one call
+    legacy = bucket.blob(commit_store.LEGACY_PATH).download_as_bytes()
+    assert json.loads(zstandard.ZstdDecompressor().decompress(legacy)) == results
+
+    assert commit_store.read(bucket) == results
+    assert commit_store.CommitCoverageStore(bucket).load() == results
+
+
+def test_append_compact(monkeypatch, tmpdir):
+    monkeypatch.setattr(commit_store, "COMPACTION_THRESHOLD", 2)
+    bucket = gcp.LocalBucket(tmpdir.strpath)
+
+    store = commit_store.CommitCoverageStore(bucket)
+    assert store.load() == {}
+    store.append({})
+    assert segments(bucket) == []
+
+    store.append({"rev1": None})
+    store.append({"rev2": {"added": 1, "covered": 1, "unknown": 0}})
+    assert not store.needs_compaction()
+    # Newer results override older ones
+    store.append({"rev1": {"added": 2, "covered": 0, "unknown": 0}})
+    assert store.needs_compaction()
+    assert len(segments(bucket)) == 3
+
+    expected = {
+        "rev1": {"added": 2, "covered": 0, "unknown": 0},
+        "rev2": {"added": 1, "covered": 1, "unknown": 0},
+    }
+    assert commit_store.read(bucket) == expected
+
+    store.compact()
+    assert len(store.segments) == 1
+    assert commit_store.read(bucket) == expected
+
+    # Merged segments are only deleted after a grace period
+    assert len(segments(bucket)) == 4
+    store.delete_retired()
+    assert len(segments(bucket)) == 4
+    monkeypatch.setattr(commit_store, "RETIRED_GRACE_PERIOD", 0)
+    store.delete_retired()
+    assert store.segments == segments(bucket)
+    assert store.retired == []
+
+    # Updates of another writer are merged
+    other = commit_store.CommitCoverageStore(bucket)
+    other.load()
+    other.append({"rev3": None})
+    store.append({"rev4": None})
+    assert commit_store.read(bucket) == dict(expected, rev3=None, rev4=None)
+    assert len(store.segments) == 3
+
+
+def test_concurrent_compaction(monkeypatch, tmpdir):
+    monkeypatch.setattr(commit_store, "RETIRED_GRACE_PERIOD", 0)
+    bucket = gcp.LocalBucket(tmpdir.strpath)
+
+    store = commit_store.CommitCoverageStore(bucket)
+    store.load()
+    for i in range(3):
+        store.append({f"rev{i}": None})
+    expected = {"rev0": None, "rev1": None, "rev2": None}
+
+    # Another process compacts the same segments first
+    other = commit_store.CommitCoverageStore(bucket)
+    assert other.load() == expected
+    other.compact()
+    store.compact()
+    assert store.segments == other.segments == segments(bucket)
+
+    # A reader of the previous index reloads it when its segments are deleted
+    reader = commit_store.CommitCoverageStore(bucket)
+    read_segments = reader._read_segments
+    stale = ["commit_coverage/segments/deleted.json.zst"]
+
+    def _read_segments(paths):
+        if stale:
+            paths = [stale.pop()]
+        return read_segments(paths)
+
+    monkeypatch.setattr(reader, "_read_segments", _read_segments)
+    assert reader.load() == expected
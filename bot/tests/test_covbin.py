@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import random
+from datetime import datetime
+
+import pytest
+import pytz
+from google.api_core.exceptions import NotFound
+
+from code_coverage_bot import covbin
+from code_coverage_bot import covdir
+from code_coverage_bot import gcp
+from code_coverage_bot import uploader
+
+
+@pytest.mark.parametrize(
+    "coverage",
+    [
+        [],
+        [-1],
+        [0, 0, 0],
+        [-1, -1, 3, 3, 0, 2**40, -1],
+        [random.randint(-1, 5) for _ in range(1000)],
+    ],
+)
+def test_encode_coverage(coverage):
+    assert list(covbin.decode_coverage(covbin.encode_coverage(coverage))) == coverage
+
+
+def build_index(nb):
+    rng = random.Random(nb)
+    return covdir.PathIndex(
+        {
+            f"dir{i % 7}/sub{i % 3}/file{i}.cpp": [
+                rng.choice([-1, 0, 1, 300]) for _ in range(rng.randrange(50))
+            ]
+            for i in range(nb)
+        }
+    )
+
+
+@pytest.mark.parametrize("nb", [0, 1, covbin.BLOCK_SIZE, 1000])
+def test_reader(nb):
+    index = build_index(nb)
+    data = covbin.dumps(index)
+
+    reads = []
+
+    def read(offset, size):
+        reads.append((offset, size))
+        assert offset + size <= len(data)
+        return data[offset : offset + size]
+
+    reader = covbin.Reader(read)
+    for path, coverage in index.coverages.items():
+        assert list(reader.get(path)) == coverage
+    assert reader.get("dir0") is None
+    assert reader.get("0.cpp") is None
+    assert reader.get("zzz/file.cpp") is None
+    assert reader.nb_files == nb
+
+    if nb:
+        # Each file only needs a block and its record, on top of the header
+        reads.clear()
+        reader = covbin.Reader(read)
+        path = "dir0/sub0/file0.cpp"
+        assert list(reader.get(f"/{path}")) == index.coverages[path]
+        assert len(reads) == 4
+        assert sum(size for _, size in reads) < len(data) or nb == 1
+
+        # The header, top table & blocks are only read once:
+        # only the record and the block of the missing path are read
+        reads.clear()
+        assert reader.get_coverages([path, "missing.cpp"]) == {
+            path: covdir.coverage_array(index.coverages[path])
+        }
+        assert len(reads) <= 2
+
+
+class Blob(object):
+    def __init__(self, name, data=None):
+        self.name = name
+        self.data = data
+        self.time_created = datetime.now(pytz.UTC)
+        self.generation = 1
+
+    def download_as_bytes(self, start=None, end=None, raw_download=False):
+        if self.data is None:
+            raise NotFound("Missing blob")
+        assert raw_download
+        return self.data[start : end + 1]
+
+
+class Bucket(object):
+    def __init__(self, blobs):
+        self.blobs = {blob.name: blob for blob in blobs}
+
+    def blob(self, name):
+        return self.blobs.get(name, Blob(name))
+
+    def list_blobs(self, prefix, **kwargs):
+        return [blob for name, blob in self.blobs.items() if name.startswith(prefix)]
+
+
+def test_gcp_binary_report():
+    index = build_index(500)
+    bucket = Bucket(
+        [
+            Blob("mozilla-central/deadbeef/all:all.json.zstd", b"{}"),
+            Blob("mozilla-central/deadbeef/all:all.covbin", covbin.dumps(index)),
+        ]
+    )
+
+    name = gcp.get_name("mozilla-central", "deadbeef", "all", "all")
+    path = "dir3/sub1/file10.cpp"
+    assert list(gcp.download_file_coverage(bucket, name, path)) == index.get(path)
+    assert gcp.download_file_coverage(bucket, name, "missing.cpp") is None
+    assert gcp.download_file_coverage(bucket, f"{name}-missing", path) is None
+
+    # Binary reports are not listed as reports
+    assert list(gcp.list_reports(bucket, "mozilla-central")) == [
+        ("deadbeef", "all", "all")
+    ]
+    assert (
+        uploader.GCP_COVBIN_PATH.format(
+            repository="mozilla-central",
+            revision="deadbeef",
+            platform="all",
+            suite="all",
+        )
+        == f"{name}.covbin"
+    )
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from array import array
+
+import pytest
+
+from code_coverage_bot import covdir
+from code_coverage_bot import grcov
+from code_coverage_bot import uploader
+from code_coverage_bot.phabricator import PhabricatorUploader
+
+
+def file_node(name, coverage):
+    node = {"name": name, "coverage": coverage}
+    covdir.update_stats(node)
+    return node
+
+
+def dir_node(name, *children):
+    node = {"name": name, "children": {child["name"]: child for child in children}}
+    covdir.update_stats(node)
+    return node
+
+
+def test_merge_coverage():
+    assert covdir.merge_coverage([1, -1, 0], [2, 3, -1]) == [3, 3, 0]
+    assert covdir.merge_coverage([-1, 0], [-1, -1, 5]) == [-1, 0, 5]
+    assert covdir.merge_coverage([], [0, -1]) == [0, -1]
+
+
+@pytest.mark.parametrize(
+    "covered, total, expected",
+    [
+        (0, 0, 0.0),
+        (1, 3, 33.33),
+        (2, 3, 66.67),
+        (1, 8, 12.5),
+        (3, 3, 100.0),
+        # covered / total * 100.0 * 100.0 would be just below the half
+        (23, 160, 14.38),
+        (41, 160, 25.63),
+        (46, 320, 14.38),
+        # Halves are rounded away from zero, not to even
+        (1, 32, 3.13),
+        (5, 32, 15.63),
+    ],
+)
+def test_percent(covered, total, expected):
+    assert covdir.percent(covered, total) == expected
+
+
+def test_merge():
+    a = dir_node(
+        "",
+        dir_node("dom", file_node("a.cpp", [1, 0, -1])),
+        file_node("README", [-1]),
+    )
+    b = dir_node(
+        "",
+        dir_node(
+            "dom",
+            file_node("a.cpp", [0, 0, -1, 2]),
+            file_node("b.cpp", [0, 0, 0]),
+        ),
+        dir_node("js", file_node("c.js", [4])),
+    )
+
+    report = covdir.merge([a, b])
+    assert report == dir_node(
+        "",
+        dir_node(
+            "dom",
+            file_node("a.cpp", [1, 0, -1, 2]),
+            file_node("b.cpp", [0, 0, 0]),
+        ),
+        dir_node("js", file_node("c.js", [4])),
+        file_node("README", [-1]),
+    )
+    assert report["linesTotal"] == 7
+    assert report["linesCovered"] == 3
+    assert report["linesMissed"] == 4
+    assert report["coveragePercent"] == 42.86
+    assert report["children"]["README"]["coveragePercent"] == 0.0
+
+
+def test_merge_conflict():
+    a = dir_node("", file_node("dom", [1]))
+    b = dir_node("", dir_node("dom", file_node("a.cpp", [1])))
+    with pytest.raises(AssertionError, match="dom is both a file and a directory"):
+        covdir.merge([a, b])
+
+
+def test_dumps():
+    report = covdir.merge([dir_node("", file_node("é.js", [1, -1]))])
+    assert covdir.dumps(report) == (
+        '{"children":{"é.js":{"coverage":[1,-1],"coveragePercent":100.0,'
+        '"linesCovered":1,"linesMissed":0,"linesTotal":1,"name":"é.js"}},'
+        '"coveragePercent":100.0,"linesCovered":1,"linesMissed":0,"linesTotal":1,'
+        '"name":""}'
+    ).encode("utf-8")
+
+
+def test_merge_files_grcov(
+    tmpdir,
+    grcov_artifact,
+    jsvm_artifact,
+    grcov_uncovered_artifact,
+    jsvm_uncovered_artifact,
+):
+    artifacts = [
+        grcov_artifact,
+        jsvm_artifact,
+        grcov_uncovered_artifact,
+        jsvm_uncovered_artifact,
+    ]
+
+    paths = []
+    for i, artifact in enumerate(artifacts):
+        path = tmpdir.join(f"{i}.json").strpath
+        with open(path, "wb") as f:
+            f.write(grcov.report([artifact], out_format="covdir"))
+        paths.append(path)
+
+    output = covdir.merge_files(paths, tmpdir.join("merged.json").strpath)
+    with open(output, "rb") as f:
+        merged = f.read()
+
+    assert merged == grcov.report(artifacts, out_format="covdir")
+    assert json.loads(merged)["linesTotal"] == 10
+
+
+def test_load():
+    report = covdir.merge(
+        [
+            dir_node(
+                "",
+                dir_node("dom", file_node("a.cpp", [1, 0, -1, 2**40])),
+                file_node("README", [-1]),
+                dir_node("coverage", file_node("name", [0])),
+            )
+        ]
+    )
+    data = covdir.dumps(report)
+
+    compact = covdir.loads(data)
+    assert isinstance(compact, covdir.Directory)
+    assert covdir.dumps(compact) == data
+    assert dict(compact.items()).keys() == report.keys()
+
+    # Nodes can be browsed as the plain report
+    assert sorted(uploader.covdir_paths(compact)) == sorted(
+        uploader.covdir_paths(report)
+    )
+    a = compact["children"]["dom"]["children"]["a.cpp"]
+    assert isinstance(a, covdir.File)
+    assert list(a["coverage"]) == [1, 0, -1, 2**40]
+    assert a["linesCovered"] == 2
+    assert "children" not in a
+    assert a.get("children", {}) == {}
+    assert isinstance(compact["children"]["coverage"]["children"]["name"], covdir.File)
+    assert dict(covdir.PathIndex.from_report(compact).coverages) == {
+        path: array("q", coverage)
+        for path, coverage in covdir.PathIndex.from_report(report).coverages.items()
+    }
+
+
+def test_path_index(tmpdir):
+    report = dir_node(
+        "src",
+        dir_node("dom", file_node("a.cpp", [1, 0, -1])),
+        file_node("README", [-1]),
+    )
+    index = covdir.PathIndex.from_report(report)
+    assert len(index) == 2
+    assert index.paths() == ["src/dom/a.cpp", "src/README"]
+    assert uploader.covdir_paths(index) == uploader.covdir_paths(report)
+    assert index.get("dom/a.cpp") == [1, 0, -1]
+    assert index.get("/dom//a.cpp") == [1, 0, -1]
+    assert index.get("dom") is None
+    assert index.get("dom/b.cpp") is None
+
+    phabricator = PhabricatorUploader("", "")
+    assert phabricator._find_coverage(index, "README") == [-1]
+    assert phabricator._find_coverage(index, "dom/a.cpp/b.cpp") is None
+
+    # Indexing a report file reuses the compact coverage arrays
+    report_path = tmpdir.join("report.json").strpath
+    with open(report_path, "wb") as f:
+        f.write(covdir.dumps(report))
+    index = covdir.PathIndex.from_file(report_path)
+    assert index.get("dom/a.cpp") == array("i", [1, 0, -1])
+    assert os.listdir(tmpdir.strpath) == ["report.json"]
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_streaming_report(tmpdir, indent):
+    report = dir_node(
+        "",
+        dir_node(
+            "dom",
+            file_node("a.cpp", [1, 0, -1, 2**40]),
+            file_node('{b}"[.cpp', [0, 0]),
+        ),
+        dir_node("coverage", file_node("children", [3]), dir_node("empty")),
+        file_node("README", [-1]),
+    )
+    data = json.dumps(report, indent=indent).encode("utf-8")
+    paths = [
+        "dom/a.cpp",
+        '/dom/{b}"[.cpp',
+        "dom//a.cpp",
+        "coverage/children",
+        "coverage/empty",
+        "coverage",
+        "README",
+        "missing/file.cpp",
+    ]
+    expected = {
+        "dom/a.cpp": [1, 0, -1, 2**40],
+        '/dom/{b}"[.cpp': [0, 0],
+        "dom//a.cpp": [1, 0, -1, 2**40],
+        "coverage/children": [3],
+        "README": [-1],
+    }
+
+    coverages = covdir.StreamingReport(data).get_coverages(paths)
+    assert {path: list(coverage) for path, coverage in coverages.items()} == expected
+
+    index = covdir.PathIndex.from_report(report)
+    assert index.get_coverages(paths) == expected
+
+    path = tmpdir.join("report.json").strpath
+    with open(path, "wb") as f:
+        f.write(data)
+    with covdir.StreamingReport(path) as streaming:
+        assert streaming.get_coverages(["README"]) == {"README": array("i", [-1])}
+        assert streaming.get_coverages([]) == {}
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000000])
+def test_report_parser(indent, chunk_size):
+    report = dir_node(
+        "src",
+        dir_node(
+            "dom",
+            file_node("a.cpp", [1, 0, -1, 2**40]),
+            file_node('{b}"[\\.cpp', [0, 0]),
+        ),
+        dir_node("coverage", file_node("children", [3]), dir_node("empty")),
+        file_node("README", [-1]),
+        file_node("empty.cpp", []),
+    )
+    data = json.dumps(report, indent=indent).encode("utf-8")
+
+    files = []
+    parser = covdir.ReportParser(lambda path, coverage: files.append((path, coverage)))
+    for i in range(0, len(data), chunk_size):
+        parser.feed(data[i : i + chunk_size])
+    parser.close()
+
+    assert {path: list(coverage) for path, coverage in files} == (
+        covdir.PathIndex.from_report(report).coverages
+    )
+    assert len(files) == 5
+    assert files[0] == ("dom/a.cpp", array("q", [1, 0, -1, 2**40]))
+
+    parser = covdir.ReportParser(lambda path, coverage: None)
+    parser.feed(data[:-1])
+    with pytest.raises(AssertionError, match="Truncated covdir report"):
+        parser.close()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import random
+import tracemalloc
+
+import pytest
+import zstandard
+from google.api_core.exceptions import NotFound
+
+from code_coverage_bot import covdir
+from code_coverage_bot import gcp
+from code_coverage_bot import uploader
+from code_coverage_bot.hooks.repo import RepositoryHook
+from code_coverage_bot.secrets import secrets
+from conftest import covdir_report
+
+
+def test_local_bucket(tmpdir):
+    bucket = gcp.get_bucket({"local_dir": tmpdir.strpath})
+    assert isinstance(bucket, gcp.LocalBucket)
+    assert gcp.get_bucket({"local_dir": tmpdir.strpath}) is bucket
+
+    blob = bucket.blob("mozilla-central/deadbeef/all:all.json.zstd")
+    assert not blob.exists()
+    assert bucket.get_blob(blob.name) is None
+    with pytest.raises(NotFound):
+        blob.download_as_bytes()
+
+    blob.content_encoding = "zstd"
+    blob.upload_from_string(b"0123456789", content_type="application/json")
+    bucket.blob("mozilla-central/cafe/all:all.json.zstd").upload_from_string(b"")
+    bucket.blob("other/file").upload_from_string("text")
+
+    blob = bucket.get_blob("mozilla-central/deadbeef/all:all.json.zstd")
+    assert blob.content_type == "application/json"
+    assert blob.content_encoding == "zstd"
+    assert blob.size == 10
+    assert blob.time_created is not None
+    assert blob.download_as_bytes() == b"0123456789"
+    assert blob.download_as_bytes(start=2, end=4) == b"234"
+
+    assert [blob.name for blob in bucket.list_blobs(prefix="mozilla-central")] == [
+        "mozilla-central/cafe/all:all.json.zstd",
+        "mozilla-central/deadbeef/all:all.json.zstd",
+    ]
+    assert len(list(bucket.list_blobs())) == 3
+
+    blob.delete()
+    assert not blob.exists()
+
+
+def test_upload_reports(mock_secrets, tmpdir):
+    bucket_dir = os.path.join(tmpdir.strpath, "bucket")
+    secrets[secrets.GOOGLE_CLOUD_STORAGE] = {"local_dir": bucket_dir}
+
+    report = covdir_report(
+        {"source_files": [{"name": "file", "coverage": [None, 1, 0]}]}
+    )
+    reports = {}
+    for platform in ("all", "linux", "windows"):
+        for suite in ("all", "mochitest", "xpcshell"):
+            path = os.path.join(tmpdir.strpath, f"{platform}.{suite}.json")
+            with open(path, "wb") as f:
+                f.write(covdir.dumps(report))
+            reports[(platform, suite)] = path
+
+    hook = RepositoryHook.__new__(RepositoryHook)
+    hook.repository = "https://hg.mozilla.org/mozilla-central"
+    hook.revision = "deadbeef"
+    hook.upload_reports(reports)
+
+    bucket = gcp.get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+    for platform, suite in reports:
+        blob = bucket.get_blob(f"mozilla-central/deadbeef/{platform}:{suite}.json.zstd")
+        assert blob.content_type == "application/json"
+        assert blob.content_encoding == "zstd"
+        assert zstandard.ZstdDecompressor().decompress(
+            blob.download_as_bytes()
+        ) == covdir.dumps(report)
+
+        blob = bucket.get_blob(f"mozilla-central/deadbeef/{platform}:{suite}.covbin")
+        assert blob.content_type == "application/octet-stream"
+        name = gcp.get_name("mozilla-central", "deadbeef", platform, suite)
+        assert list(gcp.download_file_coverage(bucket, name, "file")) == [-1, 1, 0]
+
+    manifest = uploader.get_manifest(bucket, "mozilla-central")
+    assert all(manifest.exists("deadbeef", *key) for key in reports)
+
+    assert list(gcp.list_reports(bucket, "mozilla-central")) == [
+        ("deadbeef", platform, suite) for platform, suite in sorted(reports)
+    ]
+
+
+def test_upload_reports_failure(mock_secrets, monkeypatch, tmpdir):
+    bucket_dir = os.path.join(tmpdir.strpath, "bucket")
+    secrets[secrets.GOOGLE_CLOUD_STORAGE] = {"local_dir": bucket_dir}
+
+    report = covdir.dumps(
+        covdir_report({"source_files": [{"name": "file", "coverage": [1]}]})
+    )
+    reports = {}
+    for platform in ("all", "linux", "windows"):
+        path = os.path.join(tmpdir.strpath, f"{platform}.json")
+        with open(path, "wb") as f:
+            f.write(report)
+        reports[(platform, "all")] = path
+
+    gcp_upload = uploader.gcp
+
+    def failing_gcp(repository, revision, report, platform, suite, manifest=None):
+        if platform == "linux":
+            raise Exception("Upload failure")
+        return gcp_upload(repository, revision, report, platform, suite, manifest)
+
+    monkeypatch.setattr(uploader, "gcp", failing_gcp)
+
+    # A report uploaded by a previous run, without being registered
+    bucket = gcp.get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+    uploader.get_manifest(bucket, "mozilla-central")
+    bucket.blob("mozilla-central/deadbeef/macosx:all.json.zstd").upload_from_string(b"")
+
+    hook = RepositoryHook.__new__(RepositoryHook)
+    hook.repository = "https://hg.mozilla.org/mozilla-central"
+    hook.revision = "deadbeef"
+    with pytest.raises(Exception, match="Upload failure"):
+        hook.upload_reports(reports)
+
+    # The uploaded reports are still registered, the first one was uploading
+    # when the failure cancelled the others
+    manifest = uploader.get_manifest(bucket, "mozilla-central")
+    assert manifest.exists("deadbeef", "all", "all")
+    assert manifest.exists("deadbeef", "macosx", "all")
+    assert not manifest.exists("deadbeef", "linux", "all")
+
+
+def test_upload_compressed_streaming(monkeypatch, tmpdir):
+    monkeypatch.setattr(uploader, "UPLOAD_CHUNK_SIZE", 256 * 1024)
+
+    path = tmpdir.join("report.json").strpath
+    with open(path, "wb") as f:
+        for i in range(64):
+            f.write(os.urandom(128 * 1024) + b"0," * 64 * 1024)
+    size = os.path.getsize(path)
+
+    class Blob:
+        name = "report.json.zstd"
+
+        def upload_from_file(self, f, content_type=None):
+            assert content_type == "application/json"
+            assert self.chunk_size == 256 * 1024
+            assert self.content_encoding == "zstd"
+
+            # Check the content chunk by chunk, without keeping it
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+            digest = hashlib.sha256()
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                digest.update(decompressor.decompress(chunk))
+            self.digest = digest.hexdigest()
+
+    blob = Blob()
+    with open(path, "rb") as f:
+        tracemalloc.start()
+        uploader._upload_compressed(blob, f, "application/json")
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    with open(path, "rb") as f:
+        assert blob.digest == hashlib.sha256(f.read()).hexdigest()
+
+    # Only a few chunks are in memory at once
+    assert peak < 8 * 256 * 1024 < size
+
+
+def test_gcp_upload_memory(mock_secrets, monkeypatch, tmpdir):
+    monkeypatch.setattr(uploader, "UPLOAD_CHUNK_SIZE", 64 * 1024)
+    secrets[secrets.GOOGLE_CLOUD_STORAGE] = {
+        "local_dir": os.path.join(tmpdir.strpath, "bucket")
+    }
+
+    rng = random.Random(42)
+    report = covdir_report(
+        {
+            "source_files": [
+                {
+                    "name": f"file{i}.cpp",
+                    "coverage": [rng.choice([None, 0, 1, 42]) for _ in range(1000)],
+                }
+                for i in range(500)
+            ]
+        }
+    )
+    path = tmpdir.join("report.json").strpath
+    with open(path, "wb") as f:
+        f.write(covdir.dumps(report))
+    size = os.path.getsize(path)
+    del report
+
+    with open(path, "rb") as f:
+        tracemalloc.start()
+        uploader.gcp("mozilla-central", "deadbeef", f, "all", "all")
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    # The report and its binary version are never fully in memory
+    assert peak < 8 * 64 * 1024 < size
+
+    bucket = gcp.get_bucket(secrets[secrets.GOOGLE_CLOUD_STORAGE])
+    name = gcp.get_name("mozilla-central", "deadbeef", "all", "all")
+    with open(path, "rb") as f:
+        index = covdir.PathIndex.from_report(covdir.load(f))
+    for path in ("file0.cpp", "file499.cpp"):
+        assert gcp.download_file_coverage(bucket, name, path) == index.get(path)
+
+
+def test_reports_manifest(tmpdir):
+    bucket = gcp.LocalBucket(tmpdir.strpath)
+    for name in (
+        "mozilla-central/deadbeef/all:all.json.zstd",
+        "mozilla-central/deadbeef/all:all.covbin",
+        "mozilla-central/deadbeef/linux:mochitest.json.zstd",
+        "mozilla-central/cafe/windows:all.json.zstd",
+        "try/babe/all:all.json.zstd",
+    ):
+        bucket.blob(name).upload_from_string(b"")
+
+    # Built from the listing when missing
+    manifest = uploader.get_manifest(bucket, "mozilla-central")
+    assert manifest.exists("deadbeef")
+    assert manifest.exists("deadbeef", "linux", "mochitest")
+    assert manifest.exists("cafe", "windows", "all")
+    assert not manifest.exists("cafe")
+    assert not manifest.exists("babe")
+    assert bucket.get_blob("manifests/mozilla-central.json.zstd") is not None
+
+    # Concurrent updates are merged
+    other = uploader.get_manifest(bucket, "mozilla-central")
+    manifest.add("cafe", "all", "all")
+    manifest.save()
+    other.add("f00d", "all", "all")
+    other.save()
+    assert other.exists("cafe")
+
+    # Only reloaded once changed
+    assert not manifest.exists("f00d")
+    manifest.refresh()
+    assert manifest.exists("f00d")
+    generation = manifest.generation
+    manifest.refresh()
+    assert manifest.generation == generation
+
+    # The listing is not used anymore once the manifest exists
+    bucket.blob("mozilla-central/beef/all:all.json.zstd").upload_from_string(b"")
+    assert not uploader.get_manifest(bucket, "mozilla-central").exists("beef")
+
+    # Unregistered reports are found by listing their revision
+    assert manifest.reconcile(["beef", "deadbeef"])
+    assert not manifest.reconcile(["beef", "missing"])
+    manifest.save()
+    assert uploader.get_manifest(bucket, "mozilla-central").exists("beef")
+
+
+def test_list_reports_cache(tmpdir):
+    bucket = gcp.LocalBucket(os.path.join(tmpdir.strpath, "bucket"))
+    for name in (
+        "mozilla-central/deadbeef/all:all.json.zstd",
+        "mozilla-central/deadbeef/all:all.covbin",
+        "mozilla-central/deadbeef/linux:all.json.zstd",
+        "mozilla-central/cafe/all:all.json.zstd",
+    ):
+        bucket.blob(name).upload_from_string(b"")
+    cache_path = os.path.join(tmpdir.strpath, "listing.json")
+
+    # Platform & suite are filtered on the listed entries
+    assert sorted(
+        gcp.list_reports(
+            bucket,
+            "mozilla-central",
+            platform="all",
+            suite="all",
+            cache_path=cache_path,
+        )
+    ) == [("cafe", "all", "all"), ("deadbeef", "all", "all")]
+    assert sorted(gcp.list_reports(bucket, "mozilla-central", platform="linux")) == [
+        ("deadbeef", "linux", "all")
+    ]
+
+    # All the reports are cached, whatever the filters
+    with open(cache_path) as f:
+        listing = json.load(f)
+    assert sorted(listing) == [
+        "mozilla-central/cafe/all:all.json.zstd",
+        "mozilla-central/deadbeef/all:all.json.zstd",
+        "mozilla-central/deadbeef/linux:all.json.zstd",
+    ]
+    assert sorted(
+        gcp.list_reports(
+            bucket, "mozilla-central", platform="linux", cache_path=cache_path
+        )
+    ) == [("deadbeef", "linux", "all")]
+
+    # Unchanged blobs are not parsed again on the next run
+    listing["mozilla-central/cafe/all:all.json.zstd"][2] = "cached"
+    with open(cache_path, "w") as f:
+        json.dump(listing, f)
+
+    bucket.blob("mozilla-central/f00d/all:all.json.zstd").upload_from_string(b"")
+    bucket.blob("mozilla-central/deadbeef/all:all.json.zstd").upload_from_string(b"")
+    assert sorted(
+        gcp.list_reports(
+            bucket,
+            "mozilla-central",
+            platform="all",
+            suite="all",
+            cache_path=cache_path,
+        )
+    ) == [("cached", "all", "all"), ("deadbeef", "all", "all"), ("f00d", "all", "all")]
+
+    # The cache is saved even when the listing is not fully consumed
+    os.unlink(cache_path)
+    reports = gcp.list_reports(bucket, "mozilla-central", cache_path=cache_path)
+    next(reports)
+    reports.close()
+    with open(cache_path) as f:
+        assert len(json.load(f)) == 1
+
+
+def test_download_report(monkeypatch, tmpdir):
+    bucket = gcp.LocalBucket(os.path.join(tmpdir.strpath, "bucket"))
+    data = b'{"name": "", "children": {}}' * 100000
+    name = gcp.get_name("mozilla-central", "deadbeef", "all", "all")
+    bucket.blob(f"{name}.json.zstd").upload_from_string(
+        zstandard.ZstdCompressor().compress(data)
+    )
+
+    # Missing reports are detected while downloading, without a probe
+    def exists(self):
+        raise AssertionError("Unexpected existence check")
+
+    monkeypatch.setattr(gcp.LocalBlob, "exists", exists)
+
+    reports_dir = os.path.join(tmpdir.strpath, "reports")
+    assert gcp.download_report(reports_dir, bucket, name)
+    with open(os.path.join(reports_dir, f"{name}.json"), "rb") as f:
+        assert f.read() == data
+    assert gcp.download_report_data(bucket, name) == data
+
+    missing = gcp.get_name("mozilla-central", "cafe", "all", "all")
+    assert not gcp.download_report(reports_dir, bucket, missing)
+    assert gcp.download_report_data(bucket, missing) is None
+    assert os.listdir(os.path.join(reports_dir, "mozilla-central", "cafe")) == []
+
+
+def test_reports_cache(tmpdir):
+    bucket = gcp.LocalBucket(os.path.join(tmpdir.strpath, "bucket"))
+    data = b'{"name": "", "children": {}}' * 100000
+    names = [
+        gcp.get_name("mozilla-central", revision, "all", "all")
+        for revision in ("deadbeef", "cafe")
+    ]
+    for name in names:
+        bucket.blob(f"{name}.json.zstd").upload_from_string(
+            zstandard.ZstdCompressor().compress(data)
+        )
+    archive_size = bucket.blob(f"{names[0]}.json.zstd").size
+
+    cache_dir = os.path.join(tmpdir.strpath, "cache")
+    reports_cache = gcp.ReportsCache(cache_dir, max_size=archive_size)
+    with reports_cache.extract(bucket, names[0]) as path:
+        with open(path, "rb") as f:
+            assert f.read() == data
+    assert not os.path.exists(path)
+
+    # Reports are kept compressed, and only downloaded once
+    bucket.blob(f"{names[0]}.json.zstd").delete()
+    assert os.path.getsize(reports_cache.fetch(bucket, names[0])) == archive_size
+    assert reports_cache.fetch(bucket, "mozilla-central/f00d/all:all") is None
+    assert (reports_cache.hits, reports_cache.misses) == (1, 2)
+
+    # The least recently used reports are evicted
+    os.utime(reports_cache.fetch(bucket, names[0]), (0, 0))
+    reports_cache.fetch(bucket, names[1])
+    reports_cache.evict()
+    assert not os.path.exists(reports_cache._path(names[0]))
+    assert os.path.exists(reports_cache._path(names[1]))
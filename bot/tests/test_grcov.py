@@ -261,3 +261,35 @@ def test_files_list_source_dir(
         [grcov_artifact, grcov_existing_file_artifact], source_dir=fake_source_dir
     )
     assert set(files) == set(["code_coverage_bot/cli.py"])
+
+
+@pytest.mark.parametrize(
+    "nb_reports, cpus, memory, expected",
+    [
+        # Enough memory: the CPUs are split between all reports.
+        (200, 16, 128 * 1024**3, (16, 1)),
+        (4, 16, 128 * 1024**3, (4, 4)),
+        # Memory bound: fewer processes, each with more threads.
+        (200, 16, 16 * 1024**3, (4, 4)),
+        (200, 16, 1024**3, (1, 16)),
+        (1, 1, 0, (1, 1)),
+    ],
+)
+def test_plan_parallelism(nb_reports, cpus, memory, expected):
+    assert (
+        grcov.plan_parallelism(nb_reports, cpus, memory, memory_per_report=4 * 1024**3)
+        == expected
+    )
+
+
+def test_report_to_file(tmpdir, grcov_artifact, jsvm_artifact):
+    path = tmpdir.join("report.json").strpath
+    assert (
+        grcov.report_to_file([grcov_artifact, jsvm_artifact], path, out_format="covdir")
+        == path
+    )
+
+    with open(path, "rb") as f:
+        assert f.read() == grcov.report(
+            [grcov_artifact, jsvm_artifact], out_format="covdir"
+        )
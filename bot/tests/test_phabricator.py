@@ -5,10 +5,14 @@ import os
 import urllib.parse
 
 import hglib
+import pytest
 import responses
 
 from code_coverage_bot import hgmo
+from code_coverage_bot.cache import AnnotateCache
+from code_coverage_bot.hooks import repo
 from code_coverage_bot.phabricator import PhabricatorUploader
+from code_coverage_bot.secrets import secrets
 from conftest import add_file
 from conftest import changesets
 from conftest import commit
@@ -474,6 +478,210 @@ def test_changesets_overwriting_one_commit_without_differential(
     }
 
 
+def test_run_annotate_batch(mock_secrets, fake_hg_repo):
+    hg, local, remote = fake_hg_repo
+
+    add_file(hg, local, "file", "1\n2\n3\n")
+    add_file(hg, local, "dir/file2", "1\n")
+    add_file(hg, local, "removed", "1\n")
+    revision1 = commit(hg, 1)
+
+    add_file(hg, local, "file", "1\n2\n4\n3\n")
+    add_file(hg, local, "dir/file 3", "1\n2\n")
+    hg.remove(files=[bytes(os.path.join(local, "removed"), "ascii")])
+    revision2 = commit(hg, 2)
+
+    phabricator = PhabricatorUploader(local, revision2)
+    paths = ["file", "removed", "dir/file 3", "missing", "dir/file2"]
+    with hglib.open(local) as hg:
+        annotate = phabricator.run_annotate_batch(hg, revision2, paths)
+        assert annotate == {
+            path: phabricator.run_annotate(hg, revision2, path) for path in paths
+        }
+        assert phabricator.run_annotate_batch(hg, revision2, []) == {}
+        assert phabricator.run_annotate_batch(hg, revision1, ["dir/file 3"]) == {
+            "dir/file 3": None
+        }
+
+    assert annotate == {
+        "file": (
+            (revision1[:12], 1),
+            (revision1[:12], 2),
+            (revision2[:12], 3),
+            (revision1[:12], 3),
+        ),
+        "removed": None,
+        "dir/file 3": ((revision2[:12], 1), (revision2[:12], 2)),
+        "missing": None,
+        "dir/file2": ((revision1[:12], 1),),
+    }
+
+
+def test_run_annotate_cache(mock_secrets, fake_hg_repo, tmpdir):
+    hg, local, remote = fake_hg_repo
+
+    add_file(hg, local, "file", "1\n2\n3\n")
+    revision = commit(hg, 1)
+
+    annotate_cache = AnnotateCache(os.path.join(tmpdir.strpath, "annotate.sqlite"))
+    phabricator = PhabricatorUploader(local, revision, annotate_cache=annotate_cache)
+    with hglib.open(local) as hg:
+        annotate = phabricator.run_annotate_batch(hg, revision, ["file", "removed"])
+    assert annotate == {
+        "file": ((revision[:12], 1), (revision[:12], 2), (revision[:12], 3)),
+        "removed": None,
+    }
+
+    # Cached annotations do not need the repository anymore
+    assert phabricator.run_annotate_batch(None, revision, ["file", "removed"]) == (
+        annotate
+    )
+    assert annotate_cache.stats() == {"hits": 2, "misses": 2}
+
+
+def test_coverage_map(tmpdir):
+    phabricator = PhabricatorUploader(tmpdir.strpath, "build")
+    build_annotate = (("aaa", 1), ("bbb", 1), ("aaa", 2), ("aaa", 3), ("ccc", 1))
+    coverage_map = phabricator._build_coverage_map(build_annotate, [-1, 0, 3])
+
+    # Lines after the coverage record are uncoverable, overwritten ones unknown
+    annotate = (("aaa", 1), ("aaa", 2), ("ddd", 1), ("bbb", 1), ("aaa", 3))
+    assert phabricator._apply_coverage_map(annotate, coverage_map) == b"NCXUN"
+    assert phabricator._apply_coverage_map((), coverage_map) == b""
+
+
+def local_changesets(hg, revision):
+    """
+    Stack of changesets up to a revision, read from the repository without pushlog
+    """
+    stack = []
+    for entry in hg.log(revrange=f"::{revision}"):
+        node = entry[1].decode("ascii")
+        stack.append(
+            {
+                "node": node,
+                "desc": entry[5].decode("utf-8"),
+                "backsoutnodes": [],
+                "files": [
+                    path.decode("utf-8")
+                    for status, path in hg.status(change=node)
+                    if status != b"R"
+                ],
+            }
+        )
+    return stack
+
+
+@pytest.mark.parametrize(
+    "contents, coverage",
+    [
+        # Simple
+        (
+            [{"file": "1\n2\n3\n4\n5\n6\n7\n"}],
+            {"file": [None, 0, 1, 1, 1, 1, 0]},
+        ),
+        # Overwriting
+        (
+            [
+                {"file": "1\n2\n3\n4\n5\n6\n7\n"},
+                {"file": "1\n2\n3\n4\n5\n6\n8\n"},
+            ],
+            {"file": [None, 0, 1, 1, 1, 1, 0]},
+        ),
+        # Displacing
+        (
+            [
+                {"file": "1\n2\n3\n4\n5\n6\n7\n"},
+                {"file": "-1\n-2\n1\n2\n3\n4\n5\n6\n7\n8\n9\n"},
+            ],
+            {"file": [0, 1, None, 0, 1, 1, 1, 1, 0, 1, 0]},
+        ),
+        # Reducing size
+        (
+            [
+                {"file": "1\n2\n3\n4\n5\n6\n7\n"},
+                {"file": "1\n2\n3\n4\n5\n"},
+            ],
+            {"file": [None, 0, 1, 1, 1]},
+        ),
+        # Increasing size, with a change in the middle and a shorter record
+        (
+            [
+                {"file": "1\n2\n3\n4\n5\n6\n7\n"},
+                {"file": "1\n2\n3\n0\n4\n5\n6\n7\n8\n9\n"},
+                {"file": "1\n2\n-3\n0\n4\n5\n6\n7\n8\n9\n"},
+            ],
+            {"file": [None, 0, 1, 1, 1, 1, 0, 1]},
+        ),
+        # Two files, one of them removed and added back. The diff engine cannot see
+        # lines restored with the same content, so they are different here.
+        (
+            [
+                {"file1_commit1": "1\n2\n", "file2_commit1": "1\n2\n3\n"},
+                {"file1_commit1": "1\n3\n2\n", "file2_commit1": None},
+                {"file2_commit1": "4\n5\n"},
+            ],
+            {"file1_commit1": [1, 0, 1], "file2_commit1": [None, 1]},
+        ),
+    ],
+)
+def test_mapping_engines(mock_secrets, fake_hg_repo, contents, coverage):
+    hg, local, remote = fake_hg_repo
+
+    for i, files in enumerate(contents):
+        for path, content in files.items():
+            if content is None:
+                hg.remove(files=[bytes(os.path.join(local, path), "ascii")])
+            else:
+                add_file(hg, local, path, content)
+        revision = commit(hg, i + 1)
+
+    report = covdir_report(
+        {
+            "source_files": [
+                {"name": path, "coverage": lines} for path, lines in coverage.items()
+            ]
+        }
+    )
+    with hglib.open(local) as hg:
+        stack = local_changesets(hg, revision)
+        results = {
+            mapping: PhabricatorUploader(local, revision, mapping=mapping).generate(
+                hg, report, stack
+            )
+            for mapping in ("annotate", "diff")
+        }
+
+    assert len(results["annotate"]) == len(contents)
+    assert results["diff"] == results["annotate"]
+
+
+def test_hook_mapping_engine(mock_secrets, monkeypatch):
+    engines = []
+
+    class FakeUploader(object):
+        def __init__(self, repo_dir, revision, annotate_cache=None, mapping=None):
+            engines.append(mapping)
+
+        def upload(self, report, changesets):
+            return {}
+
+    monkeypatch.setattr(repo, "PhabricatorUploader", FakeUploader)
+    monkeypatch.setitem(secrets, secrets.MAPPING_ENGINE, "diff")
+
+    hook = repo.RepositoryHook.__new__(repo.RepositoryHook)
+    hook.repo_dir = "repo"
+    hook.revision = "deadbeef"
+    hook.cache_root = None
+
+    # The secret is only a fallback for the engine given on the CLI
+    hook.mapping_engine = "annotate"
+    hook.upload_phabricator({}, [])
+    hook.mapping_engine = None
+    hook.upload_phabricator({}, [])
+    assert engines == ["annotate", "diff"]
+
+
 def test_removed_file(mock_secrets, fake_hg_repo):
     hg, local, remote = fake_hg_repo
 
@@ -593,6 +801,21 @@ def test_third_party(mock_secrets, fake_hg_repo):
     assert phabricator.is_third_party("third_party/test.cpp") is True
     assert phabricator.is_third_party("some/test.cpp") is False
     assert phabricator.is_third_party("some/path/test.cpp") is True
+    assert phabricator.is_third_party("third_party_lib.cpp") is True
+    assert phabricator.is_third_party("third") is False
+
+    # The matcher is reused until the list changes
+    matcher = phabricator.third_parties_matcher
+    assert PhabricatorUploader(local, revision).third_parties_matcher is matcher
+
+    path = os.path.join(local, "tools/rewriting/ThirdPartyPaths.txt")
+    with open(path, "w") as f:
+        f.write("other\n")
+    os.utime(path, (0, 0))
+    phabricator = PhabricatorUploader(local, revision)
+    assert phabricator.third_parties_matcher is not matcher
+    assert phabricator.third_parties == ["other"]
+    assert phabricator.is_third_party("third_party/test.cpp") is False
 
 
 def test_supported_extensions(mock_secrets, fake_hg_repo):
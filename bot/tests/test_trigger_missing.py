@@ -9,7 +9,6 @@ from code_coverage_bot import hgmo
 from code_coverage_bot import taskcluster
 from code_coverage_bot import trigger_missing
 from code_coverage_bot import uploader
-from code_coverage_bot.taskcluster import taskcluster_config
 from conftest import add_file
 from conftest import commit
 from conftest import copy_pushlog_database
@@ -62,16 +61,23 @@ def test_trigger_from_scratch(
 
     gcp_covdir_exists_calls = 0
 
-    def gcp_covdir_exists(bucket, repository, revision, platform, suite):
-        nonlocal gcp_covdir_exists_calls
-        gcp_covdir_exists_calls += 1
+    class FakeManifest(object):
+        def exists(self, revision, platform, suite):
+            nonlocal gcp_covdir_exists_calls
+            gcp_covdir_exists_calls += 1
+            assert platform == "all"
+            assert suite == "all"
+            return revision == revision3
+
+        def reconcile(self, revisions):
+            return False
+
+    def get_manifest(bucket, repository):
         assert bucket == myBucket
         assert repository == "mozilla-central"
-        assert platform == "all"
-        assert suite == "all"
-        return revision == revision3
+        return FakeManifest()
 
-    monkeypatch.setattr(uploader, "gcp_covdir_exists", gcp_covdir_exists)
+    monkeypatch.setattr(uploader, "get_manifest", get_manifest)
 
     def slugId():
         return "myGroupId"
@@ -99,7 +105,7 @@ def test_trigger_from_scratch(
 
         return HooksService()
 
-    monkeypatch.setattr(taskcluster_config, "get_service", get_service)
+    monkeypatch.setattr(taskcluster, "get_service", get_service)
 
     get_decision_task_calls = 0
 
@@ -257,16 +263,23 @@ def test_trigger_from_preexisting(
 
     gcp_covdir_exists_calls = 0
 
-    def gcp_covdir_exists(bucket, repository, revision, platform, suite):
-        nonlocal gcp_covdir_exists_calls
-        gcp_covdir_exists_calls += 1
+    class FakeManifest(object):
+        def exists(self, revision, platform, suite):
+            nonlocal gcp_covdir_exists_calls
+            gcp_covdir_exists_calls += 1
+            assert platform == "all"
+            assert suite == "all"
+            return revision == revision3
+
+        def reconcile(self, revisions):
+            return False
+
+    def get_manifest(bucket, repository):
         assert bucket == myBucket
         assert repository == "mozilla-central"
-        assert platform == "all"
-        assert suite == "all"
-        return revision == revision3
+        return FakeManifest()
 
-    monkeypatch.setattr(uploader, "gcp_covdir_exists", gcp_covdir_exists)
+    monkeypatch.setattr(uploader, "get_manifest", get_manifest)
 
     def slugId():
         return "myGroupId"
@@ -293,7 +306,7 @@ def test_trigger_from_preexisting(
 
         return HooksService()
 
-    monkeypatch.setattr(taskcluster_config, "get_service", get_service)
+    monkeypatch.setattr(taskcluster, "get_service", get_service)
 
     get_decision_task_calls = 0
 
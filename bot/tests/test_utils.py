@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+import http.server
+import io
+import os
+import sys
+import threading
+import zipfile
+from zipfile import BadZipFile
+
+import pytest
+import responses
+
+from code_coverage_bot import utils
+
+
+def build_zip(compression=zipfile.ZIP_DEFLATED):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", compression=compression) as z:
+        z.writestr("grcov.info", b"SF:js/src/jit/BitSet.cpp\nDA:1,42\n" * 5000)
+        z.writestr("jsvm.info", os.urandom(1000000))
+    return data.getvalue()
+
+
+def feed(content, chunk_size=1000):
+    validator = utils.ZipStreamValidator()
+    for i in range(0, len(content), chunk_size):
+        validator.feed(content[i : i + chunk_size])
+    return validator
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_zip_stream_validator(compression):
+    content = build_zip(compression)
+
+    validator = feed(content)
+    validator.finish()
+    assert validator.done
+    assert validator.entries == 2
+    assert not validator.unverified
+
+
+def test_zip_stream_validator_data_descriptor():
+    # Entries written to an unseekable stream store their CRC after the data.
+    class Unseekable(io.RawIOBase):
+        def __init__(self):
+            self.data = bytearray()
+
+        def writable(self):
+            return True
+
+        def write(self, b):
+            self.data += b
+            return len(b)
+
+    out = Unseekable()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        with z.open("grcov.info", "w") as f:
+            f.write(b"DA:1,42\n" * 1000)
+
+    validator = feed(bytes(out.data), chunk_size=7)
+    validator.finish()
+    assert validator.done
+
+
+def test_zip_stream_validator_truncated():
+    content = build_zip()
+
+    validator = feed(content[:-30])
+    with pytest.raises(utils.TruncatedDownload):
+        validator.finish()
+
+
+def test_zip_stream_validator_bad_crc():
+    content = bytearray(build_zip(zipfile.ZIP_STORED))
+    content[100] ^= 0xFF
+
+    with pytest.raises(BadZipFile, match="Bad CRC-32 for file grcov.info"):
+        feed(bytes(content))
+
+
+def test_zip_stream_validator_not_zip():
+    with pytest.raises(BadZipFile, match="File is not a zip file"):
+        feed(b"NOT A ZIP FILE")
+
+
+@pytest.fixture
+def flaky_server():
+    """
+    Local HTTP server supporting ranges, that truncates its first responses
+    """
+    content = build_zip()
+    requests_ranges = []
+    truncations = [len(content) // 3, len(content) // 2]
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = 0
+            range_header = self.headers.get("Range")
+            requests_ranges.append(range_header)
+            if range_header is not None:
+                start = int(range_header[len("bytes=") : -1])
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range",
+                    f"bytes {start}-{len(content) - 1}/{len(content)}",
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(content) - start))
+            self.end_headers()
+
+            if truncations:
+                # Close the connection before the end of the file.
+                self.wfile.write(content[start : truncations.pop(0)])
+                self.close_connection = True
+                return
+
+            self.wfile.write(content[start:])
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    responses.add_passthru(url)
+
+    yield f"{url}/code-coverage-grcov.zip", content, requests_ranges
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_file_resume(flaky_server, tmpdir, mock_tenacity):
+    url, content, requests_ranges = flaky_server
+    path = os.path.join(tmpdir.strpath, "linux_xpcshell-1_code-coverage-grcov.zip")
+
+    utils.download_file(url, path)
+
+    with open(path, "rb") as f:
+        assert f.read() == content
+    assert not os.path.exists(f"{path}.part")
+
+    # Each retry resumed the download close to where it stopped.
+    assert len(requests_ranges) == 3
+    assert requests_ranges[0] is None
+    offsets = [int(r[len("bytes=") : -1]) for r in requests_ranges[1:]]
+    assert 0 < offsets[0] <= len(content) // 3
+    assert offsets[0] < offsets[1] <= len(content) // 2
+
+
+def test_session_reuses_connections():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    responses.add_passthru(url)
+
+    session = utils.get_session()
+    assert session is utils.get_session()
+
+    before = utils.session_stats()
+    for i in range(3):
+        assert session.get(f"{url}/{i}").text == "ok"
+    after = utils.session_stats()
+
+    server.shutdown()
+    server.server_close()
+
+    assert after["requests"] - before["requests"] == 3
+    assert after["connections"] - before["connections"] == 1
+    assert after["reused"] - before["reused"] == 2
+
+
+def test_run_to_file(tmpdir):
+    path = tmpdir.join("output").strpath
+    script = (
+        "import sys\n"
+        "sys.stdout.write('x' * 10000000)\n"
+        "for i in range(100000):\n"
+        "    sys.stderr.write(f'line {i}\\n')\n"
+    )
+
+    peak_rss = utils.run_to_file([sys.executable, "-c", script], path)
+
+    assert os.path.getsize(path) == 10000000
+    assert peak_rss > 0
+
+
+def test_run_to_file_error(tmpdir, capsys):
+    path = tmpdir.join("output").strpath
+    script = (
+        "import sys\n"
+        "for i in range(100000):\n"
+        "    sys.stderr.write(f'line {i}\\n')\n"
+        "sys.exit(3)\n"
+    )
+
+    with pytest.raises(Exception, match="failed with code: 3"):
+        utils.run_to_file([sys.executable, "-c", script], path, error_lines=2)
+
+    # Only the end of the error output is kept
+    out = capsys.readouterr().out
+    assert "Error:\nline 99998\nline 99999\n" in out
+    assert "line 99997" not in out
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from code_coverage_bot import covdir
+from code_coverage_bot.artifacts import Artifact
+from code_coverage_bot.artifacts import ArtifactsHandler
+
+PLATFORMS = ["linux", "windows", "android", "macosx"]
+
+
+def timed(name, func, *args, **kwargs):
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    print(f"{name}: {1000 * (time.perf_counter() - start):.2f}ms")
+    return out
+
+
+def benchmark_artifacts(args):
+    """
+    Measure ArtifactsHandler lookups, as used when building reports & chunk mapping
+    """
+    rng = random.Random(42)
+    artifacts = []
+    for i in range(args.nb):
+        platform = rng.choice(PLATFORMS)
+        suite = f"suite{rng.randrange(args.suites)}"
+        chunk = f"{suite}-{rng.randrange(args.chunks)}"
+        artifacts.append(
+            Artifact(f"{platform}_{chunk}_{i}.zip", str(i), platform, suite, chunk)
+        )
+
+    handler = ArtifactsHandler([])
+    timed("add_artifact", lambda: [handler.add_artifact(a) for a in artifacts])
+
+    combinations = timed("get_combinations", handler.get_combinations)
+    print(f"  {len(combinations)} combinations")
+
+    def chunk_lookups():
+        nb = 0
+        for platform in PLATFORMS:
+            for chunk in handler.get_chunks(platform):
+                nb += len(handler.get(platform=platform, chunk=chunk))
+        return nb
+
+    timed("get(platform, chunk) for all chunks", chunk_lookups)
+
+
+def benchmark_covdir(args):
+    """
+    Compare the memory used by a covdir report loaded as plain dicts or as a compact tree
+    """
+    rng = random.Random(42)
+
+    def build_dir(name, depth):
+        children = {}
+        for i in range(args.width):
+            if depth < args.depth:
+                child = build_dir(f"dir{i}", depth + 1)
+            else:
+                child = {
+                    "name": f"file{i}.cpp",
+                    "coverage": [
+                        rng.choice([-1, 0, rng.randrange(1, 100000)])
+                        for _ in range(args.lines)
+                    ],
+                }
+            children[child["name"]] = child
+        return {"name": name, "children": children}
+
+    report = build_dir("", 1)
+    covdir.update_stats(report)
+    data = covdir.dumps(report)
+    del report
+    print(f"Report: {len(data) / 1024**2:.1f}MiB")
+
+    for name, load in (("json.load", json.loads), ("covdir.load", covdir.loads)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        report = load(data)
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del report
+        print(
+            f"{name}: {elapsed:.2f}s, {current / 1024**2:.1f}MiB "
+            f"(peak {peak / 1024**2:.1f}MiB)"
+        )
+
+    # Only retrieve a few files, as for a push
+    paths = rng.sample(covdir.PathIndex.from_report(covdir.loads(data)).paths(), 20)
+    tracemalloc.start()
+    start = time.perf_counter()
+    coverages = covdir.StreamingReport(data).get_coverages(paths)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(coverages) == len(paths)
+    print(
+        f"StreamingReport.get_coverages ({len(paths)} files): {elapsed:.2f}s "
+        f"(peak {peak / 1024**2:.1f}MiB)"
+    )
+
+
+def benchmark_upload(args):
+    """
+    Upload covdir reports to a local bucket, as the repository hooks do
+    """
+    from code_coverage_bot.hooks import repo
+    from code_coverage_bot.secrets import secrets
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        secrets.update(
+            {secrets.GOOGLE_CLOUD_STORAGE: {"local_dir": os.path.join(tmp_dir, "gcs")}}
+        )
+
+        rng = random.Random(42)
+        report = {
+            "name": "",
+            "children": {
+                f"file{i}.cpp": {
+                    "name": f"file{i}.cpp",
+                    "coverage": [rng.choice([-1, 0, 3]) for _ in range(args.lines)],
+                }
+                for i in range(args.files)
+            },
+        }
+        covdir.update_stats(report)
+        data = covdir.dumps(report)
+
+        reports = {}
+        for i in range(args.nb):
+            path = os.path.join(tmp_dir, f"{i}.json")
+            with open(path, "wb") as f:
+                f.write(data)
+            reports[("all", f"suite{i}")] = path
+
+        hook = repo.RepositoryHook.__new__(repo.RepositoryHook)
+        hook.repository = "https://hg.mozilla.org/mozilla-central"
+        hook.revision = "deadbeef"
+        repo.UPLOAD_WORKERS = args.workers
+        timed(f"upload_reports ({args.nb} reports)", hook.upload_reports, reports)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Code coverage bot benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    artifacts = subparsers.add_parser("artifacts", help=benchmark_artifacts.__doc__)
+    artifacts.add_argument("--nb", type=int, default=5000, help="Number of artifacts")
+    artifacts.add_argument("--suites", type=int, default=60, help="Number of suites")
+    artifacts.add_argument("--chunks", type=int, default=20, help="Chunks per suite")
+    artifacts.set_defaults(func=benchmark_artifacts)
+
+    covdir_parser = subparsers.add_parser("covdir", help=benchmark_covdir.__doc__)
+    covdir_parser.add_argument("--depth", type=int, default=3, help="Tree depth")
+    covdir_parser.add_argument("--width", type=int, default=20, help="Entries per dir")
+    covdir_parser.add_argument("--lines", type=int, default=300, help="Lines per file")
+    covdir_parser.set_defaults(func=benchmark_covdir)
+
+    upload = subparsers.add_parser("upload", help=benchmark_upload.__doc__)
+    upload.add_argument("--nb", type=int, default=50, help="Number of reports")
+    upload.add_argument("--files", type=int, default=2000, help="Files per report")
+    upload.add_argument("--lines", type=int, default=200, help="Lines per file")
+    upload.add_argument("--workers", type=int, default=8, help="Upload workers")
+    upload.set_defaults(func=benchmark_upload)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ from datetime import datetime
 
 from taskcluster.utils import slugId
 
+from code_coverage_bot import taskcluster
 from code_coverage_bot.taskcluster import taskcluster_config
 
 MC_REPO = "https://hg.mozilla.org/mozilla-central"
@@ -20,7 +21,7 @@ def trigger_task(app_channel, task_group_id, commit):
     name = "covdir with suites on {} - {} - {}".format(
         app_channel, date, commit["changeset"]
     )
-    hooks = taskcluster_config.get_service("hooks")
+    hooks = taskcluster.get_service("hooks")
     payload = {
         "REPOSITORY": MC_REPO,
         "REVISION": commit["changeset"],
@@ -57,7 +58,7 @@ def main():
 
     # List existing tags & commits
     print("Group", args.group)
-    queue = taskcluster_config.get_service("queue")
+    queue = taskcluster.get_service("queue")
     try:
         group = queue.listTaskGroup(args.group)
         commits = [
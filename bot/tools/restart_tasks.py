@@ -5,6 +5,7 @@ import os
 from taskcluster.utils import slugId
 
 from code_coverage_bot.secrets import secrets
+from code_coverage_bot import taskcluster
 from code_coverage_bot.taskcluster import taskcluster_config
 
 CODECOV_URL = "https://codecov.io/api/gh/marco-c/gecko-dev/commit"
@@ -15,7 +16,7 @@ taskcluster_config.auth(
     os.environ.get("TASKCLUSTER_CLIENT_ID"), os.environ.get("TASKCLUSTER_ACCESS_TOKEN")
 )
 secrets.load(os.environ["TASKCLUSTER_SECRET"])
-queue = taskcluster_config.get_service("queue")
+queue = taskcluster.get_service("queue")
 
 
 def list_commits(tasks):
@@ -39,7 +40,7 @@ def trigger_task(task_group_id, repository, commit):
     name = "covdir {} - {} - {}".format(
         secrets[secrets.APP_CHANNEL], repository, commit
     )
-    hooks = taskcluster_config.get_service("hooks")
+    hooks = taskcluster.get_service("hooks")
     payload = {
         "REPOSITORY": repository,
         "REVISION": commit,